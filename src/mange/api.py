@@ -2,19 +2,25 @@
 import base64
 from datetime import datetime
 from datetime import date
+from collections import namedtuple
 from functools import wraps, lru_cache
 from hashlib import sha256
 import inspect
+import itertools
+import json
 import logging
 import uuid
 import pathlib
 import pickle
 import time
 
-from sqlalchemy import create_engine
+from sqlalchemy import and_, create_engine, event, func, insert, or_, tuple_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import text, select
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import sessionmaker, scoped_session, aliased, Session
 
+from mange import forecast, metrics
+from mange.cache import TaggedCache
 from mange.conf import settings
 from mange.db import (
     Base,
@@ -25,7 +31,11 @@ from mange.db import (
     User,
     Group,
     Token,
+    ConsumoMensual,
+    Alerta,
+    get_engine,
     load_backup,
+    registro_changed,
 )
 from mange.log import logged
 
@@ -34,57 +44,561 @@ log = logging.getLogger("global")
 DB = settings.DATABASES["default"]
 URL = DB["engine"]
 
+# What a request needs to know about who made it
+AuthContext = namedtuple("AuthContext", ("user_id", "name", "group"))
+
+# token -> AuthContext, shared by every Client of the process. A commit that
+# changes users, groups or tokens clears it in this process only: the other
+# workers, and the ASGI app, keep serving what they cached for up to
+# AUTH_CACHE_TTL seconds.
+auth_cache = TaggedCache(settings.AUTH_CACHE_SIZE, settings.AUTH_CACHE_TTL)
+AUTH = "auth"
+
+
+def auth_stmt(token):
+    """:return: select of the AuthContext fields of the owner of token"""
+    return (
+        select(User.id, User.name, Group.name)
+        .join(Token, Token.user_id == User.id)
+        .outerjoin(Group, Group.id == User.group_id)
+        .where(Token.value == token)
+    )
+
+
+def resolve_auth(token, query):
+    """
+    :param query: called to resolve token when it's not cached, returns an AuthContext or None
+    """
+    context = auth_cache.get(token)
+    if context is not None:
+        return context
+    # a context read while a change commits is stale, it isn't kept
+    generation = auth_cache.generation
+    context = query()
+    if context is not None:
+        auth_cache.set(token, context, (AUTH,), generation)
+    return context
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_auth_changes(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (User, Group, Token)):
+            session.info["auth_changed"] = True
+            return
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_auth_cache(session):
+    # after the commit, a context resolved meanwhile would cache the old row
+    if session.info.pop("auth_changed", False):
+        auth_cache.invalidate((AUTH,))
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_auth_changes(session):
+    session.info.pop("auth_changed", None)
+
+
+# encoded report responses, tagged with the Sucursal ids they read. Commits of
+# this process invalidate them, writes made by any other process (the other
+# workers, mange import-readings) are only seen once REPORT_CACHE_TTL expires.
+report_cache = TaggedCache(settings.REPORT_CACHE_SIZE, settings.REPORT_CACHE_TTL)
+ALL_SUCURSALES = "*"
+
+
+def report_tags(sucursales):
+    """
+    Tags of a report computed over a list of Sucursal ids, None meaning every branch.
+    """
+    if sucursales is None:
+        return (ALL_SUCURSALES,)
+    return tuple(sucursales)
+
+
+def invalidate_reports(sucursales):
+    """
+    Drop the cached reports that read any of the given Sucursal ids,
+    including the ones computed over every branch.
+    """
+    report_cache.invalidate({ALL_SUCURSALES, *sucursales})
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_report_changes(session, flush_context):
+    changed = session.info.setdefault("report_sucursales", set())
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (Registro, Alerta)):
+            changed.add(obj.id_sucursal)
+        elif isinstance(obj, Sucursal):
+            changed.add(obj.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_report_cache(session):
+    # after the commit, so a report recomputed right away sees the new rows
+    changed = session.info.pop("report_sucursales", None)
+    if changed:
+        invalidate_reports(changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_report_changes(session):
+    session.info.pop("report_sucursales", None)
+
 
 def benchmark(method):
+    """
+    Record the wall time of every call in the mange_client_seconds histogram
+    """
+    labels = (method.__name__,)
+
     @wraps(method)
     def wrapper(*args, **kwargs):
-        start = time.time()
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            metrics.client_seconds.observe(time.perf_counter() - start, labels)
 
-        result = method(*args, **kwargs)
+    return wrapper
 
-        end = round(time.time() - start, 3)
-        log.info("benchmarked method %s %s", method.__name__, end)
-        return result
 
-    return wrapper
+def benchmarked(cls):
+    """Class decorator, benchmark every public method"""
+    for name, value in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.isfunction(value):
+            setattr(cls, name, benchmark(value))
+    return cls
+
+
+def encode_cursor(values):
+    """
+    Opaque keyset cursor pointing right after a row with the given key values.
+    """
+    raw = json.dumps(
+        [value.isoformat() if isinstance(value, date) else value for value in values]
+    )
+    return base64.urlsafe_b64encode(raw.encode("utf8")).decode("ascii")
+
+
+def decode_cursor(Obj, keys, cursor):
+    """
+    Inverse of encode_cursor, values are coerced to the python type of each key column.
+    :raises ValueError: on a malformed cursor
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError) as exc:
+        raise ValueError(f"Invalid cursor {cursor!r}") from exc
+
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise ValueError(f"Invalid cursor {cursor!r}")
+
+    decoded = []
+    for key, value in zip(keys, values):
+        python_type = getattr(Obj, key).type.python_type
+        if python_type in (date, datetime):
+            if not isinstance(value, str):
+                raise ValueError(f"Invalid cursor {cursor!r}")
+            try:
+                value = python_type.fromisoformat(value)
+            except ValueError as exc:
+                raise ValueError(f"Invalid cursor {cursor!r}") from exc
+        elif not isinstance(value, python_type) or (isinstance(value, bool) and python_type is not bool):
+            raise ValueError(f"Invalid cursor {cursor!r}")
+        decoded.append(value)
+
+    return decoded
+
+
+def order_by(Obj, keys):
+    """
+    :param keys: column names, prefixed with "-" for descending order
+    :return: the ORDER BY clauses of keys
+    """
+    return [
+        getattr(Obj, key[1:]).desc() if key.startswith("-") else getattr(Obj, key)
+        for key in keys
+    ]
+
+
+def keyset(query, Obj, keys, after, limit):
+    """
+    Restrict a query (ORM or Core select) to the page after the ``after`` cursor.
+    Keys prefixed with "-" are in descending order.
+    One row more than ``limit`` is fetched to know if there is a next page, see keyset_page.
+    """
+    names = [key.lstrip("-") for key in keys]
+    descending = [key.startswith("-") for key in keys]
+    columns = [getattr(Obj, name) for name in names]
+
+    if after is not None:
+        values = decode_cursor(Obj, names, after)
+        if not any(descending):
+            query = query.filter(tuple_(*columns) > tuple_(*values))
+        elif all(descending):
+            query = query.filter(tuple_(*columns) < tuple_(*values))
+        else:
+            # see sort_keys, the keys after a unique one never decide
+            # a row comes after when it is equal on the first i keys and beyond on the next one
+            query = query.filter(or_(*(
+                and_(
+                    *(columns[j] == values[j] for j in range(i)),
+                    columns[i] < values[i] if descending[i] else columns[i] > values[i],
+                )
+                for i in range(len(columns))
+            )))
+
+    return query.order_by(*order_by(Obj, keys)).limit(limit + 1)
+
+
+def keyset_page(rows, keys, limit):
+    """
+    :return: (rows of the page, cursor of the next page or None if this is the last one)
+    """
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = encode_cursor([getattr(rows[-1], key.lstrip("-")) for key in keys])
+
+    return rows, cursor
+
+
+@lru_cache(maxsize=None)
+def indexed_columns(Obj):
+    """
+    Names of the columns of Obj leading an index, a unique constraint or the primary key:
+    the ones collections can be filtered and sorted on without scanning the table.
+    Partial indexes only cover some rows, they don't count.
+    """
+    table = Obj.__table__
+    names = {column.name for column in table.primary_key.columns}
+    names.update(column.name for column in table.columns if column.unique or column.index)
+    for index in table.indexes:
+        if index.dialect_options["sqlite"]["where"] is None:
+            names.add(index.expressions[0].name)
+    return frozenset(names)
+
+
+FILTER_OPERATORS = ("gt", "gte", "lt", "lte", "in", "startswith")
+
+
+def parse_value(column, value):
+    """
+    Coerce a query string value to the python type of column.
+    :raises ValueError:
+    """
+    python_type = column.type.python_type
+    if python_type is bool:
+        if value.lower() not in ("true", "false", "1", "0"):
+            raise ValueError(f"{column.name}: invalid bool {value!r}")
+        return value.lower() in ("true", "1")
+    if python_type in (date, datetime):
+        try:
+            return python_type.fromisoformat(value)
+        except ValueError as exc:
+            raise ValueError(f"{column.name}: invalid {python_type.__name__} {value!r}") from exc
+    try:
+        return python_type(value)
+    except ValueError as exc:
+        raise ValueError(f"{column.name}: invalid {python_type.__name__} {value!r}") from exc
+
+
+def filter_conditions(Obj, params):
+    """
+    Compile ``field[__operator]=value`` query parameters into SQL conditions on Obj.
+    Operators: gt, gte, lt, lte, in (comma separated values) and startswith,
+    equality without one. Only indexed_columns can be filtered on.
+    :param params: iterable of (name, value)
+    :raises ValueError: on an unknown or not indexed field, unknown operator or invalid value
+    """
+    columns = Obj.__table__.columns
+    conditions = []
+    for name, value in params:
+        field, _, operator = name.partition("__")
+        if field not in columns:
+            raise ValueError(f"Unknown field {field}")
+        if field not in indexed_columns(Obj):
+            raise ValueError(f"Can't filter on {field}, it is not indexed")
+        if operator and operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unknown operator {operator}, use one of {', '.join(FILTER_OPERATORS)}")
+
+        column = getattr(Obj, field)
+        if operator == "in":
+            conditions.append(column.in_([parse_value(column, item) for item in value.split(",")]))
+        elif operator == "startswith":
+            if column.type.python_type is not str:
+                raise ValueError(f"{field}: startswith only applies to strings")
+            if value:
+                # as a range, LIKE can't use the index
+                upper = value[:-1] + chr(ord(value[-1]) + 1)
+                conditions.append(and_(column >= value, column < upper))
+        else:
+            value = parse_value(column, value)
+            conditions.append({
+                "": column == value,
+                "gt": column > value,
+                "gte": column >= value,
+                "lt": column < value,
+                "lte": column <= value,
+            }[operator])
+    return conditions
+
+
+@lru_cache(maxsize=None)
+def unique_columns(Obj):
+    """Names of the columns of Obj that identify a row by themselves"""
+    table = Obj.__table__
+    names = {column.name for column in table.columns if column.unique}
+    if len(table.primary_key.columns) == 1:
+        names.update(column.name for column in table.primary_key.columns)
+    for index in table.indexes:
+        if index.unique and len(index.expressions) == 1 and index.dialect_options["sqlite"]["where"] is None:
+            names.add(index.expressions[0].name)
+    return frozenset(names)
+
+
+def sort_keys(Obj, sort, unique=("id",)):
+    """
+    Keyset keys of a ``sort`` parameter, e.g. "-fecha,-id_sucursal". The ``unique``
+    columns are appended as a tiebreaker, in the direction of the last key, so
+    the keys identify every row.
+    The indexes are ascending, SQLite walks them either way but can't mix
+    directions: it would sort every row after the cursor in a temporary B-tree.
+    A change of direction is only accepted after a unique key, which decides alone.
+    :raises ValueError: on an unknown, not indexed or nullable field, or mixed directions
+    """
+    keys = [key.strip() for key in sort.split(",") if key.strip()]
+    for key in keys:
+        field = key.lstrip("-")
+        if field not in Obj.__table__.columns:
+            raise ValueError(f"Unknown field {field}")
+        if field not in indexed_columns(Obj) or Obj.__table__.columns[field].nullable:
+            raise ValueError(f"Can't sort on {field}")
+
+    names = {key.lstrip("-") for key in keys}
+    direction = "-" if keys and keys[-1].startswith("-") else ""
+    keys = tuple(keys) + tuple(direction + key for key in unique if key not in names)
+
+    for index, key in enumerate(keys[1:], 1):
+        if key.startswith("-") != keys[0].startswith("-"):
+            if not unique_columns(Obj) & {key.lstrip("-") for key in keys[:index]}:
+                raise ValueError("Can't mix ascending and descending order, sort every field the same way")
+            break
+    return keys
+
+
+@lru_cache(maxsize=None)
+def index_orders(Obj):
+    """
+    Column orders SQLite can walk Obj in without sorting: the primary key and every
+    index or unique column, followed by the rowid. Partial indexes don't count.
+    """
+    table = Obj.__table__
+    rowid = tuple(column.name for column in table.primary_key.columns)
+    orders = [rowid]
+    orders.extend((column.name, *rowid) for column in table.columns if column.unique)
+    for index in table.indexes:
+        if index.dialect_options["sqlite"]["where"] is None:
+            orders.append((*(expression.name for expression in index.expressions), *rowid))
+    return tuple(orders)
+
+
+def filter_keys(Obj, params, keys, rekey=False):
+    """
+    Check that a listing filtered by ``params`` (see filter_conditions) and paginated on
+    ``keys`` walks a single index: the equality filters fix its first columns, the keys
+    follow, ``in`` lists may only be on the first of them and a range only bounds the
+    one after the lists. Otherwise every page scans the whole index or sorts all the
+    matching rows in a temporary B-tree.
+    Filters on a unique column match a few rows and go with any keys.
+    :param rekey: when keys don't fit, return the ones of an index that does instead of failing
+    :return: the keys to paginate on
+    :raises ValueError: when no index serves the filters in the order of keys
+    """
+    equal, lists, ranges = set(), set(), set()
+    for name, value in params:
+        field, _, operator = name.partition("__")
+        if operator == "in":
+            # SQLite turns a single value into an equality
+            (lists if "," in value else equal).add(field)
+        else:
+            (ranges if operator else equal).add(field)
+    if (equal | lists) & unique_columns(Obj):
+        return keys
+
+    def walks(order):
+        """:return: the columns order walks in for the filters, None if it can't be used"""
+        head, tail = order[:len(equal)], order[len(equal):]
+        # lists are searched value by value in the order of the index, then one range
+        if set(head) != equal or set(tail[:len(lists)]) != lists or not ranges <= set(tail[len(lists):][:1]):
+            return None
+        return tail
+
+    names = tuple(key.lstrip("-") for key in keys if key.lstrip("-") not in equal)
+    for order in index_orders(Obj):
+        tail = walks(order)
+        if tail is not None and names == tail[:len(names)]:
+            return keys
+
+    if rekey:
+        for order in index_orders(Obj):
+            tail = walks(order)
+            if tail is not None:
+                return tail
+    raise ValueError(
+        f"Can't filter on {', '.join(sorted(equal | lists | ranges))} sorted by {', '.join(keys)} with an index,"
+        " filter a range of the first sort field only"
+    )
+
+
+def validate_row(Obj, row):
+    """
+    Check a plain dict against the columns of Obj, coercing ISO formatted dates.
+    :return: (cleaned row, list of errors)
+    """
+    columns = Obj.__table__.columns
+    if not isinstance(row, dict):
+        return None, ["expected an object"]
+
+    errors = [f"{key}: unknown field" for key in row if key not in columns]
+    cleaned = {}
+    for column in columns:
+        value = row.get(column.name)
+        if value is None:
+            required = not (
+                column.nullable
+                or column.primary_key
+                or column.default is not None
+                or column.server_default is not None
+            )
+            if required:
+                errors.append(f"{column.name}: field is required")
+            continue
+
+        python_type = column.type.python_type
+        try:
+            if python_type is date and isinstance(value, str):
+                value = date.fromisoformat(value)
+            elif python_type is datetime and isinstance(value, str):
+                value = datetime.fromisoformat(value)
+            elif python_type is float and isinstance(value, int):
+                value = float(value)
+        except ValueError:
+            errors.append(f"{column.name}: invalid {python_type.__name__} {value!r}")
+            continue
+
+        if not isinstance(value, python_type) or (
+            isinstance(value, bool) and python_type is not bool
+        ):
+            errors.append(f"{column.name}: expected {python_type.__name__}, got {value!r}")
+            continue
+
+        cleaned[column.name] = value
+
+    return cleaned, errors
+
+
+MONTH_DAYS = 365.2425 / 12  # mean length of a gregorian month
+
+
+def consumption_stmt(sucursales, start_date, end_date):
+    """
+    Per branch consumption between the first and the last reading inside [start_date, end_date],
+    and the dates of those readings. One aggregate over the (id_sucursal, fecha) index.
+    :return: select of (id_sucursal, consumo, primera, ultima)
+    """
+    bounds = (
+        select(
+            Registro.id_sucursal,
+            func.min(Registro.fecha).label("primera"),
+            func.max(Registro.fecha).label("ultima"),
+        )
+        .where(
+            Registro.id_sucursal.in_(sucursales),
+            Registro.fecha >= start_date,
+            Registro.fecha <= end_date,
+        )
+        .group_by(Registro.id_sucursal)
+        .subquery()
+    )
+    first = aliased(Registro, name="primera")
+    last = aliased(Registro, name="ultima")
+
+    return (
+        select(bounds.c.id_sucursal, last.lectura - first.lectura, bounds.c.primera, bounds.c.ultima)
+        .join(first, (first.id_sucursal == bounds.c.id_sucursal) & (first.fecha == bounds.c.primera))
+        .join(last, (last.id_sucursal == bounds.c.id_sucursal) & (last.fecha == bounds.c.ultima))
+    )
+
+
+def over_consumption_stmt(anio, mes):
+    """
+    Branches whose consumption during the month exceeded their limit, read from the monthly rollup.
+    :return: select of (id_sucursal, nombre, limite, consumo, exceso)
+    """
+    return (
+        select(
+            Sucursal.id.label("id_sucursal"),
+            Sucursal.nombre,
+            Sucursal.limite,
+            ConsumoMensual.consumo,
+            (ConsumoMensual.consumo - Sucursal.limite).label("exceso"),
+        )
+        .join(Sucursal, Sucursal.id == ConsumoMensual.id_sucursal)
+        .where(
+            ConsumoMensual.anio == anio,
+            ConsumoMensual.mes == mes,
+            ConsumoMensual.consumo > Sucursal.limite,
+        )
+        .order_by(Sucursal.id)
+    )
 
 
 def loggedmethod(method):
     """
-    Log a CRUD method and confirm its successful execution
-    version: 1.0.1
+    Log a CRUD method and confirm its successful execution.
+    The signature is inspected once, here. Arguments are only formatted for the calls
+    that are actually logged: the logger must be enabled for INFO and, under
+    LOG_SAMPLE_RATE = N, only 1 in N calls is logged.
+    version: 1.1.0
     """
+    mname = method.__name__.lstrip("_")  # ignore encapsulation
+    method_type = mname.split("_")[0].upper()
+    arg_names = inspect.getfullargspec(method).args[1:]  # without self
+    calls = itertools.count()
 
     @wraps(method)
     def wrapper(self, *args, **kwargs):
-        method_data = inspect.getfullargspec(method)
-        mname = method.__name__.lstrip("_")  # ignore encapsulation
-        method_type = mname.split("_")[0].upper()
-        # + 1 because of self
-        try:
-            self.logger.info(
+        if len(args) > len(arg_names):
+            raise IndexError(
+                f"Too many arguments for {mname}. Maybe you used positional arguments intead of key-value arguments?"
+            )
+
+        logger = self.logger
+        traced = logger.isEnabledFor(logging.INFO) and (
+            settings.LOG_SAMPLE_RATE <= 1 or next(calls) % settings.LOG_SAMPLE_RATE == 0
+        )
+        if traced:
+            logger.info(
                 "_%s_ %s %s",
                 method_type,
-                [
-                    f"{method_data.args[index + 1]}={value}"
-                    for index, value in enumerate(args)
-                ],
+                [f"{name}={value}" for name, value in zip(arg_names, args)],
                 kwargs,
             )
-        except IndexError as exc:
-            raise IndexError(
-                f"Too many arguments for {mname}. Maybe you used positional arguments intead of key-value arguments?"
-            )
 
         res = method(self, *args, **kwargs)
 
-        self.logger.debug("_%s_ --success--", method_type)
+        if traced:
+            logger.debug("_%s_ --success--", method_type)
         return res
 
     return wrapper
 
 
 @logged
+@benchmarked
 class Client:
     def __init__(self, url=URL, config=None):
         config = config or {}
@@ -96,9 +610,8 @@ class Client:
         assert db_file.exists(), f"DB file doesn't exist! {db_file}"
         assert db_file.stat().st_size > 0, "DB file is just an empty file!"
 
-        self.engine = create_engine(url)
-
-        self.engine = create_engine(url)
+        self.engine = get_engine(url)
+        event.listen(self.engine, "before_cursor_execute", metrics.count_statement)
 
         self.session = scoped_session(sessionmaker(bind=self.engine, **config))  # pylint: --disable=C0103
 
@@ -127,6 +640,53 @@ class Client:
         self.session.commit()
         return obj
 
+    def _bulk_create(self, Obj, /, rows):
+        """
+        Low level bulk insert implementation.
+        Valid rows are inserted with a single executemany in one transaction,
+        invalid ones are reported and skipped without aborting the batch.
+        :return: {"created": count, "errors": [{"index": row index, "errors": [...]}, ...]}
+        """
+        self.logger.info("_BULK_ %s %s rows", Obj.__name__, len(rows))
+
+        valid = []
+        errors = []
+        for index, row in enumerate(rows):
+            cleaned, row_errors = validate_row(Obj, row)
+            if row_errors:
+                errors.append({"index": index, "errors": row_errors})
+            else:
+                valid.append((index, cleaned))
+
+        created = 0
+        if valid:
+            try:
+                with self.session.begin_nested():
+                    self.session.execute(insert(Obj), [row for _, row in valid])
+                created = len(valid)
+            except IntegrityError:
+                # some row violates a constraint, find out which ones one at a time
+                for index, row in valid:
+                    try:
+                        with self.session.begin_nested():
+                            self.session.execute(insert(Obj), [row])
+                        created += 1
+                    except IntegrityError as exc:
+                        errors.append({"index": index, "errors": [str(exc.orig)]})
+                errors.sort(key=lambda error: error["index"])
+
+            if Obj is Registro:
+                registro_changed(self.session.connection(), [row for _, row in valid])
+
+        self.session.commit()
+
+        # Core inserts don't go through the flush events
+        if created and Obj in (Registro, Sucursal):
+            key = "id_sucursal" if Obj is Registro else "id"
+            invalidate_reports({row[key] for _, row in valid if row.get(key) is not None})
+
+        return {"created": created, "errors": errors}
+
     @loggedmethod
     def update(self, obj, /, **kwargs):
         """Update implementation. Feel free to use this directly"""
@@ -145,6 +705,47 @@ class Client:
 
         return obj
 
+    def _paginate(self, query, /, keys=("id",), after=None, limit=settings.PAGE_SIZE):
+        """
+        Keyset pagination over ``keys``, which must be unique together and,
+        ideally, covered by an index so every page is a range scan no matter how deep it is.
+        :return: (rows, cursor of the next page or None if this is the last one)
+        """
+        Obj = query.column_descriptions[0]["entity"]
+        rows = keyset(query, Obj, keys, after, limit).all()
+        return keyset_page(rows, keys, limit)
+
+    def _project(self, query, /, fields):
+        """
+        Restrict a query to some columns of its model. Rows are then returned as
+        Row tuples instead of instances, only those columns are read and nothing goes
+        through the identity map.
+        :raises ValueError: on an unknown field
+        """
+        Obj = query.column_descriptions[0]["entity"]
+        columns = Obj.__table__.columns
+        unknown = [field for field in fields if field not in columns]
+        if unknown:
+            raise ValueError(f"Unknown fields {', '.join(unknown)}")
+
+        return query.with_entities(*(getattr(Obj, field) for field in fields))
+
+    def _filter(self, query, /, params):
+        """
+        Apply ``field[__operator]=value`` filters to a query, see filter_conditions.
+        :raises ValueError: on an invalid filter
+        """
+        Obj = query.column_descriptions[0]["entity"]
+        return query.filter(*filter_conditions(Obj, params))
+
+    def _stream(self, query, /, chunk_size=settings.STREAM_CHUNK_SIZE, keys=("id",)):
+        """
+        Iterate a query fetching ``chunk_size`` rows at a time from a server side cursor,
+        so memory doesn't grow with the size of the result.
+        """
+        Obj = query.column_descriptions[0]["entity"]
+        return query.order_by(*order_by(Obj, keys)).yield_per(chunk_size)
+
     def _get_or_create(self, Obj, /, **kwargs):
         """Low level select or insert  implementation"""
         obj = self._get(Obj, **kwargs).all()
@@ -163,6 +764,9 @@ class Client:
     def create_registro(self, /, **kwargs):
         return self._create(Registro, **kwargs)
 
+    def bulk_create_registro(self, rows):
+        return self._bulk_create(Registro, rows)
+
     def get_registro(self, /, **kwargs):
         return self._get(Registro, **kwargs)
 
@@ -178,6 +782,14 @@ class Client:
     def get_area(self,/,**kwargs):
         return self._get(Area,**kwargs)
 
+    def get_alerta(self, /, **kwargs):
+        return self._get(Alerta, **kwargs)
+
+    def acknowledge_alerta(self, alerta):
+        self.update(alerta, reconocida=True)
+        self.session.commit()
+        return alerta
+
     def get_user(self, /, **kwargs):
         return self._get(User, **kwargs)
 
@@ -213,6 +825,13 @@ class Client:
     def user_from_token(self, token):
         return self._get(Token, value=token).one().user
 
+    def auth_context(self, token):
+        """
+        Resolve a token to its AuthContext with a single query, cached for AUTH_CACHE_TTL seconds.
+        :raises NoResultFound: for an unknown token
+        """
+        return resolve_auth(token, lambda: AuthContext(*self.session.execute(auth_stmt(token)).one()))
+
     def liquidate_bill(self, company, date=None):
         """
         Given a company, liquidate its bill.
@@ -232,27 +851,107 @@ class Client:
         )
     
     # high-level
-    def total_consumption(self, company, start_date, end_date):
-        # select * between start_date and end_date
-        start = self._get(Bill, date=start_date, company_id=company.id).one()
-        end = self._get(Bill, date=end_date, company_id=company.id).one()
+    @staticmethod
+    def _sucursal_ids(sucursales):
+        """Accept a Sucursal, an id or a list of either"""
+        many = isinstance(sucursales, (list, tuple, set))
+        ids = [
+            sucursal.id if isinstance(sucursal, Sucursal) else sucursal
+            for sucursal in (sucursales if many else [sucursales])
+        ]
+        return ids, many
+
+    def _consumption(self, sucursales, start_date, end_date):
+        ids, many = self._sucursal_ids(sucursales)
+        rows = {
+            id_sucursal: (consumo, (ultima - primera).days / MONTH_DAYS)
+            for id_sucursal, consumo, primera, ultima in self.session.execute(
+                consumption_stmt(ids, start_date, end_date)
+            )
+        }
+        result = {id_sucursal: rows.get(id_sucursal, (None, None)) for id_sucursal in ids}
+        return result, many
 
-        return end.reading - start.reading
+    def total_consumption(self, sucursales, start_date, end_date):
+        """
+        Consumption between the first and the last reading inside [start_date, end_date].
+        :param sucursales: a Sucursal, an id or a list of either
+        :return: the consumption, or {id_sucursal: consumption} for a list. None when there are no readings.
+        """
+        result, many = self._consumption(sucursales, start_date, end_date)
+        result = {id_sucursal: consumo for id_sucursal, (consumo, _) in result.items()}
+
+        return result if many else next(iter(result.values()))
+
+    def average_consumption(self, sucursales, start_date, end_date):
+        """
+        Monthly consumption, the total consumption over the months between the first and
+        the last reading inside [start_date, end_date], so gaps without readings count too.
+        :param sucursales: a Sucursal, an id or a list of either
+        :return: the average, or {id_sucursal: average} for a list. None with less than two readings.
+        """
+        result, many = self._consumption(sucursales, start_date, end_date)
+        result = {
+            id_sucursal: consumo / months if months else None
+            for id_sucursal, (consumo, months) in result.items()
+        }
+
+        return result if many else next(iter(result.values()))
+
+    def over_consumption(self, anio, mes):
+        """
+        Branches that exceeded their limit during a month, and by how much.
+        :return: [{"id_sucursal": ..., "nombre": ..., "limite": ..., "consumo": ..., "exceso": ...}, ...]
+        """
+        return [
+            dict(row._mapping) for row in self.session.execute(over_consumption_stmt(anio, mes))
+        ]
 
-    def average_consumption(self, company, start_date, end_date):
+    def yearly_consumption(self, sucursales, start_year, end_year):
         """
-        Monthly consumption.
+        Average monthly consumption, total cost and total over limit per year, read from the monthly rollup.
+        :param sucursales: list of Sucursal ids
+        :return: {id_sucursal: {anio: {"consumo_promedio": ..., "costo": ..., "sobre_limite": ...}}}
         """
-        months = (end_date - start_date).days // 30
-        return self.total_consumption(company, start_date, end_date)/months
+        query = (
+            self.session.query(
+                ConsumoMensual.id_sucursal,
+                ConsumoMensual.anio,
+                func.avg(ConsumoMensual.consumo),
+                func.sum(ConsumoMensual.costo),
+                func.sum(ConsumoMensual.sobre_limite),
+            )
+            .filter(
+                ConsumoMensual.id_sucursal.in_(sucursales),
+                ConsumoMensual.anio >= start_year,
+                ConsumoMensual.anio <= end_year,
+            )
+            .group_by(ConsumoMensual.id_sucursal, ConsumoMensual.anio)
+        )
+
+        result = {id_sucursal: {} for id_sucursal in sucursales}
+        for id_sucursal, anio, consumo, costo, sobre_limite in query:
+            result[id_sucursal][anio] = {
+                "consumo_promedio": consumo,
+                "costo": costo,
+                "sobre_limite": sobre_limite,
+            }
+        return result
 
-    def over_consumption(self, start_date, end_date):
-        # select company, over_limit where over_limit > 0
-        return self._get(Bill).filter(Bill.over_limit > 0).all()
+    def predict_consumption(self, sucursales=None, today=None):
+        """
+        Consumption forecast for the next quarter, from the trend of the last five years.
+        :param sucursales: a Sucursal, an id or a list of either. Every branch when None.
+        :return: the forecast, or {id_sucursal: forecast} for a list or None. None when there are no readings.
+        """
+        if sucursales is None:
+            return forecast.predict(self.session, today=today)
+
+        ids, many = self._sucursal_ids(sucursales)
+        result = forecast.predict(self.session, ids, today=today)
+        result = {id_sucursal: result.get(id_sucursal) for id_sucursal in ids}
 
-    def predict_consumption(self, company, start_date, end_date):
-        # :^)
-        return self.average_consumption(company, start_date, end_date)
+        return result if many else result[ids[0]]
 
     def compare_consumption(self, start_date, end_date):
         """
@@ -260,6 +959,10 @@ class Client:
         """
         return self._get(Bill).filter(Bill.date >= start_date).filter(Bill.date <= end_date).all()
 
-    def list_alerts(self, company):
-        # select * where over_limit>1 and company_id = company.id
-        return self._get(Bill, company_id=company.id).filter(Bill.over_limit > 0).all()
+    def list_alerts(self, sucursal):
+        """
+        Alerts of a branch, oldest first.
+        :param sucursal: a Sucursal or its id
+        """
+        ids, _ = self._sucursal_ids(sucursal)
+        return self._get(Alerta, id_sucursal=ids[0]).order_by(Alerta.fecha).all()
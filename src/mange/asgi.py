@@ -0,0 +1,340 @@
+"""
+Read only ASGI application.
+
+Serves the GET routes of the REST API (listings, details and reports) from an
+async engine, so a worker waiting on SQLite doesn't hold a thread. Rows are
+read with Core selects, there is no ORM session nor identity map. Writes stay
+on the WSGI app (mange.server), route the non GET requests to it. Listings and
+details send the same ETag and Last-Modified validators and answer
+If-None-Match with 304, ?stream=1 is a chunked JSON array (see
+mange.responses). Reports are not cached here. Run it with any ASGI server,
+for example
+
+    uvicorn mange.asgi:app --workers 4
+"""
+from collections import namedtuple
+from datetime import date
+import logging
+from urllib.parse import parse_qs
+
+from sqlalchemy import select
+from sqlalchemy.exc import NoResultFound
+
+from mange import forecast
+from mange.api import (
+    AUTH,
+    AuthContext,
+    auth_cache,
+    auth_stmt,
+    filter_conditions,
+    filter_keys,
+    keyset,
+    keyset_page,
+    order_by,
+    over_consumption_stmt,
+    sort_keys,
+)
+from mange.conf import ImproperlyConfigured, settings
+from mange.db import Alerta, Area, Equipo, Registro, Sucursal, set_pragmas
+from mange.responses import VALIDATOR_FIELDS, array_items, etag, not_modified, parse_fields, validators
+from mange.serializers import dumps, projection
+
+log = logging.getLogger("global")
+
+# name in the url -> (model, keyset used to paginate its listing), as in mange.server
+MODELS = {
+    "sucursal": (Sucursal, ("id",)),
+    "registro": (Registro, ("id_sucursal", "fecha")),
+    "equipo": (Equipo, ("id",)),
+    "area": (Area, ("id",)),
+    "alerta": (Alerta, ("id_sucursal", "fecha")),
+}
+
+REPORTS = ("forecast", "over-limit")
+
+# query parameters of the listings that are not filters
+RESERVED_ARGS = ("limit", "after", "stream", "fields", "sort")
+
+
+# what a route answers besides plain data: a status and headers, or for a
+# stream the partitions of rows sent as they are read
+Response = namedtuple("Response", ("body", "code", "headers", "partitions"), defaults=(200, (), None))
+
+
+class HTTPError(Exception):
+    def __init__(self, description, code=400):
+        super().__init__(description)
+        self.description = description
+        self.code = code
+
+
+def async_url(url):
+    """sqlite:///path -> sqlite+aiosqlite:///path"""
+    dialect, rest = url.split(":", 1)
+    if "+" in dialect:
+        dialect = dialect.split("+", 1)[0]
+    if dialect != "sqlite":
+        raise ImproperlyConfigured(f"The ASGI app only supports sqlite, got {url!r}")
+    return f"sqlite+aiosqlite:{rest}"
+
+
+def get_auth_token(headers):
+    token = headers.get(b"authorization", b"").decode("latin-1")
+    for scheme in ("Bearer ", "Token "):
+        if token.startswith(scheme):
+            return token[len(scheme):]
+    return token or None
+
+
+def _int(args, name):
+    value = args.get(name, [""])[-1]
+    if not value.isdigit():
+        raise HTTPError(f"The {name} field must be an integer")
+    return int(value)
+
+
+def _fields(args):
+    return parse_fields(",".join(args.get("fields", [])))
+
+
+def _columns(Obj, fields, *needed):
+    """
+    :param fields: see mange.responses.parse_fields
+    :return: (columns to select for fields plus the needed ones, serializer of the rows)
+    """
+    if fields is None:
+        return list(Obj.__table__.columns), lambda row: dict(row._mapping)
+
+    columns = Obj.__table__.columns
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        raise HTTPError(f"Unknown fields {', '.join(unknown)}")
+    return [columns[name] for name in dict.fromkeys((*fields, *needed))], projection(fields)
+
+
+class ReadOnlyApp:
+    """
+    ASGI callable. The engine is created on first use, in the process (and event loop)
+    that serves the requests.
+    """
+
+    def __init__(self, url=None, pragmas=None):
+        self.url = url or settings.DATABASES["default"]["engine"]
+        self.pragmas = pragmas
+        self.engine = None
+
+    def get_engine(self):
+        if self.engine is None:
+            try:
+                from sqlalchemy.ext.asyncio import create_async_engine
+                import aiosqlite  # noqa: F401 pylint: disable=unused-import,import-outside-toplevel
+                import greenlet  # noqa: F401 pylint: disable=unused-import,import-outside-toplevel
+            except ImportError as exc:
+                raise ImproperlyConfigured("The ASGI app requires sqlalchemy[asyncio] and aiosqlite") from exc
+
+            engine = create_async_engine(async_url(self.url))
+            set_pragmas(engine.sync_engine, self.pragmas)
+            self.engine = engine
+        return self.engine
+
+    async def close(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+            self.engine = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        head = scope["method"] == "HEAD"
+        try:
+            if scope["method"] not in ("GET", "HEAD"):
+                raise HTTPError("This server is read only", 405)
+            args = parse_qs(scope["query_string"].decode("latin-1"))
+            headers = dict(scope["headers"])
+            async with self.get_engine().connect() as conn:
+                await self.authenticate(conn, headers)
+                response = await self.dispatch(conn, scope["path"], args, headers)
+                if isinstance(response, Response) and response.partitions is not None:
+                    # the rows are read from the connection while they are sent
+                    await self.stream(send, response.partitions, head)
+                    return
+            if not isinstance(response, Response):
+                response = Response(response)
+        except HTTPError as exc:
+            response = Response({"status_code": exc.code, "errors": exc.description}, exc.code)
+        except NoResultFound:
+            response = Response({"status_code": 404, "errors": "Resource not found"}, 404)
+
+        payload = b"" if response.code == 304 else dumps(response.body).encode("utf8")
+        await send({
+            "type": "http.response.start",
+            "status": response.code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(payload)).encode("ascii")),
+                *((name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in response.headers),
+            ],
+        })
+        await send({
+            "type": "http.response.body",
+            "body": b"" if head else payload,
+        })
+
+    @staticmethod
+    async def stream(send, partitions, head=False):
+        """Send a chunked JSON array of the rows of the async iterable of partitions"""
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        })
+        if head:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await send({"type": "http.response.body", "body": b"[", "more_body": True})
+        first = True
+        async for partition in partitions:
+            body = array_items(partition, first).encode("utf8")
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+            first = False
+        await send({"type": "http.response.body", "body": b"]"})
+
+    @staticmethod
+    def conditional(data, tag, last_modified, headers):
+        """Same as mange.server.conditional"""
+        if_none_match = headers.get(b"if-none-match", b"").decode("latin-1")
+        code = 304 if not_modified(if_none_match, tag) else 200
+        return Response(data, code, validators(tag, last_modified))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def authenticate(self, conn, headers):
+        """Same rules as mange.server.authenticate, sharing its cache"""
+        token = get_auth_token(headers)
+        if not token:
+            return None
+
+        context = auth_cache.get(token)
+        if context is None:
+            # see mange.api.resolve_auth
+            generation = auth_cache.generation
+            row = (await conn.execute(auth_stmt(token))).first()
+            if row is None:
+                raise HTTPError("Invalid token", 401)
+            context = AuthContext(*row)
+            auth_cache.set(token, context, (AUTH,), generation)
+        return context
+
+    async def dispatch(self, conn, path, args, headers):
+        parts = [part for part in path.split("/") if part]
+        if not parts or parts[0] != "api" or len(parts) > 3:
+            raise HTTPError("Resource not found", 404)
+        parts = parts[1:]
+
+        if parts and parts[0] == "report":
+            if len(parts) == 1:
+                return list(REPORTS)
+            if parts[1] == "over-limit":
+                return await self.over_limit(conn, args)
+            if parts[1] == "forecast":
+                return await self.forecast(conn, args)
+            raise HTTPError("Resource not found", 404)
+
+        if not parts or parts[0] not in MODELS:
+            raise HTTPError("Resource not found", 404)
+        if len(parts) == 1:
+            return await self.index(conn, parts[0], args, headers)
+        if not parts[1].isdigit():
+            raise HTTPError("The ID field must be an integer")
+        return await self.get(conn, parts[0], int(parts[1]), args, headers)
+
+    async def index(self, conn, name, args, headers):
+        """Keyset paginated listing, or ?stream=1, same parameters, cursors and validators as the WSGI one"""
+        Obj, keys = MODELS[name]
+
+        reserved = RESERVED_ARGS + (("sucursal",) if Obj is Alerta else ())
+        params = [(name, value) for name, values in args.items() if name not in reserved for value in values]
+        if Obj is Alerta and "sucursal" in args:
+            params.append(("id_sucursal", str(_int(args, "sucursal"))))
+        try:
+            conditions = filter_conditions(Obj, params)
+            if args.get("sort"):
+                keys = filter_keys(Obj, params, sort_keys(Obj, args["sort"][-1]))
+            else:
+                keys = filter_keys(Obj, params, keys, rekey=True)
+        except ValueError as exc:
+            raise HTTPError(str(exc)) from exc
+
+        fields = _fields(args)
+        columns, serialize = _columns(Obj, fields, *VALIDATOR_FIELDS, *(key.lstrip("-") for key in keys))
+        stmt = select(*columns).where(*conditions)
+
+        if args.get("stream", [""])[-1] in ("1", "true"):
+            result = await conn.stream(stmt.order_by(*order_by(Obj, keys)))
+
+            async def partitions():
+                async for partition in result.partitions(settings.STREAM_CHUNK_SIZE):
+                    yield [serialize(row) for row in partition]
+
+            return Response(None, partitions=partitions())
+
+        limit = args.get("limit", [str(settings.PAGE_SIZE)])[-1]
+        if not limit.isdigit() or not 0 < int(limit) <= settings.MAX_PAGE_SIZE:
+            raise HTTPError(f"The limit field must be an integer between 1 and {settings.MAX_PAGE_SIZE}")
+
+        after = args.get("after", [None])[-1]
+        try:
+            stmt = keyset(stmt, Obj, keys, after, int(limit))
+        except ValueError as exc:
+            raise HTTPError(str(exc)) from exc
+
+        rows, cursor = keyset_page((await conn.execute(stmt)).all(), keys, int(limit))
+        tag = etag(rows, cursor, fields)
+        last_modified = max((row.updated_at for row in rows), default=None)
+        return self.conditional(
+            {"results": [serialize(row) for row in rows], "next": cursor}, tag, last_modified, headers
+        )
+
+    async def get(self, conn, name, id, args, headers):
+        Obj, _ = MODELS[name]
+        fields = _fields(args)
+        columns, serialize = _columns(Obj, fields, *VALIDATOR_FIELDS)
+        row = (await conn.execute(select(*columns).where(Obj.id == id))).one()
+        return self.conditional(serialize(row), etag([row], fields), row.updated_at, headers)
+
+    async def over_limit(self, conn, args):
+        if not ("anio" in args and "mes" in args):
+            raise HTTPError("The fields ('anio', 'mes') are required")
+        anio, mes = _int(args, "anio"), _int(args, "mes")
+        if not 1 <= mes <= 12:
+            raise HTTPError("The fields ('anio', 'mes') are required")
+        result = await conn.execute(over_consumption_stmt(anio, mes))
+        return [dict(row._mapping) for row in result]
+
+    async def forecast(self, conn, args):
+        ids = args.get("sucursal", [])
+        if not all(id.isdigit() for id in ids):
+            raise HTTPError("The sucursal field must be an integer")
+        ids = [int(id) for id in ids] or None
+
+        today = date.today()
+        rows = (await conn.execute(forecast.series_stmt(ids, today))).all()
+        result = forecast.forecast(rows, today)
+        if ids is not None:
+            result = {id_sucursal: result.get(id_sucursal) for id_sucursal in ids}
+        return result
+
+
+app = ReadOnlyApp()
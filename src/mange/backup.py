@@ -0,0 +1,272 @@
+"""
+Online backups.
+
+The database is copied with the SQLite backup API a few pages per step, with a
+pause between steps, so the copy never holds the database for long. In WAL mode
+(the default, see SQLITE_PRAGMAS) a read transaction pins a snapshot for the whole
+copy: it is consistent, writers keep going and it is not restarted by them.
+Snapshots are timestamped files in a directory, only the newest ones are kept.
+A lock file in the directory lets a single backup run at a time across
+processes, the progress of the running one is kept next to it.
+"""
+import argparse
+from datetime import datetime
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from sqlalchemy.engine import make_url
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from mange.conf import settings
+
+log = logging.getLogger("global")
+
+SUFFIX = ".sqlite3"
+# microseconds, two snapshots never get the same name
+TIMESTAMP = "%Y%m%d-%H%M%S-%f"
+LOCK = ".backup.lock"
+STATUS = ".backup.json"
+
+
+def database_path(url):
+    return pathlib.Path(make_url(url).database)
+
+
+def backup(url, destination, pages=settings.BACKUP_PAGES, sleep=settings.BACKUP_SLEEP, progress=None):
+    """
+    Copy the database at url into the file destination, which only appears once complete.
+    :param pages: pages copied per step
+    :param sleep: seconds to pause between steps
+    :param progress: called with (remaining pages, total pages) after every step
+    """
+    destination = pathlib.Path(destination)
+    partial = destination.with_name(destination.name + ".partial")
+
+    source = sqlite3.connect(database_path(url), isolation_level=None)
+    try:
+        if source.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+            # pin the snapshot the copy is taken from
+            source.execute("BEGIN")
+            source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+        def step(status, remaining, total):
+            if progress is not None:
+                progress(remaining, total)
+            if remaining:
+                time.sleep(sleep)
+
+        target = sqlite3.connect(partial)
+        try:
+            source.backup(target, pages=pages, progress=step)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+    os.replace(partial, destination)
+    return destination
+
+
+def snapshots(directory, url=None):
+    """:return: snapshots in directory, oldest first"""
+    stem = database_path(url or settings.DATABASES["default"]["engine"]).stem
+    return sorted(pathlib.Path(directory).glob(f"{stem}-*{SUFFIX}"))
+
+
+def rotate(directory, keep, url=None):
+    """Delete all but the ``keep`` newest snapshots in directory"""
+    old = snapshots(directory, url)[:-keep] if keep > 0 else []
+    for path in old:
+        path.unlink()
+        log.info("removed old backup %s", path)
+    return old
+
+
+def snapshot(url=None, directory=settings.BACKUP_DIR, keep=settings.BACKUP_KEEP, **kwargs):
+    """
+    Take a timestamped backup of the database in directory and rotate the old ones.
+    :param kwargs: pages, sleep and progress, see backup
+    :return: path of the new snapshot
+    :raises BackupRunning: when another backup of directory is running
+    """
+    with BackupLock(directory):
+        return _snapshot(url, directory, keep, **kwargs)
+
+
+def _snapshot(url, directory, keep, **kwargs):
+    url = url or settings.DATABASES["default"]["engine"]
+    directory = pathlib.Path(directory)
+
+    name = f"{database_path(url).stem}-{datetime.now().strftime(TIMESTAMP)}{SUFFIX}"
+    if (directory / name).exists():
+        raise FileExistsError(f"Backup {directory / name} already exists")
+    start = time.perf_counter()
+    path = backup(url, directory / name, **kwargs)
+    log.info("backup %s written in %.1fs", path, time.perf_counter() - start)
+
+    rotate(directory, keep, url)
+    return path
+
+
+class BackupRunning(Exception):
+    pass
+
+
+class BackupLock:
+    """
+    Lock file of a backup directory, held while a snapshot is taken there so
+    only one runs at a time, whichever process (worker, mange backup) takes it.
+    """
+
+    def __init__(self, directory):
+        self.path = pathlib.Path(directory) / LOCK
+        self._fd = None
+
+    def acquire(self):
+        """:raises BackupRunning: when the lock is held"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if fcntl is None:
+            try:
+                self._fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                raise BackupRunning("A backup is already running") from None
+            return self
+
+        fd = os.open(self.path, os.O_CREAT | os.O_WRONLY)
+        try:
+            # released by the system if the process dies
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise BackupRunning("A backup is already running") from None
+        self._fd = fd
+        return self
+
+    def release(self):
+        if self._fd is None:
+            return
+        if fcntl is None:
+            self.path.unlink(missing_ok=True)
+        os.close(self._fd)
+        self._fd = None
+
+    def held(self):
+        """:return: whether a backup holds the lock"""
+        try:
+            self.acquire()
+        except BackupRunning:
+            return True
+        self.release()
+        return False
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class BackupJob:
+    """
+    Snapshots of a directory taken in a background thread. The lock and the
+    progress are files of the directory, every worker sees the same job.
+    """
+
+    def __init__(self, directory=settings.BACKUP_DIR):
+        self.directory = pathlib.Path(directory)
+        self.status_path = self.directory / STATUS
+
+    def start(self, url=None, **kwargs):
+        """
+        :param kwargs: see snapshot
+        :return: the thread taking the snapshot
+        :raises BackupRunning: when a snapshot of the directory is already running
+        """
+        lock = BackupLock(self.directory).acquire()
+        try:
+            self._write(running=True, remaining=None, total=None, error=None)
+            thread = threading.Thread(target=self._run, args=(lock, url), kwargs=kwargs, daemon=True)
+            thread.start()
+        except BaseException:
+            lock.release()
+            raise
+        return thread
+
+    def _write(self, **values):
+        status = {**self._read(), **values}
+        partial = self.status_path.with_suffix(".partial")
+        partial.write_text(json.dumps(status))
+        os.replace(partial, self.status_path)
+
+    def _read(self):
+        try:
+            return json.loads(self.status_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _progress(self, remaining, total):
+        self._write(remaining=remaining, total=total)
+
+    def _run(self, lock, url, **kwargs):
+        try:
+            path = _snapshot(url, self.directory, kwargs.pop("keep", settings.BACKUP_KEEP),
+                             progress=self._progress, **kwargs)
+            self._write(running=False, last=str(path))
+        except Exception as exc:  # pylint: disable=broad-except
+            log.exception("backup failed")
+            self._write(running=False, error=str(exc))
+        finally:
+            lock.release()
+
+    def status(self):
+        status = self._read()
+        total, remaining = status.get("total"), status.get("remaining")
+        done = None
+        if total:
+            done = round(100 * (total - remaining) / total, 1)
+        return {
+            # the lock, not the file, says whether a backup is running: its process may have died
+            "running": BackupLock(self.directory).held(),
+            "progress": done,
+            "last": status.get("last"),
+            "error": status.get("error"),
+        }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="mange backup")
+    parser.add_argument("--database", default=settings.DATABASES["default"]["engine"],
+                        help="database url, the default one of the settings by default")
+    parser.add_argument("--dir", default=settings.BACKUP_DIR, help="where snapshots are written")
+    parser.add_argument("--keep", type=int, default=settings.BACKUP_KEEP, help="snapshots kept")
+    parser.add_argument("--pages", type=int, default=settings.BACKUP_PAGES, help="pages copied per step")
+    parser.add_argument("--sleep", type=float, default=settings.BACKUP_SLEEP, help="seconds between steps")
+    parser.add_argument("--every", type=float, default=0,
+                        help="take a snapshot every this many seconds until interrupted, just one by default")
+    args = parser.parse_args(argv)
+
+    reported = [0]
+
+    def progress(remaining, total):
+        done = 100 * (total - remaining) // max(total, 1)
+        if done >= reported[0] + 10 or not remaining:
+            reported[0] = done
+            log.info("backup %s%% (%s of %s pages)", done, total - remaining, total)
+
+    while True:
+        reported[0] = 0
+        try:
+            snapshot(args.database, args.dir, args.keep, pages=args.pages, sleep=args.sleep, progress=progress)
+        except BackupRunning:
+            log.warning("a backup of %s is already running, skipped", args.dir)
+        if not args.every:
+            return
+        time.sleep(args.every)
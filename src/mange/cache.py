@@ -0,0 +1,88 @@
+"""
+In process caches
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Bounded mapping whose entries expire ``ttl`` seconds after being set.
+    The least recently used entry is evicted when full. Thread safe.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, (None, default))[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TaggedCache(TTLCache):
+    """
+    TTLCache whose entries are labelled with tags. invalidate drops every entry
+    carrying any of the given tags.
+    Values computed while an invalidation happens may already be stale, read
+    ``generation`` before computing them and pass it to set, they are discarded
+    if an invalidation happened in between.
+    """
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize, ttl)
+        self.generation = 0
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        return default if entry is None else entry[1]
+
+    def set(self, key, value, tags=(), generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + self.ttl, (frozenset(tags), value))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = super().pop(key)
+        return default if entry is None else entry[1]
+
+    def invalidate(self, tags):
+        tags = frozenset(tags)
+        with self._lock:
+            self.generation += 1
+            stale = [key for key, (_, (entry_tags, _)) in self._data.items() if entry_tags & tags]
+            for key in stale:
+                del self._data[key]
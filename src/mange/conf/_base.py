@@ -45,3 +45,58 @@ LOGGERS = {
     },
 }
 
+# SQLite settings applied to every new connection (DATABASES[...]["pragmas"]).
+# WAL lets readers proceed while a writer commits, NORMAL synchronous is safe under WAL
+# and only fsyncs on checkpoints.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,  # KiB, i.e. 64MB
+    "mmap_size": 268435456,  # 256MB
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,  # ms
+}
+
+# Pagination
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Rows fetched per round trip when streaming a collection
+STREAM_CHUNK_SIZE = 1000
+
+# Maximum rows accepted by a single bulk insert request
+BULK_MAX_ROWS = 10000
+
+# Resolved Authorization tokens kept in memory, and for how many seconds. A
+# revoked token or a group change is seen at once by the process that made it,
+# the other workers and the ASGI app may accept the old one for up to the TTL.
+AUTH_CACHE_SIZE = 1024
+AUTH_CACHE_TTL = 30
+
+# Encoded report responses kept in memory, and for how many seconds. Writes
+# invalidate them in the process that made them only: writes of the other
+# workers or processes are seen when the TTL expires, it bounds how stale a
+# report can be.
+REPORT_CACHE_SIZE = 256
+REPORT_CACHE_TTL = 60
+
+# Rows copied per statement when a migration rebuilds a table
+MIGRATION_BATCH_SIZE = 50000
+
+# Online backups: pages copied per step and seconds paused between steps, so
+# writers are never held for long. Snapshots go to BACKUP_DIR, the newest
+# BACKUP_KEEP are kept.
+BACKUP_DIR = BASE_DIR / "backups"
+BACKUP_KEEP = 7
+BACKUP_PAGES = 256
+BACKUP_SLEEP = 0.05
+
+# mange dump: rows per line of the dump and gzip level (1 is fastest, 9 smallest)
+DUMP_CHUNK_SIZE = 10000
+DUMP_COMPRESSLEVEL = 6
+
+# Serve /api/metrics without authentication, to scrapers that can't send a token
+METRICS_PUBLIC = False
+
+# Log only 1 in LOG_SAMPLE_RATE CRUD calls
+LOG_SAMPLE_RATE = 1
@@ -14,6 +14,7 @@ DEBUG = True
 DATABASES = {
     "default": {
         "engine": "sqlite:///" + str(TEST_DIR / "test_db.sqlite3"),
+        "pragmas": SQLITE_PRAGMAS,
     },
 }
 
@@ -7,6 +7,7 @@ DEBUG = False
 DATABASES = {
         "default": {
             "engine": f"sqlite:///{BASE_DIR}/db.sqlite",
-            "config": {"autocommit": True}
+            "config": {"autocommit": True},
+            "pragmas": SQLITE_PRAGMAS,
         }
 }
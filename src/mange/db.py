@@ -1,18 +1,15 @@
 """
 ORM layer for the DB
 """
-import os
+from datetime import date, datetime, timezone
 from enum import Enum
 import logging
-import shutil
 import random
 import re
-import pathlib
-from warnings import warn
 import pickle
 import base64
 
-from sqlalchemy import Column, create_engine, func
+from sqlalchemy import Column, create_engine, delete, event, func, inspect, literal, literal_column, select, tuple_
 from sqlalchemy import (
     Integer,
     Float,
@@ -23,20 +20,27 @@ from sqlalchemy import (
     DateTime,
     Date
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.sql import text
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import relationship, as_declarative, validates
-from sqlalchemy.schema import UniqueConstraint, CheckConstraint
+from sqlalchemy.orm import relationship, as_declarative, validates, Session
+from sqlalchemy.schema import UniqueConstraint, CheckConstraint, Index
 
 from mange.conf import settings
 from mange.log import logged
+from mange.serializers import serializer
 
 logger = logging.getLogger("user_info." + __name__)
 
 
+def utcnow():
+    """Naive UTC timestamp, the way DateTime columns are stored"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 @as_declarative()
 class Base:
-    """Automated table name, surrogate pk, and serializing"""
+    """Automated table name, surrogate pk, row versioning and serializing"""
 
     @declared_attr
     def __tablename__(cls):  # pylint: --disable=no-self-argument
@@ -52,9 +56,7 @@ class Base:
         I won't recursively serialialize all related fields because it will cause trouble
         with circular dependencies (for example, in Location, Paths can lead eventually to the same Location)
         """
-        return {
-            column: getattr(self, column) for column in self.__table__.columns.keys()
-        }
+        return serializer(type(self))(self)
 
     def __str__(self):
         return f"[ {self.__class__.__name__} ] ({self.as_dict()})"
@@ -63,6 +65,14 @@ class Base:
         return self.__str__()
 
     id = Column(Integer, primary_key=True, nullable=False,autoincrement=True)
+    # Bumped by every ORM update, which also checks it wasn't changed concurrently.
+    # Core writes (the rollups, bulk inserts) maintain both columns themselves.
+    version = Column(Integer, nullable=False, default=1)
+    updated_at = Column(DateTime, nullable=False, default=utcnow, onupdate=utcnow)
+
+    @declared_attr
+    def __mapper_args__(cls):  # pylint: --disable=no-self-argument
+        return {"version_id_col": cls.version}
 
 class Sucursal(Base):
     nombre = Column(String, unique=True, nullable=False)
@@ -82,20 +92,79 @@ class Sucursal(Base):
         return max(0, self.reading - self.limit)
 
 class Area(Base):
+    __table_args__ = (
+        Index("ix_area_sucursal", "id_sucursal"),
+    )
+
     nombre = Column(String,nullable=False)
     responsable = Column(String,nullable=False)
-    id_sucursal = Column(Integer,ForeignKey("sucursal.id"),primary_key=True,autoincrement=False)
+    id_sucursal = Column(Integer,ForeignKey("sucursal.id"),nullable=False)
     # equipo = relationship("Equipo",back_populates="area",uselist=True)
     # sucursal = relationship("Sucursal",back_populates="area")
 
 class Registro(Base):
+    __table_args__ = (
+        # natural key, the surrogate id is the primary key.
+        # It is the access path of every per branch time range report.
+        Index("ix_registro_sucursal_fecha", "id_sucursal", "fecha", unique=True),
+        # reports over all branches for a date range
+        Index("ix_registro_fecha", "fecha"),
+        # over limit readings are a small fraction of the table, keep them in a partial index.
+        # Queries must use the OVER_LIMIT clause verbatim for SQLite to pick it.
+        Index(
+            "ix_registro_sobre_limite",
+            "id_sucursal",
+            "fecha",
+            sqlite_where=text("sobre_limite > 0"),
+        ),
+    )
+
     lectura = Column(Integer, nullable=False)
     costo = Column(Integer, nullable=False)
     sobre_limite = Column(Integer, nullable=False)
-    fecha = Column(Date,primary_key=True,nullable=False)
-    id_sucursal = Column(Integer,ForeignKey("sucursal.id"),primary_key=True)
+    fecha = Column(Date,nullable=False)
+    id_sucursal = Column(Integer,ForeignKey("sucursal.id"),nullable=False)
     # sucursal = relationship("Sucursal",back_populates="registro")
 
+# literal (not bound) so it matches the predicate of ix_registro_sobre_limite
+OVER_LIMIT = Registro.sobre_limite > literal_column("0")
+
+class ConsumoMensual(Base):
+    """
+    Monthly rollup of Registro, maintained by registro_changed.
+    consumo is lectura_final minus the lectura_final of the previous month with readings
+    (or lectura_inicial for the first one), since readings are cumulative.
+    """
+    __table_args__ = (
+        Index("ix_consumo_mensual_sucursal_mes", "id_sucursal", "anio", "mes", unique=True),
+        # reports over all branches for one month
+        Index("ix_consumo_mensual_mes", "anio", "mes"),
+    )
+
+    id_sucursal = Column(Integer,ForeignKey("sucursal.id"),nullable=False)
+    anio = Column(Integer, nullable=False)
+    mes = Column(Integer, nullable=False)
+    lectura_inicial = Column(Integer, nullable=False)
+    lectura_final = Column(Integer, nullable=False)
+    consumo = Column(Integer, nullable=False)
+    costo = Column(Integer, nullable=False)
+    sobre_limite = Column(Integer, nullable=False)
+    registros = Column(Integer, nullable=False)
+
+class Alerta(Base):
+    """
+    Over limit readings, maintained by registro_changed so listing them
+    doesn't have to go through the history of readings.
+    """
+    __table_args__ = (
+        Index("ix_alerta_sucursal_fecha", "id_sucursal", "fecha", unique=True),
+    )
+
+    id_sucursal = Column(Integer,ForeignKey("sucursal.id"),nullable=False)
+    fecha = Column(Date,nullable=False)
+    exceso = Column(Integer, nullable=False)
+    reconocida = Column(Boolean, default=False, nullable=False)
+
 class Equipo(Base):
     modelo = Column(String,nullable=False)
     consumo_diario_promedio = Column(Integer)
@@ -121,7 +190,7 @@ class User(Base):
     token = relationship("Token", uselist=False, back_populates="user")
 
 class Token(Base):
-    value = Column(String, nullable=False)
+    value = Column(String, nullable=False, unique=True, index=True)
     user_id = Column(
         None,
         ForeignKey("user.id"),
@@ -133,73 +202,307 @@ class Token(Base):
         )
 
 
-def create_db(name=settings.DATABASES["default"]["engine"]):
+def _month_bounds(anio, mes):
+    return date(anio, mes, 1), date(anio + mes // 12, mes % 12 + 1, 1)
+
+
+def _refresh_consumo(connection, id_sucursal, anio, mes):
     """
-    Create database and schema if and only if the schema was modified
+    Recompute consumo of a bucket from its own readings and the previous bucket.
+    The row, and so its validators, is only touched when the value changes.
     """
-    file = name.split(os.sep)[-1]
-    master = "master_" + file
-    master_name = name.replace(file, master)
+    table = ConsumoMensual.__table__
+    bucket = (table.c.id_sucursal == id_sucursal) & (table.c.anio == anio) & (table.c.mes == mes)
+    previous = (
+        select(table.c.lectura_final)
+        .where(
+            table.c.id_sucursal == id_sucursal,
+            tuple_(table.c.anio, table.c.mes) < tuple_(anio, mes),
+        )
+        .order_by(table.c.anio.desc(), table.c.mes.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    consumo = table.c.lectura_final - func.coalesce(previous, table.c.lectura_inicial)
+    connection.execute(
+        table.update()
+        .where(bucket, table.c.consumo.is_distinct_from(consumo))
+        .values(consumo=consumo, version=table.c.version + 1, updated_at=utcnow())
+    )
 
-    path = name.split("///")[-1].replace("(", "")
-    master_path = pathlib.Path(path.replace(file, master))
-    child_path = pathlib.Path(path)
 
-    # Nuke everything and build it from scratch.
-    if db_schema_modified("db.py") or not master_path.exists():
-        master_engine = create_engine(master_name)
-        Base.metadata.drop_all(master_engine)
-        Base.metadata.create_all(master_engine)
+def refresh_consumo_mensual(connection, buckets=None):
+    """
+    Recompute the ConsumoMensual rows of the given (id_sucursal, anio, mes) buckets from Registro.
+    The consumption of the bucket right after each one is refreshed too, as its baseline may have moved.
+    :param buckets: iterable of buckets, every bucket with readings when None
+    """
+    registro = Registro.__table__
+    table = ConsumoMensual.__table__
+
+    if buckets is None:
+        anio = func.cast(func.strftime("%Y", registro.c.fecha), Integer)
+        mes = func.cast(func.strftime("%m", registro.c.fecha), Integer)
+        buckets = connection.execute(select(registro.c.id_sucursal, anio, mes).distinct()).all()
+
+    # chronological order, so every bucket sees the refreshed previous one
+    for id_sucursal, anio, mes in sorted(set(buckets)):
+        start, end = _month_bounds(anio, mes)
+        count, costo, sobre_limite, inicial, final = connection.execute(
+            select(
+                func.count(),
+                func.sum(registro.c.costo),
+                func.sum(registro.c.sobre_limite),
+                func.min(registro.c.lectura),
+                func.max(registro.c.lectura),
+            ).where(
+                registro.c.id_sucursal == id_sucursal,
+                registro.c.fecha >= start,
+                registro.c.fecha < end,
+            )
+        ).one()
+
+        if count:
+            values = dict(
+                lectura_inicial=inicial,
+                lectura_final=final,
+                consumo=final - inicial,
+                costo=costo,
+                sobre_limite=sobre_limite,
+                registros=count,
+            )
+            connection.execute(
+                sqlite_insert(table)
+                .values(id_sucursal=id_sucursal, anio=anio, mes=mes, **values)
+                .on_conflict_do_update(
+                    index_elements=["id_sucursal", "anio", "mes"],
+                    set_={**values, "version": table.c.version + 1, "updated_at": utcnow()},
+                )
+            )
+            _refresh_consumo(connection, id_sucursal, anio, mes)
+        else:
+            connection.execute(
+                delete(table).where(
+                    table.c.id_sucursal == id_sucursal, table.c.anio == anio, table.c.mes == mes
+                )
+            )
+
+        following = connection.execute(
+            select(table.c.anio, table.c.mes)
+            .where(
+                table.c.id_sucursal == id_sucursal,
+                tuple_(table.c.anio, table.c.mes) > tuple_(anio, mes),
+            )
+            .order_by(table.c.anio, table.c.mes)
+            .limit(1)
+        ).one_or_none()
+        if following is not None:
+            _refresh_consumo(connection, id_sucursal, *following)
+
+
+def refresh_alertas(connection, keys=None):
+    """
+    Create, update or delete the Alerta of the given (id_sucursal, fecha) readings
+    so it matches their current sobre_limite. Acknowledged alerts stay acknowledged.
+    :param keys: iterable of (id_sucursal, fecha), every reading when None
+    """
+    registro = Registro.__table__
+    table = Alerta.__table__
+
+    if keys is None:
+        connection.execute(delete(table))
+        connection.execute(
+            table.insert().from_select(
+                ["id_sucursal", "fecha", "exceso", "reconocida"],
+                select(registro.c.id_sucursal, registro.c.fecha, registro.c.sobre_limite, literal(False))
+                .where(OVER_LIMIT),
+            )
+        )
+        return
 
-    shutil.copy(master_path, child_path)
+    keys = sorted(set(keys))
+    upsert = sqlite_insert(table)
+    upsert = upsert.on_conflict_do_update(
+        index_elements=["id_sucursal", "fecha"],
+        set_={
+            "exceso": upsert.excluded.exceso,
+            "version": table.c.version + 1,
+            "updated_at": upsert.excluded.updated_at,
+        },
+        # an unchanged excess is not a new version
+        where=table.c.exceso != upsert.excluded.exceso,
+    )
 
-    engine = create_engine(name)
+    # stay well below the bound parameters limit of SQLite
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        over = {
+            (id_sucursal, fecha): exceso
+            for id_sucursal, fecha, exceso in connection.execute(
+                select(registro.c.id_sucursal, registro.c.fecha, registro.c.sobre_limite)
+                .where(tuple_(registro.c.id_sucursal, registro.c.fecha).in_(chunk), OVER_LIMIT)
+            )
+        }
 
-    return str(engine.url)
+        cleared = [key for key in chunk if key not in over]
+        if cleared:
+            connection.execute(
+                delete(table).where(tuple_(table.c.id_sucursal, table.c.fecha).in_(cleared))
+            )
+        if over:
+            connection.execute(
+                upsert,
+                [
+                    {"id_sucursal": id_sucursal, "fecha": fecha, "exceso": exceso, "reconocida": False}
+                    for (id_sucursal, fecha), exceso in over.items()
+                ],
+            )
+
+
+def registro_changed(connection, rows):
+    """
+    Ingestion hook, keep the data derived from Registro in sync.
+    Must be called for every row written outside of the ORM unit of work (bulk inserts),
+    ORM flushes are handled by the after_flush listener below.
+    :param rows: Registro objects or dicts whose (id_sucursal, fecha) was inserted, updated or deleted
+    """
+    keys = set()
+    for row in rows:
+        if isinstance(row, dict):
+            keys.add((row["id_sucursal"], row["fecha"]))
+        else:
+            keys.add((row.id_sucursal, row.fecha))
+
+    if keys:
+        refresh_consumo_mensual(
+            connection, {(id_sucursal, fecha.year, fecha.month) for id_sucursal, fecha in keys}
+        )
+        refresh_alertas(connection, keys)
 
 
-def drop_db(name=settings.DATABASES["default"]["engine"]):
-    engine = create_engine(name)
-    Base.metadata.drop_all(engine)
+@event.listens_for(Session, "after_flush")
+def _registro_flushed(session, flush_context):
+    rows = []
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if not isinstance(obj, Registro):
+            continue
+        rows.append(obj)
+        # a reading moved to another branch or month leaves its old bucket behind
+        state = inspect(obj)
+        old_sucursal = state.attrs.id_sucursal.history.deleted
+        old_fecha = state.attrs.fecha.history.deleted
+        if old_sucursal or old_fecha:
+            rows.append({
+                "id_sucursal": old_sucursal[0] if old_sucursal else obj.id_sucursal,
+                "fecha": old_fecha[0] if old_fecha else obj.fecha,
+            })
+
+    registro_changed(session.connection(), rows)
+
 
+class FullScanError(AssertionError):
+    pass
 
-def db_schema_modified(filename):
+
+def query_plan(connection, statement):
     """
-    Utility tool to know if a file was modified.
-    :param file: Path object, file to watch
+    Output of EXPLAIN QUERY PLAN for a select statement or ORM query.
+    :return: list of plan details, e.g. ["SEARCH registro USING INDEX ix_registro_fecha (fecha>?)"]
     """
-    ts_file = (
-        settings.BASE_DIR
-        / f"_last_mod_{filename if isinstance(filename, str) else filename.name}.timestamp"
+    statement = getattr(statement, "statement", statement)
+    compiled = statement.compile(
+        dialect=connection.dialect, compile_kwargs={"literal_binds": True}
     )
-    if not (settings.BASE_DIR / filename).exists():
-        warn(f"{filename} does not exist")
-        return
-    _last_schema_mod = os.stat(settings.BASE_DIR / filename).st_mtime
-    try:
-        with open(ts_file, encoding="utf-8") as file:
-            _lst_reg_schema_mod = file.read()
-    except FileNotFoundError as exc:
-        _, error = exc.args
-        warn(error)
-        with open(ts_file, "w", encoding="utf-8") as file:
-            file.write(str(_last_schema_mod))
-            _lst_reg_schema_mod = 0
+    rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + compiled.string)
+    return [row[-1] for row in rows]
+
 
-    SCHEMA_MODIFIED = float(_lst_reg_schema_mod) != _last_schema_mod
-    if SCHEMA_MODIFIED:
-        logger.info("Detected change in %s ... db will be rebuilt", filename)
-        with open(ts_file, "w", encoding="utf-8") as file:
-            file.write(str(_last_schema_mod))
+def assert_indexed(connection, statement, allow=()):
+    """
+    Fail if the plan of statement falls back to scanning a whole table.
+    :param allow: names of tables that may be scanned (e.g. the outer table of a report over all branches)
+    :raises FullScanError:
+    """
+    partial = {
+        index.name
+        for table in Base.metadata.tables.values()
+        for index in table.indexes
+        if index.dialect_options["sqlite"]["where"] is not None
+    }
+
+    plan = query_plan(connection, statement)
+    for detail in plan:
+        words = detail.split()
+        if words[0] != "SCAN" or words[1] not in Base.metadata.tables or words[1] in allow:
+            continue
+        # walking a partial index only visits the rows matching its predicate
+        if "INDEX" in words and words[words.index("INDEX") + 1] in partial:
+            continue
+        raise FullScanError(f"Full scan of {words[1]}: {plan}")
+    return plan
+
+
+def set_pragmas(engine, pragmas=None):
+    """
+    Apply the SQLite pragmas of the settings (DATABASES["default"]["pragmas"])
+    on every new connection of engine.
+    """
+    if pragmas is None:
+        pragmas = settings.DATABASES["default"].get("pragmas", {})
 
-    return SCHEMA_MODIFIED
+    if not pragmas or engine.dialect.name != "sqlite":
+        return engine
+
+    statements = []
+    for name, value in pragmas.items():
+        if not name.isidentifier() or not str(value).lstrip("-").isalnum():
+            raise ValueError(f"Invalid pragma {name}={value}")
+        statements.append(f"PRAGMA {name}={value}")
+
+    @event.listens_for(engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    return engine
+
+
+def get_engine(url=settings.DATABASES["default"]["engine"], pragmas=None):
+    """create_engine with the pragmas of the settings, see set_pragmas"""
+    return set_pragmas(create_engine(url), pragmas)
+
+
+def create_db(name=settings.DATABASES["default"]["engine"]):
+    """
+    Create the database, or bring its schema up to date without touching its data.
+    See mange.migrations.
+    """
+    from mange.migrations import migrate  # pylint: disable=import-outside-toplevel
+
+    migrate(name)
+    return name
+
+
+def drop_db(name=settings.DATABASES["default"]["engine"]):
+    engine = get_engine(name)
+    Base.metadata.drop_all(engine)
 
 
 def load_backup(source: "Engine", dest: "Engine"):
-    if isinstance(dest, str):
-        dest = create_engine(dest)
+    owned = isinstance(dest, str)
+    if owned:
+        dest = get_engine(dest)
 
     raw_src = source.raw_connection()
-    raw_dst = dest.raw_connection()
-    raw_src.driver_connection.backup(raw_dst.driver_connection)
-    raw_src.close()
+    try:
+        raw_dst = dest.raw_connection()
+        try:
+            raw_src.driver_connection.backup(raw_dst.driver_connection)
+        finally:
+            raw_dst.close()
+    finally:
+        raw_src.close()
+        if owned:
+            dest.dispose()
@@ -0,0 +1,195 @@
+"""
+Logical export and import of the whole database.
+
+A dump is a gzip compressed file of JSON lines: a header, then every table of
+Base.metadata in dependency order, each one as a line with its name and
+columns followed by lines of up to DUMP_CHUNK_SIZE rows (arrays of the values
+in column order), closed by a line with its row count. A last line with the
+number of tables marks the end of the dump. Values are copied as
+SQLite stores them, so nothing is converted on either side. The file is written
+as <path>.partial and only renamed to path once complete.
+
+Dumping reads every table in a single read transaction, a consistent snapshot
+that doesn't block writers in WAL mode. Loading creates the tables without
+their indexes, inserts the rows, then builds the indexes and records the
+schema version, all in a single transaction: a load that fails leaves the
+database as it was. Both directions hold one chunk in memory at a time.
+"""
+import argparse
+import gzip
+import logging
+import os
+import pathlib
+import time
+
+from sqlalchemy import inspect, select
+from sqlalchemy.schema import CreateTable
+
+from mange.conf import settings
+from mange.db import Base
+from mange.migrations import (
+    current_fingerprint,
+    fingerprint,
+    record_version,
+    schema_version,
+    transactional_engine,
+)
+from mange.serializers import dumps, loads
+
+log = logging.getLogger("global")
+
+FORMAT = "mange-dump"
+VERSION = 1
+
+
+class DumpError(Exception):
+    pass
+
+
+def _write(out, data):
+    out.write(dumps(data))
+    out.write("\n")
+
+
+def dump(url, path, metadata=Base.metadata, chunk_size=settings.DUMP_CHUNK_SIZE,
+         compresslevel=settings.DUMP_COMPRESSLEVEL):
+    """
+    Write every table of metadata in the database at url to the dump file path,
+    which only appears (or is replaced) once complete.
+    :return: {table: rows written}
+    """
+    path = pathlib.Path(path)
+    partial = path.with_name(path.name + ".partial")
+    target = fingerprint(metadata)
+    counts = {}
+    engine = transactional_engine(url)
+    try:
+        with engine.begin() as connection, gzip.open(partial, "wt", compresslevel=compresslevel) as out:
+            current = current_fingerprint(connection)
+            if current is not None and current != target:
+                raise DumpError("The schema of the database is not the one of the models, migrate it first")
+            _write(out, {"format": FORMAT, "version": VERSION, "fingerprint": target})
+
+            # the connection is in the transaction opened above, every table is read from the same snapshot
+            cursor = connection.connection.driver_connection.cursor()
+            for table in metadata.sorted_tables:
+                start = time.perf_counter()
+                _write(out, {"table": table.name, "columns": table.columns.keys()})
+                cursor.execute(str(select(table).compile(connection)))
+                rows = 0
+                while True:
+                    chunk = cursor.fetchmany(chunk_size)
+                    if not chunk:
+                        break
+                    _write(out, chunk)
+                    rows += len(chunk)
+                _write(out, {"end": table.name, "rows": rows})
+                counts[table.name] = rows
+                _log_table("dumped", table.name, rows, start)
+            cursor.close()
+            _write(out, {"tables": len(counts)})
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    finally:
+        engine.dispose()
+
+    os.replace(partial, path)
+    return counts
+
+
+def load(url, path, metadata=Base.metadata, replace=False):
+    """
+    Load the dump file path into the database at url.
+    :param replace: drop the tables of metadata even when they have rows, by default
+        only an empty database (or one with empty tables) is loaded into
+    :return: {table: rows inserted}
+    """
+    counts = {}
+    engine = transactional_engine(url)
+    try:
+        with engine.begin() as connection, gzip.open(path, "rt") as lines:
+            header = loads(next(lines, "{}"))
+            if header.get("format") != FORMAT or header.get("version") != VERSION:
+                raise DumpError(f"{path} is not a dump of this version")
+            if header["fingerprint"] != fingerprint(metadata):
+                raise DumpError(f"{path} was dumped from another schema")
+
+            _clear(connection, metadata, replace)
+
+            cursor = connection.connection.driver_connection.cursor()
+            table = insert = tables = None
+            start = time.perf_counter()
+            for line in lines:
+                data = loads(line)
+                if isinstance(data, list):
+                    if insert is None:
+                        raise DumpError(f"{path} has rows outside of a table")
+                    cursor.executemany(insert, data)
+                    counts[table.name] += len(data)
+                elif "table" in data:
+                    table = metadata.tables.get(data["table"])
+                    if table is None or data["columns"] != table.columns.keys():
+                        raise DumpError(f"Table {data['table']} of {path} is not the one of the models")
+                    # the indexes are built once the rows are in
+                    connection.execute(CreateTable(table))
+                    insert = str(table.insert().compile(connection))
+                    counts[table.name] = 0
+                    start = time.perf_counter()
+                elif "end" in data:
+                    if table is None or data["end"] != table.name or data["rows"] != counts[table.name]:
+                        raise DumpError(f"{path} is truncated or corrupt")
+                    _log_table("loaded", table.name, counts[table.name], start)
+                    table = insert = None
+                elif "tables" in data:
+                    tables = data["tables"]
+            if table is not None or tables != len(counts):
+                raise DumpError(f"{path} is truncated")
+            cursor.close()
+
+            for name in counts:
+                start = time.perf_counter()
+                for index in metadata.tables[name].indexes:
+                    index.create(connection)
+                log.info("indexed %s in %.1fs", name, time.perf_counter() - start)
+            record_version(connection, header["fingerprint"])
+    finally:
+        engine.dispose()
+
+    return counts
+
+
+def _clear(connection, metadata, replace):
+    """Drop the tables of metadata that exist, refusing to drop rows unless replace"""
+    existing = set(inspect(connection).get_table_names()) & set(metadata.tables)
+    if not replace:
+        for name in existing:
+            if connection.execute(select(metadata.tables[name]).limit(1)).first() is not None:
+                raise DumpError(f"Table {name} is not empty, use --replace to drop its rows")
+    metadata.drop_all(connection, tables=[metadata.tables[name] for name in existing])
+    schema_version.drop(connection, checkfirst=True)
+
+
+def _log_table(action, name, rows, start):
+    elapsed = time.perf_counter() - start
+    log.info("%s %s rows of %s in %.1fs (%.0f rows/s)", action, rows, name, elapsed, rows / max(elapsed, 1e-9))
+
+
+def main(argv, command="dump"):
+    """mange dump and mange load"""
+    parser = argparse.ArgumentParser(prog=f"mange {command}")
+    parser.add_argument("path", help="dump file, gzip compressed JSON lines")
+    parser.add_argument("--database", default=settings.DATABASES["default"]["engine"],
+                        help="database url, the default one of the settings by default")
+    if command == "dump":
+        parser.add_argument("--chunk-size", type=int, default=settings.DUMP_CHUNK_SIZE, help="rows per line")
+    else:
+        parser.add_argument("--replace", action="store_true", help="drop the rows already in the database")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    if command == "dump":
+        counts = dump(args.database, args.path, chunk_size=args.chunk_size)
+    else:
+        counts = load(args.database, args.path, replace=args.replace)
+    log.info("%s rows of %s tables in %.1fs", sum(counts.values()), len(counts), time.perf_counter() - start)
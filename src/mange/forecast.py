@@ -0,0 +1,88 @@
+"""
+Trend based consumption forecasting.
+
+The monthly series of every branch is loaded from the ConsumoMensual rollup in a
+single query and a least squares line is fitted to all of them at once with
+grouped sums, so the cost is a few vector operations regardless of the number of branches.
+"""
+from datetime import date
+
+import numpy as np
+from sqlalchemy import select
+
+from mange.db import ConsumoMensual
+
+YEARS = 5
+HORIZON = 3  # months, the three calendar months after today's
+
+
+def _month_index(anio, mes):
+    return anio * 12 + mes - 1
+
+
+def series_stmt(sucursales, today):
+    """Monthly consumption of the last YEARS years before today's month, the current one is not complete yet"""
+    current = _month_index(today.year, today.month)
+    start = current - YEARS * 12
+    month = ConsumoMensual.anio * 12 + ConsumoMensual.mes - 1
+
+    stmt = select(
+        ConsumoMensual.id_sucursal,
+        month,
+        ConsumoMensual.consumo,
+    ).where(month >= start, month < current)
+    if sucursales is not None:
+        stmt = stmt.where(ConsumoMensual.id_sucursal.in_(sucursales))
+    return stmt
+
+
+def fit(groups, x, y):
+    """
+    Least squares line for every group at once.
+    :param groups: int array, group index (0..n-1) of every point
+    :return: (slope, intercept) arrays indexed by group. Groups with a single
+        point, or all points in the same month, get a flat line at their mean.
+    """
+    n = np.bincount(groups).astype(float)
+    sx = np.bincount(groups, weights=x)
+    sy = np.bincount(groups, weights=y)
+    sxx = np.bincount(groups, weights=x * x)
+    sxy = np.bincount(groups, weights=x * y)
+
+    denominator = n * sxx - sx * sx
+    flat = np.isclose(denominator, 0)
+    slope = np.where(flat, 0.0, (n * sxy - sx * sy) / np.where(flat, 1.0, denominator))
+    intercept = (sy - slope * sx) / n
+    return slope, intercept
+
+
+def forecast(rows, today, horizon=HORIZON):
+    """
+    Sum of the trend over the ``horizon`` months after today's for every branch.
+    :param rows: iterable of (id_sucursal, month index, consumption) of complete months
+    :return: {id_sucursal: forecast}
+    """
+    data = np.array(list(rows), dtype=float).reshape(-1, 3)
+    if not len(data):
+        return {}
+
+    ids, groups = np.unique(data[:, 0].astype(np.int64), return_inverse=True)
+    # center x on the current month to keep the sums small, the fitted
+    # months are all before it (x < 0) and the forecast ones after it
+    x = data[:, 1] - _month_index(today.year, today.month)
+    slope, intercept = fit(groups, x, data[:, 2])
+
+    months = np.arange(1, horizon + 1, dtype=float)
+    prediction = intercept * horizon + slope * months.sum()
+
+    return dict(zip(ids.tolist(), prediction.tolist()))
+
+
+def predict(session, sucursales=None, today=None):
+    """
+    Forecast the consumption of the next quarter from the trend of the last five years.
+    :param sucursales: list of Sucursal ids, every branch with readings when None
+    :return: {id_sucursal: forecast}
+    """
+    today = today or date.today()
+    return forecast(session.execute(series_stmt(sucursales, today)), today)
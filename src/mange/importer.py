@@ -0,0 +1,160 @@
+"""
+Streaming importer for historical meter readings.
+
+Files are read line by line (CSV with a header row or JSON lines) and stored in
+chunks through Client.bulk_create_registro. After every committed chunk the byte
+offset of the file is saved next to it, so an interrupted import resumes from there.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import pathlib
+import time
+
+from mange.db import Registro
+
+log = logging.getLogger("global")
+
+FORMATS = ("csv", "jsonl")
+
+
+def state_path(path):
+    return pathlib.Path(f"{path}.offset")
+
+
+def load_state(path):
+    try:
+        with open(state_path(path), encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"offset": 0, "line": 0}
+
+
+def save_state(path, state):
+    tmp = state_path(path).with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as file:
+        json.dump(state, file)
+    os.replace(tmp, state_path(path))
+
+
+def coerce(row):
+    """CSV gives strings for everything, convert numeric columns of Registro"""
+    columns = Registro.__table__.columns
+    for key, value in row.items():
+        if key not in columns:
+            continue
+        python_type = columns[key].type.python_type
+        if value == "":
+            row[key] = None
+        elif python_type in (int, float):
+            try:
+                row[key] = python_type(value)
+            except ValueError:
+                pass  # left as is, validation will report it
+    return row
+
+
+def read_rows(file, fmt, offset=0):
+    """
+    Yield (row, offset right after the row) from a file opened in binary mode.
+    Only one line is held in memory at a time.
+    """
+    header = None
+    if fmt == "csv":
+        header = next(csv.reader([file.readline().decode("utf-8-sig")]))
+
+    if offset:
+        file.seek(offset)
+
+    while True:
+        line = file.readline()
+        if not line:
+            return
+        offset = file.tell()
+        line = line.decode("utf-8").strip()
+        if not line:
+            continue
+
+        if fmt == "csv":
+            row = coerce(dict(zip(header, next(csv.reader([line])))))
+        else:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = line  # reported by validation
+        yield row, offset
+
+
+def import_readings(client, path, fmt=None, chunk_size=1000, restart=False):
+    """
+    Import a file of readings in chunks of ``chunk_size`` rows, one transaction per chunk.
+    :return: (rows created, list of (line number, errors) that were rejected)
+    """
+    path = pathlib.Path(path)
+    fmt = fmt or ("jsonl" if path.suffix in (".jsonl", ".json") else "csv")
+    state = {"offset": 0, "line": 0} if restart else load_state(path)
+
+    if state["offset"]:
+        log.info("Resuming %s from line %s", path, state["line"])
+
+    created = 0
+    rejected = []
+    start = time.perf_counter()
+
+    def flush(chunk, offset):
+        nonlocal created
+        result = client.bulk_create_registro(chunk)
+        created += result["created"]
+        rejected.extend(
+            (state["line"] + error["index"] + 1, error["errors"]) for error in result["errors"]
+        )
+        state["offset"] = offset
+        state["line"] += len(chunk)
+        save_state(path, state)
+
+        log.info(
+            "%s: %s rows imported, %s rejected, %.0f rows/s",
+            path.name,
+            created,
+            len(rejected),
+            created / max(time.perf_counter() - start, 1e-9),
+        )
+
+    with open(path, "rb") as file:
+        chunk = []
+        offset = state["offset"]
+        for row, offset in read_rows(file, fmt, state["offset"]):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                flush(chunk, offset)
+                chunk = []
+        if chunk:
+            flush(chunk, offset)
+
+    state_path(path).unlink(missing_ok=True)
+
+    for line, errors in rejected:
+        log.warning("%s: row %s rejected %s", path.name, line, errors)
+
+    return created, rejected
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="mange import-readings")
+    parser.add_argument("file", help="CSV (with header) or JSON lines file of readings")
+    parser.add_argument("--format", choices=FORMATS, help="guessed from the extension by default")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="rows committed per transaction")
+    parser.add_argument("--restart", action="store_true", help="ignore the saved offset and start over")
+    args = parser.parse_args(argv)
+
+    from mange.api import Client
+
+    import_readings(
+        Client(),
+        args.file,
+        fmt=args.format,
+        chunk_size=args.chunk_size,
+        restart=args.restart,
+    )
@@ -1,5 +1,3 @@
-from mange.db import create_db
-from mange.conf import settings
 import sys
 
 def get_command(command: list=sys.argv[1]):
@@ -8,16 +6,32 @@ def get_command(command: list=sys.argv[1]):
         import mange.test.shell
 
     elif command == "migrate":
-        create_db(settings.DATABASES["default"]["engine"])
-        
+        from mange.migrations import main
+        main(sys.argv[2:])
+
+    elif command == "backup":
+        from mange.backup import main
+        main(sys.argv[2:])
+
+    elif command in ("dump", "load"):
+        from mange.dump import main
+        main(sys.argv[2:], command)
 
     elif command == "test":
         from mange.test import test_db
         test_db.run()
 
+    elif command == "import-readings":
+        from mange.importer import main
+        main(sys.argv[2:])
+
+    elif command == "bench":
+        from mange.test.bench import main
+        main(sys.argv[2:])
+
     elif command == "runserver":
         from mange.server import runserver
-        runserver()
+        runserver(sys.argv[2:])
 
 if __name__ == "__main__":
     get_command()
@@ -0,0 +1,290 @@
+"""
+In process metrics, exposed in the Prometheus text format.
+
+Metrics are labelled by a tuple of values, recording takes a lock and a
+couple of dict operations so it is cheap enough to do on every call.
+
+The values are those of the current process only. A forked child starts
+from zero instead of the counters of its parent at the time of the fork.
+The pre-forking server (mange.serving) shares a directory between its
+workers: each one writes a snapshot of its registry there every
+SHARE_INTERVAL seconds and the worker answering a scrape adds up its own
+values and the snapshots of the others, which are at most that old. The
+snapshot of a worker is deleted when it exits, so its counts are lost.
+"""
+from bisect import bisect_left
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+
+log = logging.getLogger("global")
+
+# seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+SHARE_INTERVAL = 1  # seconds
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in sorted(values):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+    def snapshot(self):
+        """:return: the values, JSON serializable"""
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+    def merge(self, snapshot):
+        """Add the values of a snapshot"""
+        for labels, value in snapshot:
+            self.inc(tuple(labels), value)
+
+    def copy(self):
+        other = type(self)(self.name, self.documentation, self.labelnames)
+        other.merge(self.snapshot())
+        return other
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _after_fork(self):
+        # the lock may have been held by another thread of the parent, that doesn't exist here
+        self._lock = threading.Lock()
+        self._values = {}
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                counts, total = self._values[labels]
+            except KeyError:
+                counts, total = [0] * (len(self.buckets) + 1), 0.0
+            counts[index] += 1
+            self._values[labels] = (counts, total + value)
+
+    def count(self, labels=()):
+        counts, _ = self._values.get(labels, ((), 0))
+        return sum(counts)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+    def snapshot(self):
+        """:return: the values, JSON serializable"""
+        with self._lock:
+            return [[list(labels), list(counts), total] for labels, (counts, total) in self._values.items()]
+
+    def merge(self, snapshot):
+        """Add the values of a snapshot"""
+        with self._lock:
+            for labels, counts, total in snapshot:
+                labels = tuple(labels)
+                mine, mine_total = self._values.get(labels, ([0] * (len(self.buckets) + 1), 0.0))
+                self._values[labels] = ([a + b for a, b in zip(mine, counts)], mine_total + total)
+
+    def copy(self):
+        other = type(self)(self.name, self.documentation, self.labelnames, self.buckets)
+        other.merge(self.snapshot())
+        return other
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _after_fork(self):
+        # the lock may have been held by another thread of the parent, that doesn't exist here
+        self._lock = threading.Lock()
+        self._values = {}
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def clear(self):
+        """Reset every metric to zero"""
+        for metric in self._metrics.values():
+            metric.clear()
+
+    def after_fork(self):
+        """Reset every metric to zero in a forked child, without taking their locks"""
+        for metric in self._metrics.values():
+            metric._after_fork()  # pylint: disable=protected-access
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def render(self, snapshots=()):
+        """
+        Prometheus text exposition format, version 0.0.4
+        :param snapshots: snapshots of other registries, added to the values of this one
+        """
+        metrics = self._metrics.values()
+        if snapshots:
+            metrics = [metric.copy() for metric in metrics]
+            for snapshot in snapshots:
+                for metric in metrics:
+                    metric.merge(snapshot.get(metric.name, ()))
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=registry.after_fork)
+
+# directory shared by the workers of mange.serving, None when not forked
+_shared = None
+
+
+def share(directory):
+    """Publish to and aggregate from directory, set in the parent before forking the workers"""
+    global _shared  # pylint: disable=global-statement
+    _shared = pathlib.Path(directory) if directory is not None else None
+
+
+def _snapshot_path(pid):
+    return _shared / f"{pid}.json"
+
+
+def publish():
+    """Write the snapshot of this process to the shared directory"""
+    path = _snapshot_path(os.getpid())
+    partial = path.with_suffix(".partial")
+    partial.write_text(json.dumps(registry.snapshot()))
+    os.replace(partial, path)
+
+
+def publish_every(interval=SHARE_INTERVAL):
+    """Publish from a daemon thread every interval seconds, started in each worker, until share(None)"""
+    def loop():
+        while _shared is not None:
+            try:
+                publish()
+            except Exception:  # pylint: disable=broad-except
+                # keep publishing, the next write may succeed
+                log.exception("Couldn't publish the metrics of worker %s", os.getpid())
+            time.sleep(interval)
+
+    threading.Thread(target=loop, name="mange-metrics", daemon=True).start()
+
+
+def forget(pid):
+    """Delete the snapshot of a worker that exited"""
+    if _shared is not None:
+        _snapshot_path(pid).unlink(missing_ok=True)
+
+
+def render():
+    """Prometheus text of this process, with the snapshots of the other workers when shared"""
+    if _shared is None:
+        return registry.render()
+
+    own = _snapshot_path(os.getpid())
+    snapshots = []
+    for path in _shared.glob("*.json"):
+        if path == own:
+            continue
+        try:
+            snapshots.append(json.loads(path.read_text()))
+        except (FileNotFoundError, ValueError):
+            # the worker exited meanwhile
+            continue
+    return registry.render(snapshots)
+
+client_seconds = registry.histogram(
+    "mange_client_seconds", "Duration of Client method calls", ("method",)
+)
+http_seconds = registry.histogram(
+    "mange_http_request_seconds", "Duration of REST requests", ("route", "method")
+)
+http_requests = registry.counter(
+    "mange_http_requests_total", "REST responses by status code", ("route", "method", "status")
+)
+plugin_seconds = registry.histogram(
+    "mange_plugin_export_seconds", "Duration of plugin exports", ("plugin",)
+)
+cache_requests = registry.counter(
+    "mange_cache_requests_total", "Cache lookups by result", ("cache", "result")
+)
+sql_statements = registry.counter(
+    "mange_sql_statements_total", "SQL statements executed", ("statement",)
+)
+
+
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    """before_cursor_execute listener"""
+    sql_statements.inc((statement.lstrip().split(None, 1)[0].upper(),))
@@ -0,0 +1,411 @@
+"""
+Incremental schema migrations.
+
+The schema a database was last migrated to is recorded in the schema_version
+table as a fingerprint of Base.metadata, when it matches the models there is
+nothing to do. Otherwise the live schema is compared with the models and only
+the difference is applied, every step in its own transaction:
+
+- missing tables are created, the rollups are then populated from the readings,
+- new columns are added in place (a metadata only change in SQLite), the rows
+  already there get the column default. A function default is computed once
+  and written to those rows, it never becomes the SQL DEFAULT of the column,
+  so a required column with one makes the table be rebuilt instead,
+- missing or changed indexes are (re)created, the ones no longer declared dropped,
+- tables whose existing columns, primary key or unique constraints changed are
+  rebuilt: copied in batches into a new table that then replaces the old one.
+
+Tables that are no longer declared are left alone, data is never dropped
+unless a rebuild removes one of its columns.
+"""
+import argparse
+from collections import namedtuple
+from functools import partial
+from hashlib import sha256
+import json
+import logging
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    UniqueConstraint,
+    bindparam,
+    event,
+    func,
+    inspect,
+    literal,
+    select,
+    text,
+)
+
+from sqlalchemy.schema import CreateTable
+
+from mange.conf import settings
+from mange.db import Base, get_engine, refresh_alertas, refresh_consumo_mensual, utcnow
+
+log = logging.getLogger("global")
+
+schema_version = Table(
+    "schema_version",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("fingerprint", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# derived tables, filled from the readings when they are created
+POPULATE = {
+    "consumo_mensual": refresh_consumo_mensual,
+    "alerta": refresh_alertas,
+}
+
+Step = namedtuple("Step", ("description", "apply"))
+
+
+class MigrationError(Exception):
+    pass
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _default(column):
+    if column.default is None:
+        return None
+    if column.default.is_callable:
+        return getattr(column.default.arg, "__name__", "callable")
+    return repr(column.default.arg)
+
+
+def _index_columns(index):
+    return [getattr(expression, "name", str(expression)) for expression in index.expressions]
+
+
+def _unique_sets(table):
+    """Column sets of the unique constraints declared on a model table"""
+    # unique=True with index=True is a unique index instead, compared with the indexes
+    sets = {(column.name,) for column in table.columns if column.unique and not column.index}
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            sets.add(tuple(column.name for column in constraint.columns))
+    return {tuple(sorted(columns)) for columns in sets}
+
+
+def fingerprint(metadata=Base.metadata):
+    """
+    Hash of everything migrate acts upon: tables, column types, nullability,
+    keys and defaults, and indexes.
+    """
+    from sqlalchemy.dialects import sqlite  # pylint: disable=import-outside-toplevel
+
+    dialect = sqlite.dialect()
+    description = []
+    for name, table in sorted(metadata.tables.items()):
+        columns = [
+            (
+                column.name,
+                column.type.compile(dialect=dialect),
+                column.nullable,
+                column.primary_key,
+                bool(column.unique),
+                [key.target_fullname for key in column.foreign_keys],
+                _default(column),
+            )
+            for column in table.columns
+        ]
+        indexes = sorted(
+            (
+                index.name,
+                _index_columns(index),
+                bool(index.unique),
+                str(index.dialect_options["sqlite"]["where"]),
+            )
+            for index in table.indexes
+        )
+        description.append((name, columns, indexes))
+    return sha256(json.dumps(description, default=str).encode("utf8")).hexdigest()
+
+
+def current_fingerprint(connection):
+    """:return: fingerprint of the last migration applied, None for a database never migrated"""
+    if not inspect(connection).has_table(schema_version.name):
+        return None
+    return connection.execute(
+        select(schema_version.c.fingerprint).order_by(schema_version.c.version.desc()).limit(1)
+    ).scalar()
+
+
+def _fill_value(column):
+    """Value of a new column for the rows already in the table"""
+    if column.default is None:
+        if not column.nullable:
+            raise MigrationError(
+                f"Can't add {column.table.name}.{column.name}: it is not nullable and has no default"
+            )
+        return None
+    if column.default.is_callable:
+        return column.default.arg(None)
+    return column.default.arg
+
+
+def _literal(column, value, dialect):
+    return str(
+        literal(value, column.type).compile(dialect=dialect, compile_kwargs={"literal_binds": True})
+    )
+
+
+def _create_table(table, connection, batch_size):
+    table.create(connection)
+
+
+def _populate(table, connection, batch_size):
+    POPULATE[table.name](connection)
+
+
+def _add_column(column, connection, batch_size):
+    dialect = connection.dialect
+    spec = f"{_quote(column.name)} {column.type.compile(dialect=dialect)}"
+    value = _fill_value(column)
+    computed = column.default is not None and column.default.is_callable
+    if value is not None and not computed:
+        # constant default, SQLite doesn't have to touch the rows
+        spec += f" DEFAULT {_literal(column, value, dialect)}"
+    if not column.nullable:
+        spec += " NOT NULL"
+    table = _quote(column.table.name)
+    connection.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {spec}")
+    if computed:
+        connection.execute(
+            text(f"UPDATE {table} SET {_quote(column.name)} = :value").bindparams(
+                bindparam("value", value, type_=column.type)
+            )
+        )
+
+
+def _create_index(index, connection, batch_size, drop=False):
+    if drop:
+        connection.exec_driver_sql(f"DROP INDEX {_quote(index.name)}")
+    index.create(connection)
+
+
+def _drop_index(name, connection, batch_size):
+    connection.exec_driver_sql(f"DROP INDEX {_quote(name)}")
+
+
+def _rebuild(table, live_columns, connection, batch_size):
+    """
+    The SQLite procedure for changes ALTER TABLE can't make: create the new table
+    under another name, copy the rows over in batches of rowids, drop the old
+    table, rename the new one and create its indexes.
+    """
+    temporary = f"_migrate_{table.name}"
+    name = connection.dialect.identifier_preparer.format_table(table)
+    # the DDL of the table alone, its indexes' names are still taken by the old one
+    create = str(CreateTable(table).compile(dialect=connection.dialect)).strip()
+    create = create.replace(f"CREATE TABLE {name} ", f"CREATE TABLE {_quote(temporary)} ", 1)
+    connection.exec_driver_sql(f"DROP TABLE IF EXISTS {_quote(temporary)}")
+    connection.exec_driver_sql(create)
+
+    kept = [column.name for column in table.columns if column.name in live_columns]
+    # a new primary key is assigned by SQLite
+    filled = [
+        column for column in table.columns
+        if column.name not in live_columns and not column.primary_key
+    ]
+    names = ", ".join(_quote(name) for name in kept + [column.name for column in filled])
+    values = ", ".join([_quote(name) for name in kept] + [f":fill_{index}" for index in range(len(filled))])
+    insert = text(
+        f"INSERT INTO {_quote(temporary)} ({names}) "
+        f"SELECT {values} FROM {_quote(table.name)} WHERE rowid > :low AND rowid <= :high"
+    ).bindparams(*(
+        bindparam(f"fill_{index}", _fill_value(column), type_=column.type)
+        for index, column in enumerate(filled)
+    ))
+
+    last = connection.exec_driver_sql(f"SELECT max(rowid) FROM {_quote(table.name)}").scalar() or 0
+    low, copied = 0, 0
+    while low < last:
+        high = connection.execute(
+            text(
+                f"SELECT max(rowid) FROM (SELECT rowid FROM {_quote(table.name)} "
+                "WHERE rowid > :low ORDER BY rowid LIMIT :batch)"
+            ),
+            {"low": low, "batch": batch_size},
+        ).scalar()
+        copied += connection.execute(insert, {"low": low, "high": high}).rowcount
+        low = high
+        log.info("%s: %s rows copied", table.name, copied)
+
+    connection.exec_driver_sql(f"DROP TABLE {_quote(table.name)}")
+    connection.exec_driver_sql(f"ALTER TABLE {_quote(temporary)} RENAME TO {_quote(table.name)}")
+    for index in table.indexes:
+        index.create(connection)
+
+
+def _same_type(column, live, dialect):
+    return column.type.compile(dialect=dialect).upper() == live["type"].compile(dialect=dialect).upper()
+
+
+def plan(connection, metadata=Base.metadata):
+    """
+    Steps that bring the schema of connection's database to metadata.
+    :raises MigrationError: when a change can't be applied
+    """
+    inspector = inspect(connection)
+    dialect = connection.dialect
+    existing = set(inspector.get_table_names())
+    steps = []
+    populate = []
+
+    for table in metadata.sorted_tables:
+        if table.name not in existing:
+            steps.append(Step(f"create table {table.name}", partial(_create_table, table)))
+            if table.name in POPULATE:
+                populate.append(Step(f"populate {table.name}", partial(_populate, table)))
+            continue
+
+        live = {column["name"]: column for column in inspector.get_columns(table.name)}
+        added = [column for column in table.columns if column.name not in live]
+        live_pk = inspector.get_pk_constraint(table.name)["constrained_columns"]
+        live_unique = {
+            tuple(sorted(constraint["column_names"]))
+            for constraint in inspector.get_unique_constraints(table.name)
+        }
+
+        reasons = [
+            f"{column.name} changed"
+            for column in table.columns
+            if column.name in live and (
+                not _same_type(column, live[column.name], dialect)
+                # SQLite reports INTEGER PRIMARY KEY as nullable
+                or (column.nullable != live[column.name]["nullable"] and not column.primary_key)
+            )
+        ]
+        reasons += [f"{name} removed" for name in live if name not in table.columns]
+        if sorted(live_pk) != sorted(column.name for column in table.primary_key):
+            reasons.append("primary key changed")
+        if live_unique != _unique_sets(table):
+            reasons.append("unique constraints changed")
+        # ADD COLUMN can't declare them, nor a required column without a constant DEFAULT
+        reasons += [
+            f"{column.name} added"
+            for column in added
+            if column.primary_key or column.unique or column.foreign_keys
+            or (not column.nullable and column.default is not None and column.default.is_callable)
+        ]
+
+        if reasons:
+            description = f"rebuild table {table.name} ({', '.join(reasons)})"
+            steps.append(Step(description, partial(_rebuild, table, set(live))))
+            continue
+
+        for column in added:
+            _fill_value(column)  # fail early
+            steps.append(Step(f"add column {table.name}.{column.name}", partial(_add_column, column)))
+
+        live_indexes = {index["name"]: index for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            found = live_indexes.get(index.name)
+            if found is None:
+                steps.append(Step(f"create index {index.name}", partial(_create_index, index)))
+            elif (
+                found["column_names"] != _index_columns(index)
+                or bool(found["unique"]) != bool(index.unique)
+                or ("sqlite_where" in found["dialect_options"])
+                != (index.dialect_options["sqlite"]["where"] is not None)
+            ):
+                steps.append(Step(f"recreate index {index.name}", partial(_create_index, index, drop=True)))
+        declared = {index.name for index in table.indexes}
+        for name in sorted(set(live_indexes) - declared):
+            steps.append(Step(f"drop index {name}", partial(_drop_index, name)))
+
+    for name in sorted(existing - set(metadata.tables) - {schema_version.name}):
+        if not name.startswith("_migrate_"):
+            log.warning("table %s is not declared in the models, it is left as it is", name)
+
+    return steps + populate
+
+
+def transactional_engine(url):
+    """
+    Engine whose transactions include DDL. The sqlite3 module only opens them
+    before DML by itself, so BEGIN is emitted explicitly.
+    """
+    engine = get_engine(url)
+
+    @event.listens_for(engine, "connect")
+    def disable_implicit_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+    return engine
+
+
+def migrate(url, metadata=Base.metadata, batch_size=settings.MIGRATION_BATCH_SIZE, dry_run=False):
+    """
+    Bring the schema of the database to metadata, see the module documentation.
+    :param url: database url, or an Engine to migrate its database
+    :return: descriptions of the steps applied (or that would be, with dry_run)
+    """
+    if not isinstance(url, str):
+        url = url.url.render_as_string(hide_password=False)
+    engine = transactional_engine(url)
+    try:
+        return _migrate(engine, metadata, batch_size, dry_run)
+    finally:
+        engine.dispose()
+
+
+def _migrate(engine, metadata, batch_size, dry_run):
+    target = fingerprint(metadata)
+    with engine.connect() as connection:
+        if current_fingerprint(connection) == target:
+            log.info("The schema is up to date")
+            return []
+        steps = plan(connection, metadata)
+
+    for step in steps:
+        log.info("%s%s", "(dry run) " if dry_run else "", step.description)
+        if not dry_run:
+            with engine.begin() as connection:
+                step.apply(connection, batch_size)
+
+    if not dry_run:
+        with engine.begin() as connection:
+            version = record_version(connection, target)
+        log.info("Schema migrated to version %s", version)
+
+    return [step.description for step in steps]
+
+
+def record_version(connection, target=None):
+    """
+    Record in schema_version that the database is at the fingerprint target (the one of Base.metadata by default).
+    :return: the new version number
+    """
+    schema_version.create(connection, checkfirst=True)
+    version = (connection.execute(select(func.max(schema_version.c.version))).scalar() or 0) + 1
+    connection.execute(
+        schema_version.insert().values(version=version, fingerprint=target or fingerprint(), applied_at=utcnow())
+    )
+    return version
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="mange migrate")
+    parser.add_argument("--database", default=settings.DATABASES["default"]["engine"],
+                        help="database url, the default one of the settings by default")
+    parser.add_argument("--batch-size", type=int, default=settings.MIGRATION_BATCH_SIZE,
+                        help="rows copied per statement when a table is rebuilt")
+    parser.add_argument("--dry-run", action="store_true", help="only print the steps")
+    args = parser.parse_args(argv)
+
+    migrate(args.database, batch_size=args.batch_size, dry_run=args.dry_run)
@@ -0,0 +1,71 @@
+"""
+Response helpers shared by the WSGI (mange.server) and ASGI (mange.asgi) apps,
+so both parse ?fields= the same way, send the same validators and stream
+collections in the same format.
+"""
+from hashlib import sha1
+from itertools import islice
+
+from werkzeug.http import http_date, parse_etags, quote_etag
+
+from mange.conf import settings
+from mange.serializers import dumps
+
+# columns the ETag is computed from, projections always read them
+VALIDATOR_FIELDS = ("id", "version", "updated_at")
+
+
+def parse_fields(value):
+    """
+    :param value: the ?fields=a,b parameter, or None
+    :return: tuple of the requested columns, None for all of them
+    """
+    fields = tuple(dict.fromkeys(field.strip() for field in (value or "").split(",") if field.strip()))
+    return fields or None
+
+
+def etag(rows, *extra):
+    """
+    Validator of a representation built from the given rows, from their versions.
+    updated_at tells apart rows recreated with a reused id.
+    :param extra: anything else the representation depends on (cursor, fields)
+    """
+    digest = sha1()
+    for row in rows:
+        digest.update(f"{row.id}:{row.version}:{row.updated_at.isoformat()};".encode("ascii"))
+    digest.update(repr(extra).encode("utf8"))
+    return digest.hexdigest()
+
+
+def not_modified(if_none_match, tag):
+    """:return: whether the If-None-Match header value already holds tag (weak comparison)"""
+    return bool(if_none_match) and parse_etags(if_none_match).contains_weak(tag)
+
+
+def validators(tag, last_modified=None):
+    """:return: the ETag and Last-Modified headers, as (name, value) pairs"""
+    headers = [("ETag", quote_etag(tag))]
+    if last_modified is not None:
+        headers.append(("Last-Modified", http_date(last_modified)))
+    return headers
+
+
+def array_items(rows, first):
+    """Rows encoded as items of a JSON array, after a comma unless they are the first ones"""
+    return ("" if first else ",") + ",".join(map(dumps, rows))
+
+
+def json_chunks(rows, chunk_size=settings.STREAM_CHUNK_SIZE):
+    """
+    A JSON array in pieces of up to chunk_size rows, encoded as rows are consumed from the iterable.
+    """
+    rows = iter(rows)
+    yield "["
+    first = True
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield array_items(chunk, first)
+        first = False
+    yield "]"
@@ -0,0 +1,90 @@
+"""
+JSON serialization of models and API payloads.
+
+The serializer of a model is built once, on first use, with its column
+accessors resolved up front. A row is turned into a dict straight from the
+instance state, falling back to the attribute (which loads it) when a column
+was expired or deferred. orjson (a requirement) encodes dates and datetimes
+natively; the standard library encoder is only a fallback for environments
+without it, and a slower one.
+"""
+from datetime import date
+from decimal import Decimal
+from functools import lru_cache
+import json
+from operator import attrgetter, itemgetter
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+@lru_cache(maxsize=None)
+def serializer(Obj):
+    """
+    :return: function turning an instance of the model Obj into a dict of its columns
+    """
+    names = tuple(Obj.__table__.columns.keys())
+    from_state = itemgetter(*names)
+    from_attributes = attrgetter(*names)
+
+    def serialize(obj):
+        try:
+            values = from_state(obj.__dict__)
+        except KeyError:
+            # expired or deferred columns, let the ORM load them
+            values = from_attributes(obj)
+        return dict(zip(names, values))
+
+    serialize.__name__ = f"serialize_{Obj.__name__}"
+    return serialize
+
+
+@lru_cache(maxsize=256)
+def projection(fields):
+    """
+    :param fields: tuple of column names
+    :return: function turning a row (query Row or model instance) into a dict of those columns only
+    """
+    getter = attrgetter(*fields)
+
+    if len(fields) == 1:
+        def serialize(row):
+            return {fields[0]: getter(row)}
+    else:
+        def serialize(row):
+            return dict(zip(fields, getter(row)))
+
+    return serialize
+
+
+def default(o):
+    """Encoding of what JSON has no type for"""
+    # Base is not imported to keep this module free of the ORM, every model has a table
+    if hasattr(o, "__table__"):
+        return serializer(type(o))(o)
+    if isinstance(o, date):
+        return o.isoformat()
+    if isinstance(o, Decimal):
+        return float(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def dumps(data):
+        """:return: data encoded as a JSON str"""
+        return orjson.dumps(data, default=default, option=_OPTIONS).decode("utf8")
+
+    loads = orjson.loads
+
+else:  # pragma: no cover
+    _encoder = json.JSONEncoder(default=default)
+
+    def dumps(data):
+        """:return: data encoded as a JSON str"""
+        return _encoder.encode(data)
+
+    loads = json.loads
@@ -1,23 +1,26 @@
+import argparse
 import importlib
 import base64
 from functools import wraps
-from json.encoder import JSONEncoder
 import logging
 import os
 import re
-import spec
 import sys
+import threading
+import time
 
-from flask import Blueprint, Flask, request, make_response
+from flask import Blueprint, Flask, Response, g, request, make_response, stream_with_context
 from flask_classful import FlaskView, route
 from flask_cors import CORS
 from werkzeug.exceptions import HTTPException
 import sqlalchemy
 
-from mange.api import Client
-from mange.db import Base
+from mange import backup, metrics, serving
+from mange.api import Client, filter_keys, report_cache, report_tags, sort_keys
 from mange.conf import settings
 from mange.log import logged
+from mange.responses import VALIDATOR_FIELDS, etag, json_chunks, not_modified, parse_fields, validators
+from mange.serializers import dumps, projection
 
 
 log = logging.getLogger("global")
@@ -26,12 +29,6 @@ app = Flask(__name__)
 CORS(app)
 api = Blueprint("api", __name__, url_prefix="/api")
 
-class ModelSerializer(JSONEncoder):
-    def default(self, o):
-        if isinstance(o, Base):
-            return o.as_dict()
-        return super().default(o)
-
 def import_from_path(module_name, file_path):
     """Import a module given its name and file path."""
     spec = importlib.util.spec_from_file_location(module_name, file_path)
@@ -40,14 +37,42 @@ def import_from_path(module_name, file_path):
     spec.loader.exec_module(module)
     return module
 
-encoder = ModelSerializer()
+class ProcessLocalClient:
+    """
+    Client created on first use in each process, so forked workers never share
+    the engine, and the SQLite connections, of their parent.
+    """
+
+    def __init__(self, factory=Client):
+        self._factory = factory
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._client = self._factory()
+                    self._pid = pid
+        return self._client
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._client.session.remove()
+            self._client.engine.dispose()
+        self._client = self._pid = None
 
-client = Client()
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+client = ProcessLocalClient()
 
 # REST API
 def output_json(data, code, headers=None):
     content_type = "application/json"
-    dumped = encoder.encode(data)
+    dumped = dumps(data)
     if headers:
         headers.update({"Content-Type": content_type})
     else:
@@ -55,6 +80,25 @@ def output_json(data, code, headers=None):
     response = make_response(dumped, code, headers)
     return response
 
+def stream_json(rows, chunk_size=settings.STREAM_CHUNK_SIZE):
+    """
+    Chunked JSON array response, rows are encoded as they are consumed from the iterable.
+    """
+    return Response(stream_with_context(json_chunks(rows, chunk_size)), mimetype="application/json")
+
+def conditional(data, tag, last_modified=None):
+    """
+    JSON response carrying the ETag (and Last-Modified) validators, or a bodiless 304
+    when If-None-Match already holds tag, in which case data is not serialized.
+    """
+    if not_modified(request.headers.get("If-None-Match"), tag):
+        response = make_response("", 304)
+    else:
+        response = output_json(data, 200)
+    for name, value in validators(tag, last_modified):
+        response.headers[name] = value
+    return response
+
 def protected(decorated):
     """
     Protect a method against db failure
@@ -72,14 +116,67 @@ def protected(decorated):
             log.error(e)
             client.session.rollback()
             raise APIException()
+        except sqlalchemy.orm.exc.StaleDataError as e:
+            # the row changed since it was loaded, see Base.version
+            log.error(e)
+            client.session.rollback()
+            exc = APIException("The resource was modified concurrently")
+            exc.code = 409
+            raise exc
 
     return internal
 
+def cached(sucursales):
+    """
+    Serve the response from the report cache, keyed by path and normalized query string.
+    :param sucursales: called with the view arguments, returns the Sucursal ids
+        the response reads (None for every branch), writes to them from this
+        process invalidate it, see mange.api.report_cache
+    """
+    def decorator(view):
+        @wraps(view)
+        def internal(*args, **kwargs):
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            entry = report_cache.get(key)
+            if entry is None:
+                metrics.cache_requests.inc(("report", "miss"))
+                generation = report_cache.generation
+                data = view(*args, **kwargs)
+                if not isinstance(data, Response):
+                    data = output_json(data, 200)
+                elif data.status_code != 200 or data.is_streamed:
+                    # 304 or streamed, not cacheable
+                    return data
+                entry = (data.get_data(as_text=True), data.get_etag()[0], data.last_modified)
+                report_cache.set(key, entry, report_tags(sucursales(*args, **kwargs)), generation)
+                return data
+
+            metrics.cache_requests.inc(("report", "hit"))
+            body, tag, last_modified = entry
+            if tag is not None and not_modified(request.headers.get("If-None-Match"), tag):
+                response = make_response("", 304)
+            else:
+                response = make_response(body, 200, {"Content-Type": "application/json"})
+            if tag is not None:
+                for name, value in validators(tag, last_modified):
+                    response.headers[name] = value
+            return response
+
+        return internal
+    return decorator
+
 @logged
 class APIView(FlaskView):
-    representations = {"application/json": output_json}
+    representations = {
+        "application/json": output_json,
+        "flask-classful/default": output_json,
+    }
     model = None
     pk_field = "id"
+    # keyset used to paginate index, must be unique together
+    cursor_fields = ("id",)
+    # query parameters of index that are not filters
+    reserved_args = ("limit", "after", "stream", "fields", "sort")
     excluded_methods = ["get_queryset"]
     route_base = None
 
@@ -101,14 +198,100 @@ class APIView(FlaskView):
 
     @protected
     def index(self):
-        return self.get_queryset("get").all()
+        """
+        Paginated listing. Use ?limit=N to set the page size and ?after=<next> to fetch the following page.
+        ?stream=1 returns the whole collection as a chunked JSON array instead.
+        ?fields=a,b only reads and returns those columns.
+        Any other parameter is a filter, field=value or field__<gt|gte|lt|lte|in|startswith>=value,
+        and ?sort=-a,-b orders by those fields (descending when prefixed with -, all the same
+        way, see sort_keys). Only indexed columns can be filtered and sorted on, and a range
+        only on the first sort field, so every listing is a walk of one index (see filter_keys).
+        Without ?sort= the listing is ordered by the index its filters use.
+        """
+        fields = self._fields()
+        query = self.get_queryset("get")
+        Obj = query.column_descriptions[0]["entity"]
+        params = self._filters()
+        try:
+            query = client._filter(query, params)
+            if request.args.get("sort"):
+                keys = filter_keys(Obj, params, sort_keys(Obj, request.args["sort"]))
+            else:
+                keys = filter_keys(Obj, params, self.cursor_fields, rekey=True)
+        except ValueError as exc:
+            raise APIException(str(exc))
+
+        if fields is not None:
+            query, serialize = self._project(
+                query, fields, *VALIDATOR_FIELDS, *(key.lstrip("-") for key in keys)
+            )
+
+        if request.args.get("stream") in ("1", "true"):
+            rows = client._stream(query, keys=keys)
+            return stream_json(rows if fields is None else map(serialize, rows))
+
+        limit = request.args.get("limit", str(settings.PAGE_SIZE))
+        if not limit.isdigit() or not 0 < int(limit) <= settings.MAX_PAGE_SIZE:
+            raise APIException(f"The limit field must be an integer between 1 and {settings.MAX_PAGE_SIZE}")
+
+        try:
+            rows, cursor = client._paginate(
+                query,
+                keys=keys,
+                after=request.args.get("after"),
+                limit=int(limit),
+            )
+        except ValueError as exc:
+            raise APIException(str(exc))
+
+        # validators of this page, the cursor covers the rows after it
+        tag = etag(rows, cursor, fields)
+        last_modified = max((row.updated_at for row in rows), default=None)
+        if fields is not None:
+            rows = [serialize(row) for row in rows]
+        return conditional({"results": rows, "next": cursor}, tag, last_modified)
 
     @protected
     def get(self, id: str):
+        """
+        Honors If-None-Match with 304 Not Modified, see Base.version
+        """
         if not id.isdigit():
             raise APIException("The ID field must be an integer")
         id = int(id)
-        return self.get_queryset("get", **{self.pk_field: id}).one()
+
+        fields = self._fields()
+        query = self.get_queryset("get", **{self.pk_field: id})
+        if fields is not None:
+            query, serialize = self._project(query, fields, *VALIDATOR_FIELDS)
+
+        obj = query.one()
+        tag = etag([obj], fields)
+        return conditional(obj if fields is None else serialize(obj), tag, obj.updated_at)
+
+    def _filters(self):
+        """
+        Filters of the listing, (name, value) for every parameter that isn't reserved
+        """
+        return [(name, value) for name, value in request.args.items(multi=True) if name not in self.reserved_args]
+
+    @staticmethod
+    def _fields():
+        """
+        Columns requested with ?fields=a,b, None for all of them
+        """
+        return parse_fields(request.args.get("fields"))
+
+    @staticmethod
+    def _project(query, fields, *needed):
+        """
+        :return: (query reading only fields and the needed ones, serializer of fields)
+        """
+        try:
+            query = client._project(query, tuple(dict.fromkeys((*fields, *needed))))
+        except ValueError as exc:
+            raise APIException(str(exc))
+        return query, projection(fields)
 
     @protected
     def update(self, id):
@@ -152,7 +335,7 @@ class APIException(HTTPException):
         scope=None,
     ) -> str:
         """Get the HTML body."""
-        return encoder.encode(
+        return dumps(
             {"status_code": self.code, "errors": self.get_description()}
         )
 
@@ -178,18 +361,58 @@ def handle_not_found(e):
     return output_json(e.get_body(), e.code, e.get_headers())
 
 def get_auth_token(request):
-    return request.headers.get("Authorization", None)
+    token = request.headers.get("Authorization", None)
+    if token:
+        for scheme in ("Bearer ", "Token "):
+            if token.startswith(scheme):
+                return token[len(scheme):]
+    return token
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    if "start" in g:
+        metrics.http_seconds.observe(time.perf_counter() - g.start, (route, request.method))
+    metrics.http_requests.inc((route, request.method, str(response.status_code)))
+    return response
+
+@app.before_request
+def authenticate():
+    """
+    Resolve the Authorization header once per request into request.user (an AuthContext, or None)
+    """
+    request.user = None
+    token = get_auth_token(request)
+    if not token:
+        return
+
+    try:
+        request.user = client.auth_context(token)
+    except sqlalchemy.exc.NoResultFound:
+        exc = APIException("Invalid token")
+        exc.code = 401
+        raise exc
 
 def is_role(role_name):
     def is_role_decorator(fun):
-        def wraps(*args, **kwargs):
-            if request.user.group.name == role_name:
+        @wraps(fun)
+        def internal(*args, **kwargs):
+            if request.user is None:
+                exc = APIException("Authentication required")
+                exc.code = 401
+                raise exc
+
+            if request.user.group == role_name:
                 return fun(*args, **kwargs)
 
             exc = APIException("Insufficient credentials") # not allowed
             exc.code = 403
             raise exc
-        return wraps
+        return internal
     return is_role_decorator
 
 def is_admin():
@@ -203,7 +426,55 @@ class SucursalAPIView(APIView):
 	pass
     
 class RegistroAPIView(APIView):
-	pass
+    cursor_fields = ("id_sucursal", "fecha")
+
+    @route("/bulk/", methods=["POST"])
+    @protected
+    def bulk(self):
+        """
+        Insert a list of readings at once. Invalid rows are reported by index, the rest are stored.
+        """
+        rows = request.json
+        if not isinstance(rows, list):
+            raise APIException("A list of readings is required")
+        if len(rows) > settings.BULK_MAX_ROWS:
+            raise APIException(f"At most {settings.BULK_MAX_ROWS} readings are allowed per request")
+
+        return client.bulk_create_registro(rows)
+
+class AlertaAPIView(APIView):
+    """
+    Over limit alerts, ?sucursal=<id> lists the ones of a single branch.
+    They are derived from the readings (see refresh_alertas), so only reading them
+    and acknowledging them is routed, the other methods answer 405.
+    """
+    cursor_fields = ("id_sucursal", "fecha")
+    excluded_methods = [*APIView.excluded_methods, "post", "update", "delete"]
+    reserved_args = (*APIView.reserved_args, "sucursal")
+
+    @staticmethod
+    def _sucursales():
+        sucursal = request.args.get("sucursal")
+        if sucursal is None:
+            return None
+        if not sucursal.isdigit():
+            raise APIException("The sucursal field must be an integer")
+        return [int(sucursal)]
+
+    def _filters(self):
+        sucursales = self._sucursales()
+        filters = super()._filters()
+        return filters if sucursales is None else [*filters, ("id_sucursal", str(sucursales[0]))]
+
+    @cached(lambda self: self._sucursales())
+    def index(self):
+        return super().index()
+
+    @route("/<id>/acknowledge/", methods=["POST"])
+    @protected
+    def acknowledge(self, id):
+        alerta = self.get_queryset("get", **{self.pk_field: id}).one()
+        return client.acknowledge_alerta(alerta).as_dict()
 
 class EquipoAPIView(APIView):
     pass
@@ -229,6 +500,51 @@ class UserAPIView(APIView):
 class GroupAPIView(APIView):
     pass
 
+class ReportAPIView(APIView):
+    """
+    Analytics over the readings. Branches are selected with ?sucursal=<id> (repeatable), all by default.
+    """
+
+    REPORTS = ("forecast", "over-limit")
+
+    def get_queryset(self, method, *args, **kwargs):
+        """
+        get_queryset is invalid for this view
+        """
+        raise APIException("nothing to see here")
+
+    @staticmethod
+    def _sucursales():
+        ids = request.args.getlist("sucursal")
+        if not all(id.isdigit() for id in ids):
+            raise APIException("The sucursal field must be an integer")
+        return [int(id) for id in ids] or None
+
+    def index(self):
+        return list(self.REPORTS)
+
+    @staticmethod
+    def _month():
+        anio = request.args.get("anio", "")
+        mes = request.args.get("mes", "")
+        if not (anio.isdigit() and mes.isdigit() and 1 <= int(mes) <= 12):
+            raise APIException("The fields ('anio', 'mes') are required")
+        return int(anio), int(mes)
+
+    @route("/over-limit/")
+    @cached(lambda self: None)
+    @protected
+    def over_limit(self):
+        """Branches over their limit during ?anio=&mes="""
+        return client.over_consumption(*self._month())
+
+    @route("/forecast/")
+    @cached(lambda self: self._sucursales())
+    @protected
+    def forecast(self):
+        """Consumption forecast for the next quarter"""
+        return client.predict_consumption(self._sucursales())
+
 class PluginAPIView(APIView):
 
     PLUGIN_FOLDER = "plugins"
@@ -264,7 +580,9 @@ class PluginAPIView(APIView):
 
         controller = plugin.Controller
 
+        start = time.perf_counter()
         result = controller.export(data)
+        metrics.plugin_seconds.observe(time.perf_counter() - start, (name,))
 
         sys.path.remove(str(lib))
         sys.path.remove(str(lib64))
@@ -287,6 +605,38 @@ class PluginAPIView(APIView):
             "data": base64.b64encode(result).decode("utf8"),
         }
 
+class BackupAPIView(APIView):
+
+    def get_queryset(self, method, *args, **kwargs):
+        """
+        get_queryset is invalid for this view
+        """
+        raise APIException("nothing to see here")
+
+    @staticmethod
+    def _url():
+        return client.engine.url.render_as_string(hide_password=False)
+
+    @is_admin()
+    def index(self):
+        """Progress of the running backup, if any, and the snapshots kept"""
+        return {
+            **backup.BackupJob(settings.BACKUP_DIR).status(),
+            "snapshots": [path.name for path in backup.snapshots(settings.BACKUP_DIR, self._url())],
+        }
+
+    @is_admin()
+    def post(self):
+        """Start an online backup in the background, GET reports its progress"""
+        job = backup.BackupJob(settings.BACKUP_DIR)
+        try:
+            job.start(url=self._url())
+        except backup.BackupRunning as running:
+            exc = APIException(str(running))
+            exc.code = 409
+            raise exc
+        return job.status(), 202
+
 
 # populate urls
 _loc = locals().copy()
@@ -301,7 +651,39 @@ for namespace in _keys:
 def index():
     return "OK"
 
+def render_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@api.route("/metrics")
+def metrics_view():
+    """Metrics of every worker, admin only unless METRICS_PUBLIC"""
+    if settings.METRICS_PUBLIC:
+        return render_metrics()
+    return is_admin()(render_metrics)()
+
 app.register_blueprint(api)
 
-def runserver():
-    app.run(port=5050)
+def runserver(argv=()):
+    """
+    Without options, run the development server.
+    --workers/--threads run the pre-forking production server instead.
+    """
+    parser = argparse.ArgumentParser(prog="mange runserver")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--workers", type=int, help="processes, one per core is a good start")
+    parser.add_argument("--threads", type=int, help="threads per process")
+    args = parser.parse_args(argv)
+
+    if args.workers is None and args.threads is None:
+        app.run(host=args.host, port=args.port)
+        return
+
+    serving.serve(
+        app,
+        host=args.host,
+        port=args.port,
+        workers=args.workers or 1,
+        threads=args.threads or 1,
+        on_exit=client.close,
+    )
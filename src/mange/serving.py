@@ -0,0 +1,163 @@
+"""
+Pre-forking WSGI server for production.
+
+The parent binds the listening socket and forks the workers, every worker
+serves requests from it with a bounded pool of threads and only accepts a
+connection when one of them is free. Workers must not
+inherit database connections, anything process bound (the Client) is
+created lazily after the fork. SIGTERM or SIGINT stops accepting new
+connections, lets the in flight requests finish and exits. The workers
+publish their metrics to a directory of the parent, see mange.metrics.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import BaseWSGIServer
+
+from mange import metrics
+
+log = logging.getLogger("global")
+
+RESPAWN_DELAY = 1  # seconds
+ACCEPT_WAIT = 0.5  # seconds waiting for a free thread before checking for shutdown
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug server handling each connection in a pool of ``threads`` threads.
+    A connection is only accepted when one of them is free: a busy worker leaves
+    the new ones in the shared listen backlog, for an idle worker to accept.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd=None):
+        super().__init__(host, port, app, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="mange")
+        self.free = threading.BoundedSemaphore(threads)
+        self._submitted = False
+
+    def _handle_request_noblock(self):
+        if not self.free.acquire(timeout=ACCEPT_WAIT):
+            return
+        self._submitted = False
+        try:
+            super()._handle_request_noblock()
+        finally:
+            # another worker accepted the connection, or it was rejected
+            if not self._submitted:
+                self.free.release()
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+        self._submitted = True
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.free.release()
+
+
+def listen(host, port, backlog=1024):
+    sock = socket.create_server((host, port), backlog=backlog)
+    sock.set_inheritable(True)
+    # workers race for every connection, the losers must not block in accept
+    sock.setblocking(False)
+    return sock
+
+
+def _serve(app, sock, threads, on_exit=None):
+    """Run a worker until SIGTERM/SIGINT, then drain it"""
+    server = PooledWSGIServer(*sock.getsockname()[:2], app, threads, fd=sock.fileno())
+
+    def stop(signum, frame):
+        # shutdown blocks until serve_forever returns, it can't run in its thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    server.serve_forever()  # closes the listening socket when it returns
+    server.pool.shutdown(wait=True)
+    if on_exit is not None:
+        on_exit()
+
+
+def _spawn(app, sock, threads, on_exit):
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            metrics.publish_every()
+            _serve(app, sock, threads, on_exit)
+        except BaseException:  # pylint: disable=broad-except
+            log.exception("worker %s crashed", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)  # never run the parent's code in the child
+    return pid
+
+
+def serve(app, host="127.0.0.1", port=5050, workers=1, threads=1, on_exit=None):
+    """
+    Serve ``app`` with ``workers`` processes of ``threads`` threads each.
+    Dead workers are replaced until the server is asked to stop.
+    :param on_exit: called in every worker after it stopped serving, to release its resources
+    """
+    sock = listen(host, port)
+    log.info("Listening on http://%s:%s (%s workers x %s threads)", host, port, workers, threads)
+
+    if workers <= 1 or not hasattr(os, "fork"):
+        if workers > 1:
+            log.warning("fork is not available, running a single worker")
+        _serve(app, sock, threads, on_exit)
+        sock.close()
+        return
+
+    stopping = False
+    children = set()
+    shared = tempfile.mkdtemp(prefix="mange-metrics-")
+    metrics.share(shared)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(workers):
+        children.add(_spawn(app, sock, threads, on_exit))
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        metrics.forget(pid)
+        if not stopping:
+            log.warning("worker %s exited with status %s, restarting it", pid, status)
+            time.sleep(RESPAWN_DELAY)  # don't spin if workers crash on start
+            children.add(_spawn(app, sock, threads, on_exit))
+
+    sock.close()
+    shutil.rmtree(shared, ignore_errors=True)
+    metrics.share(None)
+    log.info("Server stopped")
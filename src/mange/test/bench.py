@@ -0,0 +1,232 @@
+"""
+Benchmark suite.
+
+Builds seeded synthetic databases of N branches x years of daily readings,
+times the Client analytics and the main REST routes on each of them and
+writes the results as JSON so runs can be compared.
+"""
+import argparse
+from datetime import date, timedelta
+import json
+import logging
+import pathlib
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from mange.api import Client, report_cache
+from mange.db import Area, Base, Equipo, Sucursal
+from mange.serializers import dumps
+
+log = logging.getLogger("global")
+
+CHUNK = 5000
+
+
+def generate(client, sucursales, years, areas=2, equipos=5, seed=0, end=date(2020, 12, 31)):
+    """
+    Fill an empty database with ``sucursales`` branches, each with ``areas`` areas,
+    ``equipos`` pieces of equipment and a reading per day during ``years`` years up to ``end``.
+    """
+    rng = random.Random(seed)
+    start = date(end.year - years + 1, 1, 1)
+    days = (end - start).days + 1
+
+    client._bulk_create(Sucursal, [
+        {
+            "nombre": f"sucursal {index}",
+            "tipo": rng.choice(("oficina", "almacen", "tienda")),
+            "direccion": f"calle {index}",
+            "limite": rng.randint(2000, 6000),
+        }
+        for index in range(1, sucursales + 1)
+    ])
+    limites = {row.id: row.limite for row in client.get_sucursal()}
+
+    client._bulk_create(Area, [
+        {"nombre": f"area {area}", "responsable": "bench", "id_sucursal": id_sucursal}
+        for id_sucursal in limites
+        for area in range(areas)
+    ])
+    client._bulk_create(Equipo, [
+        {
+            "modelo": f"modelo {rng.randint(1, 50)}",
+            "consumo_diario_promedio": rng.randint(1, 40),
+            "fecha_instalacion": start + timedelta(days=rng.randrange(days)),
+            "tipo": rng.choice(("clima", "computo", "iluminacion")),
+        }
+        for _ in limites
+        for _ in range(equipos)
+    ])
+
+    chunk = []
+    for id_sucursal, limite in limites.items():
+        lectura = 0
+        mes = None
+        for day in range(days):
+            fecha = start + timedelta(days=day)
+            if fecha.month != mes:
+                mes, acumulado = fecha.month, 0
+            consumo = max(0, int(rng.gauss(limite / 28, limite / 100)))
+            excedido = max(0, acumulado + consumo - limite) - max(0, acumulado - limite)
+            acumulado += consumo
+            lectura += consumo
+            chunk.append({
+                "id_sucursal": id_sucursal,
+                "fecha": fecha,
+                "lectura": lectura,
+                "costo": consumo * 2,
+                "sobre_limite": excedido,
+            })
+            if len(chunk) == CHUNK:
+                client.bulk_create_registro(chunk)
+                chunk = []
+    if chunk:
+        client.bulk_create_registro(chunk)
+
+    return start, end
+
+
+def timeit(function, repeat):
+    times = []
+    for run in range(repeat):
+        # every run computes its reports, as before the report cache existed
+        report_cache.clear()
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+        if run == 0:
+            check(result)
+    return {"min": min(times), "median": statistics.median(times), "max": max(times)}
+
+
+def check(result):
+    """Fail on an HTTP case that didn't succeed, its timing would be meaningless"""
+    status = getattr(result, "status_code", 200)
+    if status != 200:
+        raise RuntimeError(f"{result.request.method} {result.request.full_path} answered {status}")
+
+
+def cases(client, http, start, end):
+    """(name, callable) of everything that is measured"""
+    ids = [row.id for row in client.get_sucursal().limit(10)]
+    last = end.replace(day=1)
+    registros = client.get_registro().limit(10000).all()
+    return [
+        ("client.total_consumption", lambda: client.total_consumption(ids, start, end)),
+        ("client.average_consumption", lambda: client.average_consumption(ids, start, end)),
+        ("client.yearly_consumption", lambda: client.yearly_consumption(ids, start.year, end.year)),
+        ("client.over_consumption", lambda: client.over_consumption(last.year, last.month)),
+        ("client.predict_consumption", lambda: client.predict_consumption(today=end)),
+        ("client.list_alerts", lambda: client.list_alerts(ids[0])),
+        ("serializers.dumps 10k registro", lambda: dumps(registros)),
+        ("GET /api/registro/", lambda: http.get("/api/registro/?limit=1000")),
+        ("GET /api/equipo/", lambda: http.get("/api/equipo/?limit=1000")),
+        ("GET /api/alerta/", lambda: http.get(f"/api/alerta/?sucursal={ids[0]}")),
+        ("GET /api/report/over-limit/", lambda: http.get(f"/api/report/over-limit/?anio={last.year}&mes={last.month}")),
+        ("GET /api/report/forecast/", lambda: http.get("/api/report/forecast/")),
+    ]
+
+
+def run(sizes, repeat=5, areas=2, equipos=5, seed=0, directory=None):
+    """
+    :param sizes: list of (branches, years)
+    :return: JSON serializable results
+    """
+    from mange import server
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": seed,
+        "sizes": [],
+    }
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        for sucursales, years in sizes:
+            path = pathlib.Path(tmp) / f"bench_{sucursales}x{years}.sqlite3"
+            url = f"sqlite:///{path}"
+            Base.metadata.create_all(create_engine(url))
+
+            client = Client(url=url)
+            begin = time.perf_counter()
+            start, end = generate(client, sucursales, years, areas, equipos, seed)
+            elapsed = time.perf_counter() - begin
+            rows = client.get_registro().count()
+            log.info("generated %s readings in %.1fs (%.0f rows/s)", rows, elapsed, rows / elapsed)
+
+            previous, server.client = server.client, client
+            try:
+                http = server.app.test_client()
+                timings = {name: timeit(function, repeat) for name, function in cases(client, http, start, end)}
+            finally:
+                server.client = previous
+                client.session.remove()
+                client.engine.dispose()
+
+            for name, timing in timings.items():
+                log.info("%sx%s %-30s %.4fs", sucursales, years, name, timing["median"])
+
+            results["sizes"].append({
+                "sucursales": sucursales,
+                "years": years,
+                "registros": rows,
+                "generate_seconds": elapsed,
+                "timings": timings,
+            })
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of (size, case, ratio) whose median is more than ``tolerance`` times the baseline one
+    """
+    previous = {
+        (size["sucursales"], size["years"]): size["timings"] for size in baseline["sizes"]
+    }
+    regressions = []
+    for size in results["sizes"]:
+        key = (size["sucursales"], size["years"])
+        for name, timing in size["timings"].items():
+            before = previous.get(key, {}).get(name)
+            if before and before["median"] > 0:
+                ratio = timing["median"] / before["median"]
+                if ratio > tolerance:
+                    regressions.append((f"{key[0]}x{key[1]}", name, ratio))
+    return regressions
+
+
+def parse_sizes(value):
+    return [tuple(int(part) for part in size.split("x")) for size in value.split(",")]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="mange bench")
+    parser.add_argument("--sizes", type=parse_sizes, default=parse_sizes("10x1,100x3"),
+                        help="comma separated <branches>x<years>, default 10x1,100x3")
+    parser.add_argument("--areas", type=int, default=2, help="areas per branch")
+    parser.add_argument("--equipos", type=int, default=5, help="equipment per branch")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_output.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="fail when a median is more than this times the baseline one")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeat, args.areas, args.equipos, args.seed)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+    log.info("results written to %s", args.output)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for size, name, ratio in regressions:
+            log.error("regression %s %s: %.2fx slower", size, name, ratio)
+        if regressions:
+            sys.exit(1)
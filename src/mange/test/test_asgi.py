@@ -0,0 +1,154 @@
+from datetime import date
+import asyncio
+import json
+import unittest
+
+from mange.test.test_db import ENGINE, build_test_db
+
+build_test_db()
+
+from mange.api import Client
+from mange.asgi import ReadOnlyApp, async_url
+
+
+class Test_ASGI(unittest.TestCase):
+
+    def setUp(self):
+        build_test_db()
+        self.client = Client(url=ENGINE)
+        self.app = ReadOnlyApp(url=ENGINE)
+
+    def tearDown(self):
+        self.client.session.remove()
+        self.client.engine.dispose()
+
+    def request(self, path, query="", method="GET", headers=()):
+        """:return: (status, decoded body)"""
+        status, _, body = self.response(path, query, method, headers)
+        return status, json.loads(body)
+
+    def response(self, path, query="", method="GET", headers=()):
+        """:return: (status, headers, body bytes) of all the body messages"""
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": query.encode(),
+            "headers": [(key.lower().encode(), value.encode()) for key, value in headers],
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        async def call():
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                # the engine is bound to this event loop
+                await self.app.close()
+
+        asyncio.run(call())
+        start, *bodies = messages
+        self.assertFalse(bodies[-1].get("more_body", False))
+        headers = {key.decode(): value.decode() for key, value in start["headers"]}
+        return start["status"], headers, b"".join(body["body"] for body in bodies)
+
+    def create_sucursales(self, n):
+        for index in range(n):
+            self.client.create_sucursal(
+                nombre=f"sucursal {index}", tipo="oficina", direccion="calle", limite=100
+            )
+
+    def test_async_url(self):
+        self.assertEqual(async_url("sqlite:///a.sqlite3"), "sqlite+aiosqlite:///a.sqlite3")
+        self.assertEqual(async_url("sqlite+pysqlite:///a.sqlite3"), "sqlite+aiosqlite:///a.sqlite3")
+
+    def test_index_paginates(self):
+        self.create_sucursales(3)
+
+        status, page = self.request("/api/sucursal/", "limit=2")
+        self.assertEqual(status, 200)
+        self.assertEqual([row["id"] for row in page["results"]], [1, 2])
+
+        status, page = self.request("/api/sucursal/", f"limit=2&after={page['next']}")
+        self.assertEqual([row["id"] for row in page["results"]], [3])
+        self.assertIsNone(page["next"])
+
+    def test_index_streams(self):
+        self.create_sucursales(3)
+
+        status, _, body = self.response("/api/sucursal/", "stream=1&fields=id")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), [{"id": 1}, {"id": 2}, {"id": 3}])
+
+        build_test_db()
+        self.assertEqual(self.request("/api/sucursal/", "stream=1"), (200, []))
+
+    def test_conditional_get(self):
+        self.create_sucursales(2)
+
+        status, headers, _ = self.response("/api/sucursal/1/")
+        tag = headers["etag"]
+        self.assertIn("last-modified", headers)
+        status, _, body = self.response("/api/sucursal/1/", headers=[("If-None-Match", tag)])
+        self.assertEqual((status, body), (304, b""))
+
+        _, page, _ = self.response("/api/sucursal/", "limit=1")
+        self.assertEqual(self.response("/api/sucursal/", "limit=1", headers=[("If-None-Match", page["etag"])])[0], 304)
+        # a projection is another representation
+        self.assertNotEqual(self.response("/api/sucursal/1/", "fields=id")[1]["etag"], tag)
+
+        self.client.update(self.client.get_sucursal(id=1).one(), limite=1000)
+        self.client.session.commit()
+        self.assertEqual(self.response("/api/sucursal/1/", headers=[("If-None-Match", tag)])[0], 200)
+        self.assertEqual(self.response("/api/sucursal/", "limit=1", headers=[("If-None-Match", page["etag"])])[0], 200)
+
+    def test_get(self):
+        self.create_sucursales(1)
+        self.client.bulk_create_registro([
+            {"id_sucursal": 1, "fecha": date(2000, 10, 1), "lectura": 1, "costo": 0, "sobre_limite": 0},
+        ])
+
+        status, row = self.request("/api/registro/1/")
+        self.assertEqual(status, 200)
+        self.assertEqual(row["fecha"], "2000-10-01")
+
+        self.assertEqual(self.request("/api/registro/1/", "fields=lectura")[1], {"lectura": 1})
+        self.assertEqual(self.request("/api/registro/", "fields=fecha")[1]["results"], [{"fecha": "2000-10-01"}])
+        self.assertEqual(self.request("/api/registro/", "fields=nope")[0], 400)
+        self.assertEqual(self.request("/api/registro/", "fecha__gt=2000-10-01")[1]["results"], [])
+        self.assertEqual(self.request("/api/registro/", "fecha__gt=2000-10-01&sort=id")[0], 400)
+        self.assertEqual(self.request("/api/registro/", "lectura=1")[0], 400)
+        self.assertEqual(self.request("/api/registro/2/")[0], 404)
+        self.assertEqual(self.request("/api/registro/x/")[0], 400)
+        self.assertEqual(self.request("/api/nothing/")[0], 404)
+
+    def test_over_limit(self):
+        self.create_sucursales(2)
+        self.client.bulk_create_registro([
+            {"id_sucursal": 2, "fecha": date(2000, 10, 1), "lectura": 0, "costo": 0, "sobre_limite": 0},
+            {"id_sucursal": 2, "fecha": date(2000, 10, 31), "lectura": 150, "costo": 0, "sobre_limite": 50},
+        ])
+
+        status, rows = self.request("/api/report/over-limit/", "anio=2000&mes=10")
+        self.assertEqual(status, 200)
+        self.assertEqual(rows, self.client.over_consumption(2000, 10))
+        self.assertEqual(self.request("/api/report/over-limit/", "anio=2000")[0], 400)
+
+    def test_rejects_writes_and_bad_tokens(self):
+        self.assertEqual(self.request("/api/sucursal/", method="POST")[0], 405)
+        status, body = self.request("/api/sucursal/", headers=[("Authorization", "Bearer nope")])
+        self.assertEqual(status, 401)
+        self.assertEqual(body["errors"], "Invalid token")
+
+
+def main_suite() -> unittest.TestSuite:
+    s = unittest.TestSuite()
+    load_from = unittest.defaultTestLoader.loadTestsFromTestCase
+    s.addTests(load_from(Test_ASGI))
+
+    return s
@@ -0,0 +1,106 @@
+import pathlib
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from mange.test.test_db import ENGINE, build_test_db
+
+build_test_db()
+
+from mange import backup
+from mange.conf import settings
+from mange.server import app, client
+
+
+class Test_Backup(unittest.TestCase):
+
+    def setUp(self):
+        build_test_db()
+        client.session.remove()
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.dir.name)
+        client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=100)
+
+    def tearDown(self):
+        client.session.remove()
+        self.dir.cleanup()
+
+    def query(self, path, sql):
+        connection = sqlite3.connect(path)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_backup(self):
+        steps = []
+        path = backup.backup(ENGINE, self.path / "copy.sqlite3", pages=1, sleep=0,
+                             progress=lambda remaining, total: steps.append(remaining))
+
+        self.assertEqual(self.query(path, "SELECT nombre FROM sucursal"), [("blobcorp",)])
+        # one page per step, until nothing remains
+        self.assertGreater(len(steps), 1)
+        self.assertEqual(steps[-1], 0)
+        self.assertEqual([p.name for p in self.path.iterdir()], ["copy.sqlite3"])
+
+    def test_rotation(self):
+        stem = backup.database_path(ENGINE).stem
+        for day in range(1, 4):
+            (self.path / f"{stem}-2000010{day}-000000.sqlite3").touch()
+
+        path = backup.snapshot(ENGINE, self.path, keep=2, sleep=0)
+
+        self.assertEqual(
+            [p.name for p in backup.snapshots(self.path, ENGINE)],
+            [f"{stem}-20000103-000000.sqlite3", path.name],
+        )
+
+    def test_one_at_a_time(self):
+        with backup.BackupLock(self.path):
+            self.assertTrue(backup.BackupJob(self.path).status()["running"])
+            with self.assertRaises(backup.BackupRunning):
+                backup.snapshot(ENGINE, self.path, sleep=0)
+            with self.assertRaises(backup.BackupRunning):
+                backup.BackupJob(self.path).start(ENGINE, sleep=0)
+        self.assertFalse(backup.BackupJob(self.path).status()["running"])
+
+        # back to back snapshots get their own names
+        first = backup.snapshot(ENGINE, self.path, sleep=0)
+        second = backup.snapshot(ENGINE, self.path, sleep=0)
+        self.assertEqual(backup.snapshots(self.path, ENGINE), [first, second])
+
+    def test_endpoint(self):
+        http = app.test_client()
+        token = client.create_user(name="blob", password="doko").token.value
+        self.assertEqual(http.get("/api/backup/").status_code, 401)
+        self.assertEqual(http.post("/api/backup/", headers={"Authorization": token}).status_code, 403)
+
+        admin = client.create_group(name="Admin")
+        token = client.create_user(name="admin", password="doko", group=admin).token.value
+        directory, settings.BACKUP_DIR = settings.BACKUP_DIR, self.path
+        try:
+            with backup.BackupLock(self.path):
+                self.assertEqual(http.post("/api/backup/", headers={"Authorization": token}).status_code, 409)
+
+            self.assertEqual(http.post("/api/backup/", headers={"Authorization": token}).status_code, 202)
+            for _ in range(100):
+                status = http.get("/api/backup/", headers={"Authorization": token}).json
+                if not status["running"]:
+                    break
+                time.sleep(0.05)
+        finally:
+            settings.BACKUP_DIR = directory
+
+        self.assertFalse(status["running"])
+        self.assertIsNone(status["error"])
+        self.assertEqual(status["progress"], 100)
+        self.assertEqual(status["snapshots"], [pathlib.Path(status["last"]).name])
+
+
+def main_suite() -> unittest.TestSuite:
+    s = unittest.TestSuite()
+    load_from = unittest.defaultTestLoader.loadTestsFromTestCase
+    s.addTests(load_from(Test_Backup))
+
+    return s
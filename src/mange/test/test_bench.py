@@ -0,0 +1,39 @@
+import unittest
+
+from mange.test import bench
+from mange.test.test_db import build_test_db
+
+build_test_db()
+
+
+class Test_Bench(unittest.TestCase):
+
+    def test_run(self):
+        results = bench.run([(2, 1)], repeat=1, areas=1, equipos=1)
+
+        size, = results["sizes"]
+        self.assertEqual(size["registros"], 2 * 366)
+        self.assertIn("client.over_consumption", size["timings"])
+        self.assertIn("GET /api/registro/", size["timings"])
+        self.assertTrue(all(timing["min"] > 0 for timing in size["timings"].values()))
+
+        slower = {"sizes": [dict(size, timings={
+            name: dict(timing, median=timing["median"] * 3) for name, timing in size["timings"].items()
+        })]}
+        self.assertEqual(bench.compare(results, results, 1.5), [])
+        self.assertEqual(len(bench.compare(slower, results, 1.5)), len(size["timings"]))
+
+    def test_failed_request(self):
+        from mange.server import app
+
+        http = app.test_client()
+        with self.assertRaisesRegex(RuntimeError, "GET /api/nothing/.* answered 404"):
+            bench.timeit(lambda: http.get("/api/nothing/"), 1)
+
+
+def main_suite() -> unittest.TestSuite:
+    s = unittest.TestSuite()
+    load_from = unittest.defaultTestLoader.loadTestsFromTestCase
+    s.addTests(load_from(Test_Bench))
+
+    return s
@@ -1,11 +1,15 @@
-from datetime import datetime
+from datetime import date, datetime
+from decimal import Decimal
+import json
 import os
 from pathlib import Path
 import unittest
+from unittest import mock
 
 from mange.db import *
 from mange.api import *
 from mange.conf import settings
+from mange.serializers import dumps
 
 db = settings.DATABASES["default"]
 ENGINE = db["engine"]
@@ -41,6 +45,301 @@ class Test_API(unittest.TestCase):
 
         self.assertEqual(self.client.login(name="blob", password="doko"), user.token)
 
+    def test_paginate_registro(self):
+        for id_sucursal in (1, 2):
+            self.client.create_sucursal(
+                nombre=f"sucursal {id_sucursal}", tipo="oficina", direccion="calle", limite=100
+            )
+            for day in (1, 2, 3):
+                self.client.create_registro(
+                    id_sucursal=id_sucursal, fecha=date(2000, 10, day), lectura=day, costo=0, sobre_limite=0
+                )
+
+        keys = ("id_sucursal", "fecha")
+        seen = []
+        cursor = None
+        while True:
+            rows, cursor = self.client._paginate(
+                self.client.get_registro(), keys=keys, after=cursor, limit=4
+            )
+            seen.extend((row.id_sucursal, row.fecha.day) for row in rows)
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, [(s, d) for s in (1, 2) for d in (1, 2, 3)])
+
+    def test_bulk_create_registro(self):
+        self.client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=100)
+        rows = [
+            {"id_sucursal": 1, "fecha": f"2000-10-{day:02}", "lectura": day, "costo": 0, "sobre_limite": 0}
+            for day in range(1, 11)
+        ]
+        rows[3]["fecha"] = "not a date"
+        rows[5] = dict(rows[4])  # duplicated natural key
+        del rows[7]["lectura"]
+
+        result = self.client.bulk_create_registro(rows)
+
+        self.assertEqual(result["created"], 7)
+        self.assertEqual([error["index"] for error in result["errors"]], [3, 5, 7])
+        self.assertEqual(self.client.get_registro().count(), 7)
+
+    def test_report_queries_are_indexed(self):
+        connection = self.client.session.connection()
+        queries = [
+            self.client.get_registro(id_sucursal=1)
+            .filter(Registro.fecha >= date(2000, 1, 1), Registro.fecha <= date(2000, 12, 31)),
+            self.client.get_registro(id_sucursal=1).filter(OVER_LIMIT),
+            self.client.get_registro().filter(OVER_LIMIT),
+            self.client.get_registro().filter(Registro.fecha == date(2000, 1, 1)),
+            self.client.get_alerta(id_sucursal=1).order_by(Alerta.fecha),
+        ]
+        for query in queries:
+            assert_indexed(connection, query)
+        assert_indexed(connection, consumption_stmt([1, 2], date(2000, 1, 1), date(2000, 12, 31)))
+        assert_indexed(connection, over_consumption_stmt(2000, 1))
+
+        with self.assertRaises(FullScanError):
+            assert_indexed(connection, self.client.get_registro(lectura=1))
+
+    def test_filters_are_indexed(self):
+        # every filter and sort the listings accept is a walk of one index, on the first and the next pages
+        connection = self.client.session.connection()
+        row = {"id": 5, "id_sucursal": 1, "fecha": date(2000, 1, 1), "anio": 2000, "mes": 1}
+        for Obj, default in (
+            (Sucursal, ("id",)), (Registro, ("id_sucursal", "fecha")), (Area, ("id",)),
+            (Alerta, ("id_sucursal", "fecha")), (ConsumoMensual, ("id",)), (Token, ("id",)),
+        ):
+            for field in indexed_columns(Obj):
+                column = getattr(Obj, field)
+                value = {int: "1", float: "1", str: "a", date: "2000-01-01", datetime: "2000-01-01"}
+                value = value[column.type.python_type]
+                sorts = [None] + [key for key in indexed_columns(Obj) if not getattr(Obj, key).nullable]
+                for operator in ("", "__gte", "__in"):
+                    params = [(field + operator, value if operator != "__in" else f"{value},{value}")]
+                    for sort in sorts:
+                        try:
+                            keys = sort_keys(Obj, sort) if sort else default
+                            keys = filter_keys(Obj, params, keys, rekey=sort is None)
+                        except ValueError:
+                            self.assertIsNotNone(sort)  # without ?sort= some index always fits
+                            continue
+                        query = self.client._filter(self.client._get(Obj), params)
+                        for after in (None, encode_cursor([row.get(key.lstrip("-"), "a") for key in keys])):
+                            plan = assert_indexed(connection, keyset(query, Obj, keys, after, 10))
+                            if not (field in unique_columns(Obj) and operator != "__gte"):
+                                self.assertFalse([detail for detail in plan if "TEMP B-TREE" in detail], (params, keys, plan))
+
+        # a range only bounds the first sort field, the default sort follows it
+        params = [("fecha__gte", "2000-01-01")]
+        self.assertEqual(filter_keys(Registro, params, ("id_sucursal", "fecha"), rekey=True), ("fecha", "id"))
+        with self.assertRaises(ValueError):
+            filter_keys(Registro, params, ("id_sucursal", "fecha"))
+        self.assertEqual(filter_keys(Registro, [("id_sucursal", "1"), *params], ("id_sucursal", "fecha")), ("id_sucursal", "fecha"))
+        self.assertEqual(filter_keys(Sucursal, [("nombre__startswith", "blob")], ("id",), rekey=True), ("nombre", "id"))
+        self.assertEqual(filter_keys(ConsumoMensual, [("anio", "2000")], ("id",), rekey=True), ("mes", "id"))
+        with self.assertRaises(ValueError):
+            filter_keys(Registro, [("id_sucursal__gte", "1"), *params], ("id_sucursal", "fecha"), rekey=True)
+
+        with self.assertRaises(ValueError):
+            self.client._filter(self.client._get(Registro), [("lectura__gte", "1")])
+        with self.assertRaises(ValueError):
+            self.client._filter(self.client._get(Registro), [("fecha__between", "1")])
+        with self.assertRaises(ValueError):
+            self.client._filter(self.client._get(Registro), [("fecha", "yesterday")])
+
+    def test_sort_keys(self):
+        self.assertEqual(sort_keys(Registro, "-fecha"), ("-fecha", "-id"))
+        self.assertEqual(sort_keys(Registro, "-id_sucursal,-id"), ("-id_sucursal", "-id"))
+        self.assertEqual(sort_keys(Sucursal, "-nombre,id"), ("-nombre", "id"))
+        with self.assertRaises(ValueError):
+            sort_keys(Registro, "lectura")
+        with self.assertRaises(ValueError):
+            sort_keys(Registro, "id_sucursal,-id")
+
+        # deep pages of every accepted sort are searched in an index, never sorted
+        connection = self.client.session.connection()
+        row = {"id": 5, "id_sucursal": 1, "fecha": date(2000, 1, 1), "nombre": "a"}
+        for Obj, sort in (
+            (Registro, "fecha"), (Registro, "-fecha"), (Registro, "-id_sucursal,-fecha"),
+            (Sucursal, "-nombre"), (Sucursal, "-nombre,id"),
+        ):
+            keys = sort_keys(Obj, sort)
+            after = encode_cursor([row[key.lstrip("-")] for key in keys])
+            plan = assert_indexed(connection, keyset(self.client._get(Obj), Obj, keys, after, 10))
+            self.assertFalse([detail for detail in plan if "TEMP B-TREE" in detail], (sort, plan))
+
+        for sucursal in range(3):
+            self.client.create_sucursal(nombre=f"s{sucursal}", tipo="oficina", direccion="calle", limite=100)
+        keys = sort_keys(Sucursal, "-nombre")
+        rows, cursor = self.client._paginate(self.client.get_sucursal(), keys=keys, limit=2)
+        self.assertEqual([row.nombre for row in rows], ["s2", "s1"])
+        rows, cursor = self.client._paginate(self.client.get_sucursal(), keys=keys, after=cursor, limit=2)
+        self.assertEqual([row.nombre for row in rows], ["s0"])
+        self.assertIsNone(cursor)
+
+    def rollup(self):
+        return {
+            (row.anio, row.mes): (row.consumo, row.costo, row.registros)
+            for row in self.client.session.query(ConsumoMensual)
+        }
+
+    def test_consumo_mensual(self):
+        self.client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=100)
+        for day, lectura in ((1, 100), (20, 150)):
+            self.client.create_registro(
+                id_sucursal=1, fecha=date(2000, 10, day), lectura=lectura, costo=1, sobre_limite=0
+            )
+        self.assertEqual(self.rollup(), {(2000, 10): (50, 2, 2)})
+
+        self.client.bulk_create_registro([
+            {"id_sucursal": 1, "fecha": "2000-11-05", "lectura": 180, "costo": 1, "sobre_limite": 0},
+            {"id_sucursal": 1, "fecha": "2000-11-30", "lectura": 230, "costo": 1, "sobre_limite": 0},
+        ])
+        self.assertEqual(self.rollup(), {(2000, 10): (50, 2, 2), (2000, 11): (80, 2, 2)})
+
+        # moving the last reading of october to november shifts the baseline of november
+        registro = self.client.get_registro(fecha=date(2000, 10, 20)).one()
+        self.client.update(registro, fecha=date(2000, 11, 1))
+        self.client.session.commit()
+        self.assertEqual(self.rollup(), {(2000, 10): (0, 1, 1), (2000, 11): (130, 3, 3)})
+
+        for registro in self.client.get_registro().filter(Registro.fecha < date(2000, 11, 2)):
+            self.client.session.delete(registro)
+        self.client.session.commit()
+        self.assertEqual(self.rollup(), {(2000, 11): (50, 2, 2)})
+
+        self.assertEqual(
+            self.client.yearly_consumption([1], 2000, 2000),
+            {1: {2000: {"consumo_promedio": 50, "costo": 2, "sobre_limite": 0}}},
+        )
+
+    def test_baseline_moves_validators(self):
+        self.client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=100)
+        self.client.bulk_create_registro([
+            {"id_sucursal": 1, "fecha": "2000-10-01", "lectura": 100, "costo": 1, "sobre_limite": 0},
+            {"id_sucursal": 1, "fecha": "2000-10-31", "lectura": 200, "costo": 1, "sobre_limite": 0},
+            {"id_sucursal": 1, "fecha": "2000-11-30", "lectura": 330, "costo": 1, "sobre_limite": 0},
+        ])
+        november = self.client.session.query(ConsumoMensual).filter_by(anio=2000, mes=11).one()
+        version, updated_at = november.version, november.updated_at
+
+        # october still ends at 200, november keeps its consumption and its validators
+        self.client.create_registro(id_sucursal=1, fecha=date(2000, 10, 15), lectura=150, costo=1, sobre_limite=0)
+        self.client.session.refresh(november)
+        self.assertEqual((november.consumo, november.version, november.updated_at), (130, version, updated_at))
+
+        # only the baseline of november moves
+        self.client.update(self.client.get_registro(fecha=date(2000, 10, 31)).one(), lectura=250)
+        self.client.session.commit()
+        self.client.session.refresh(november)
+        self.assertEqual(november.consumo, 80)
+        self.assertGreater(november.version, version)
+        self.assertGreater(november.updated_at, updated_at)
+
+    def test_alerts(self):
+        self.client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=100)
+        self.client.create_registro(id_sucursal=1, fecha=date(2000, 10, 1), lectura=90, costo=0, sobre_limite=0)
+        self.client.create_registro(id_sucursal=1, fecha=date(2000, 10, 2), lectura=120, costo=0, sobre_limite=20)
+        self.client.bulk_create_registro([
+            {"id_sucursal": 1, "fecha": "2000-10-03", "lectura": 130, "costo": 0, "sobre_limite": 30},
+        ])
+
+        alerts = self.client.list_alerts(1)
+        self.assertEqual([(alert.fecha.day, alert.exceso) for alert in alerts], [(2, 20), (3, 30)])
+
+        self.client.acknowledge_alerta(alerts[0])
+        registro = self.client.get_registro(fecha=date(2000, 10, 2)).one()
+        self.client.update(registro, sobre_limite=25)
+        registro = self.client.get_registro(fecha=date(2000, 10, 3)).one()
+        self.client.update(registro, sobre_limite=0)
+        self.client.session.commit()
+        self.client.session.expire_all()
+
+        alerts = self.client.list_alerts(self.client.get_sucursal(id=1).one())
+        self.assertEqual([(alert.fecha.day, alert.exceso, alert.reconocida) for alert in alerts], [(2, 25, True)])
+
+    def test_auth_context(self):
+        group = self.client.create_group(name="Admin")
+        user = self.client.create_user(name="blob", password="doko", group=group)
+        token = user.token.value
+
+        statements = []
+        listener = lambda *args: statements.append(args)
+        event.listen(self.client.engine, "before_cursor_execute", listener)
+        try:
+            self.assertEqual(self.client.auth_context(token), AuthContext(user.id, "blob", "Admin"))
+            self.assertEqual(self.client.auth_context(token).group, "Admin")
+            self.assertEqual(len(statements), 1)
+        finally:
+            event.remove(self.client.engine, "before_cursor_execute", listener)
+
+        # only a commit invalidates, a flush that is rolled back doesn't
+        group.name = "Staff"
+        self.client.session.flush()
+        self.assertEqual(auth_cache.get(token).group, "Admin")
+        self.client.session.rollback()
+        self.assertEqual(auth_cache.get(token).group, "Admin")
+
+        # a context read before a commit isn't cached after it
+        generation = auth_cache.generation
+        self.client.update(group, name="Staff")
+        self.client.session.commit()
+        auth_cache.set(token, AuthContext(user.id, "blob", "Admin"), (AUTH,), generation)
+        self.assertEqual(self.client.auth_context(token).group, "Staff")
+
+    def test_loggedmethod_sampling(self):
+        rate = settings.LOG_SAMPLE_RATE
+        settings.LOG_SAMPLE_RATE = 3
+        try:
+            with self.assertLogs(self.client.logger, "INFO") as logs:
+                for _ in range(6):
+                    self.client.get_sucursal(nombre="blobcorp")
+        finally:
+            settings.LOG_SAMPLE_RATE = rate
+
+        self.assertEqual(len([line for line in logs.output if "_GET_" in line]), 2)
+
+    def test_loggedmethod_disabled(self):
+        sucursal = self.client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=100)
+
+        level = self.client.logger.level
+        self.client.logger.setLevel("WARNING")
+        try:
+            with mock.patch.object(Sucursal, "__str__", side_effect=AssertionError("formatted a disabled log record")):
+                self.client.update(sucursal, limite=1)
+        finally:
+            self.client.logger.setLevel(level)
+
+        with self.assertRaises(IndexError):
+            self.client._get(Sucursal, Sucursal)
+
+    def test_pragmas(self):
+        with self.client.engine.connect() as connection:
+            pragma = lambda name: connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+            self.assertEqual(pragma("journal_mode"), "wal")
+            self.assertEqual(pragma("busy_timeout"), 5000)
+            self.assertEqual(pragma("temp_store"), 2)  # MEMORY
+
+        with self.assertRaises(ValueError):
+            get_engine(ENGINE, pragmas={"journal_mode": "WAL; DROP TABLE user"})
+
+    def test_serializer(self):
+        sucursal = self.client.create_sucursal(nombre="blob", tipo="oficina", direccion="calle", limite=100)
+        self.client.bulk_create_registro([
+            {"id_sucursal": sucursal.id, "fecha": date(2000, 10, 1), "lectura": 1, "costo": 0, "sobre_limite": 0},
+        ])
+        registro = self.client.get_registro().one()
+
+        row = json.loads(dumps([registro, Decimal("1.5")]))
+        self.assertEqual(row[0]["fecha"], "2000-10-01")
+        self.assertEqual(row[0]["updated_at"], registro.updated_at.isoformat())
+        self.assertEqual(row[1], 1.5)
+
+        # expired columns are loaded
+        self.client.session.expire(registro)
+        self.assertEqual(registro.as_dict()["lectura"], 1)
+
     def test_liquidate_bill(self):
         company = self.client.create_company(name="blobcorp", last_reading=0, reading=0, limit=100)
         self.client.session.commit()
@@ -58,36 +357,85 @@ class Test_API(unittest.TestCase):
         self.assertEqual(bill.over_limit, 50)
 
     def test_total_consumption(self):
-        company = self.client.create_company(name="blobcorp", last_reading=0, reading=100, limit=9999)
-        self.client.session.commit()
-
-        company.reading = 150
-        bill = self.client.liquidate_bill(company, date=datetime(2000, 10, 1))
-
-        company.reading = 300
-        bill = self.client.liquidate_bill(company, date=datetime(2000, 10, 2))
+        for name in ("blobcorp", "idlecorp", "emptycorp"):
+            self.client.create_sucursal(nombre=name, tipo="oficina", direccion="calle", limite=9999)
 
-        company.reading = 500
-        bill = self.client.liquidate_bill(company, date=datetime(2000, 10, 3))
+        for fecha, lectura in ((date(2000, 10, 1), 150), (date(2000, 10, 2), 300), (date(2000, 10, 3), 500)):
+            self.client.create_registro(id_sucursal=1, fecha=fecha, lectura=lectura, costo=0, sobre_limite=0)
+        self.client.create_registro(id_sucursal=2, fecha=date(2000, 10, 2), lectura=7, costo=0, sobre_limite=0)
 
         self.assertEqual(
             self.client.total_consumption(
-                company,
-                start_date=datetime(2000, 10, 1),
-                end_date=datetime(2000, 10, 3)
+                self.client.get_sucursal(id=1).one(),
+                start_date=date(2000, 10, 1),
+                end_date=date(2000, 10, 3)
             ),
             350,
         )
+        # no readings exactly on the boundaries
+        self.assertEqual(
+            self.client.total_consumption(
+                [1, 2, 3], start_date=date(2000, 9, 1), end_date=date(2000, 10, 2)
+            ),
+            {1: 150, 2: 0, 3: None},
+        )
+
+    def test_average_consumption(self):
+        self.client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=9999)
+        for fecha, lectura in ((date(2000, 1, 31), 100), (date(2000, 2, 15), 200), (date(2000, 3, 1), 400)):
+            self.client.create_registro(id_sucursal=1, fecha=fecha, lectura=lectura, costo=0, sobre_limite=0)
+
+        # 300 over the 30 days between january 31 and march 1
+        self.assertAlmostEqual(self.client.average_consumption(1, date(2000, 1, 1), date(2000, 12, 31)), 300 / (30 / MONTH_DAYS))
+        # the months without readings in between count
+        self.client.create_registro(id_sucursal=1, fecha=date(2000, 6, 1), lectura=700, costo=0, sobre_limite=0)
+        self.assertAlmostEqual(self.client.average_consumption(1, date(2000, 1, 1), date(2000, 12, 31)), 600 / (122 / MONTH_DAYS))
+        self.assertEqual(self.client.average_consumption(1, date(2000, 6, 1), date(2000, 12, 31)), None)
+        self.assertEqual(self.client.average_consumption([1], date(2001, 1, 1), date(2001, 12, 31)), {1: None})
+
+    def test_forecast(self):
+        today = date(2001, 1, 15)
+        current = 2001 * 12
+        rows = [(1, current - k, 1000 - 10 * k) for k in range(1, 13)]  # +10 every month
+        rows += [(2, current - 1, 50)]
+
+        result = forecast.forecast(rows, today)
+
+        # February, March and April, January is still in progress
+        self.assertAlmostEqual(result[1], 1010 + 1020 + 1030)
+        self.assertAlmostEqual(result[2], 150)
+
+    def test_predict_consumption(self):
+        self.client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=9999)
+        self.client.create_sucursal(nombre="emptycorp", tipo="oficina", direccion="calle", limite=9999)
+        lectura = 0
+        for mes in range(1, 13):
+            for day in (1, 28):
+                lectura += 100
+                self.client.create_registro(
+                    id_sucursal=1, fecha=date(2000, mes, day), lectura=lectura, costo=0, sobre_limite=0
+                )
+
+        # 200 every month but the first one, which has no previous month to compare with:
+        # the line through x = -12..-1 has slope 50/13 and intercept 650/3, summed over x = 1..3
+        self.assertAlmostEqual(self.client.predict_consumption(1, today=date(2001, 1, 1)), 3 * 650 / 3 + 6 * 50 / 13)
+        self.assertEqual(self.client.predict_consumption([2], today=date(2001, 1, 1)), {2: None})
+        self.assertEqual(list(self.client.predict_consumption(today=date(2001, 1, 1))), [1])
 
     def test_over_consumption(self):
-        company = self.client.create_company(name="blobcorp", last_reading=0, reading=1, limit=0)
-        self.client.session.commit()
-        bill = self.client.liquidate_bill(company, date=datetime(2000, 10, 1))
+        self.client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=100)
+        self.client.create_sucursal(nombre="idlecorp", tipo="oficina", direccion="calle", limite=100)
+        for id_sucursal, lecturas in ((1, (0, 50, 150)), (2, (0, 20, 60))):
+            for day, lectura in zip((1, 10, 20), lecturas):
+                self.client.create_registro(
+                    id_sucursal=id_sucursal, fecha=date(2000, 10, day), lectura=lectura, costo=0, sobre_limite=0
+                )
 
         self.assertEqual(
-            self.client.over_consumption(start_date=datetime(2000, 10, 1), end_date=datetime(2000, 10, 1)),
-            [bill],
+            self.client.over_consumption(2000, 10),
+            [{"id_sucursal": 1, "nombre": "blobcorp", "limite": 100, "consumo": 150, "exceso": 50}],
         )
+        self.assertEqual(self.client.over_consumption(2000, 11), [])
 
 
 
@@ -95,7 +443,31 @@ def main_suite() -> unittest.TestSuite:
     s = unittest.TestSuite()
     load_from = unittest.defaultTestLoader.loadTestsFromTestCase
     s.addTests(load_from(Test_API))
-    
+
+    from mange.test import test_server
+    s.addTests(test_server.main_suite())
+
+    from mange.test import test_importer
+    s.addTests(test_importer.main_suite())
+
+    from mange.test import test_bench
+    s.addTests(test_bench.main_suite())
+
+    from mange.test import test_serving
+    s.addTests(test_serving.main_suite())
+
+    from mange.test import test_asgi
+    s.addTests(test_asgi.main_suite())
+
+    from mange.test import test_migrations
+    s.addTests(test_migrations.main_suite())
+
+    from mange.test import test_backup
+    s.addTests(test_backup.main_suite())
+
+    from mange.test import test_dump
+    s.addTests(test_dump.main_suite())
+
     return s
 
 def run():
@@ -0,0 +1,120 @@
+from datetime import date
+import gzip
+import json
+import pathlib
+import sqlite3
+import tempfile
+import unittest
+
+from sqlalchemy.exc import IntegrityError
+
+from mange.api import Client
+from mange.dump import DumpError, dump, load
+from mange.migrations import migrate, schema_version
+
+
+class Test_Dump(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.dir.name)
+        self.source = f"sqlite:///{self.path / 'source.sqlite3'}"
+        self.target = f"sqlite:///{self.path / 'target.sqlite3'}"
+        self.dump = self.path / "dump.jsonl.gz"
+
+        migrate(self.source)
+        client = Client(url=self.source)
+        try:
+            client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=10)
+            client.bulk_create_registro([
+                {"id_sucursal": 1, "fecha": date(2000, 10, day), "lectura": 10 * day, "costo": 0, "sobre_limite": 0}
+                for day in range(1, 31)
+            ])
+        finally:
+            client.session.remove()
+            client.engine.dispose()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def query(self, url, sql):
+        connection = sqlite3.connect(url.removeprefix("sqlite:///"))
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_round_trip(self):
+        counts = dump(self.source, self.dump, chunk_size=7)
+        self.assertEqual(counts["registro"], 30)
+
+        self.assertEqual(load(self.target, self.dump), counts)
+        for table in ("sucursal", "registro", "consumo_mensual", "alerta"):
+            sql = f"SELECT * FROM {table} ORDER BY 1, 2"
+            self.assertEqual(self.query(self.target, sql), self.query(self.source, sql))
+
+        # the indexes were built and the schema version recorded
+        indexes = {name for name, in self.query(self.target, "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertIn("ix_registro_sucursal_fecha", indexes)
+        self.assertEqual(len(self.query(self.target, f"SELECT * FROM {schema_version.name}")), 1)
+        self.assertEqual(migrate(self.target), [])
+
+    def test_failed_dump_keeps_the_old_one(self):
+        dump(self.source, self.dump)
+        content = self.dump.read_bytes()
+        with sqlite3.connect(self.path / "source.sqlite3") as connection:
+            connection.execute("INSERT INTO schema_version VALUES (1000, 'other', '2000-01-01')")
+
+        with self.assertRaises(DumpError):
+            dump(self.source, self.dump)
+        self.assertEqual(self.dump.read_bytes(), content)
+        self.assertEqual(list(self.path.glob("*.partial")), [])
+
+    def test_load_keeps_rows(self):
+        dump(self.source, self.dump)
+
+        with self.assertRaises(DumpError):
+            load(self.source, self.dump)
+        self.assertEqual(load(self.source, self.dump, replace=True)["registro"], 30)
+        self.assertEqual(self.query(self.source, "SELECT count(*) FROM registro"), [(30,)])
+
+    def test_truncated(self):
+        dump(self.source, self.dump, chunk_size=7)
+        with gzip.open(self.dump, "rt") as lines:
+            head = lines.readlines()[:-3]
+        with gzip.open(self.dump, "wt") as out:
+            out.writelines(head)
+
+        with self.assertRaises(DumpError):
+            load(self.target, self.dump)
+        # nothing was loaded
+        self.assertEqual(self.query(self.target, "SELECT name FROM sqlite_master"), [])
+
+    def test_failed_index_rolls_back(self):
+        dump(self.source, self.dump)
+        with gzip.open(self.dump, "rt") as lines:
+            content = lines.readlines()
+        # a second reading of the same branch and day, the unique index can't be built
+        for number, line in enumerate(content):
+            if line.startswith('{"table":"registro"'):
+                columns = json.loads(line)["columns"]
+                rows = json.loads(content[number + 1])
+                duplicate = list(rows[0])
+                duplicate[columns.index("id")] = 1000
+                content[number + 1] = json.dumps(rows + [duplicate]) + "\n"
+                content[number + 2] = json.dumps({"end": "registro", "rows": len(rows) + 1}) + "\n"
+        with gzip.open(self.dump, "wt") as out:
+            out.writelines(content)
+
+        with self.assertRaises(IntegrityError):
+            load(self.target, self.dump)
+        # neither the rows nor a schema version without its indexes
+        self.assertEqual(self.query(self.target, "SELECT name FROM sqlite_master"), [])
+
+
+def main_suite() -> unittest.TestSuite:
+    s = unittest.TestSuite()
+    load_from = unittest.defaultTestLoader.loadTestsFromTestCase
+    s.addTests(load_from(Test_Dump))
+
+    return s
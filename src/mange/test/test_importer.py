@@ -0,0 +1,68 @@
+import json
+import pathlib
+import tempfile
+import unittest
+
+from mange.api import Client
+from mange.importer import import_readings, load_state, save_state, state_path
+from mange.test.test_db import build_test_db
+
+
+class Test_Importer(unittest.TestCase):
+
+    def setUp(self):
+        build_test_db()
+        self.client = Client()
+        self.client.create_sucursal(nombre="blobcorp", tipo="oficina", direccion="calle", limite=100)
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.client.session.remove()
+        self.dir.cleanup()
+
+    def write(self, name, lines):
+        path = pathlib.Path(self.dir.name) / name
+        path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return path
+
+    def test_import_csv(self):
+        path = self.write(
+            "readings.csv",
+            ["id_sucursal,fecha,lectura,costo,sobre_limite"]
+            + [f"1,2000-10-{day:02},{day},0,0" for day in range(1, 8)]
+            + ["1,2000-10-08,oops,0,0"],
+        )
+
+        created, rejected = import_readings(self.client, path, chunk_size=3)
+
+        self.assertEqual(created, 7)
+        self.assertEqual([line for line, _ in rejected], [8])
+        self.assertFalse(state_path(path).exists())
+
+    def test_resume_jsonl(self):
+        rows = [
+            {"id_sucursal": 1, "fecha": f"2000-10-{day:02}", "lectura": day, "costo": 0, "sobre_limite": 0}
+            for day in range(1, 6)
+        ]
+        path = self.write("readings.jsonl", [json.dumps(row) for row in rows])
+
+        # pretend a previous run committed the first two rows and crashed
+        self.client.bulk_create_registro(rows[:2])
+        with open(path, "rb") as file:
+            file.readline()
+            file.readline()
+            save_state(path, {"offset": file.tell(), "line": 2})
+
+        created, rejected = import_readings(self.client, path, chunk_size=2)
+
+        self.assertEqual((created, rejected), (3, []))
+        self.assertEqual(self.client.get_registro().count(), 5)
+        self.assertEqual(load_state(path), {"offset": 0, "line": 0})
+
+
+def main_suite() -> unittest.TestSuite:
+    s = unittest.TestSuite()
+    load_from = unittest.defaultTestLoader.loadTestsFromTestCase
+    s.addTests(load_from(Test_Importer))
+
+    return s
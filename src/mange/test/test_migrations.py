@@ -0,0 +1,110 @@
+import pathlib
+import sqlite3
+import tempfile
+import unittest
+
+from sqlalchemy import Column, Integer, MetaData, create_engine
+
+from mange.db import Base
+from mange.migrations import MigrationError, fingerprint, migrate
+
+
+OLD_SCHEMA = """
+CREATE TABLE sucursal (
+    id INTEGER PRIMARY KEY, nombre VARCHAR NOT NULL UNIQUE, tipo VARCHAR NOT NULL,
+    direccion VARCHAR NOT NULL, limite INTEGER NOT NULL,
+    porciento_extra INTEGER NOT NULL, aumento INTEGER NOT NULL
+);
+CREATE INDEX ix_sucursal_tipo ON sucursal (tipo);
+CREATE TABLE registro (
+    lectura TEXT NOT NULL, costo INTEGER NOT NULL, sobre_limite INTEGER NOT NULL,
+    fecha DATE NOT NULL, id_sucursal INTEGER NOT NULL REFERENCES sucursal (id),
+    id INTEGER NOT NULL, PRIMARY KEY (id, id_sucursal)
+);
+INSERT INTO sucursal VALUES (1, 'blobcorp', 'oficina', 'calle', 10, 15, 20);
+INSERT INTO registro VALUES
+    (0, 0, 0, '2000-01-01', 1, 1),
+    (20, 0, 10, '2000-01-31', 1, 2),
+    (25, 0, 5, '2000-02-01', 1, 3);
+"""
+
+
+class Test_Migrations(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.dir.name) / "db.sqlite3"
+        self.url = f"sqlite:///{self.path}"
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def query(self, sql):
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def test_create(self):
+        steps = migrate(self.url)
+        self.assertIn("create table registro", steps)
+        self.assertEqual(migrate(self.url), [])
+        self.assertEqual(self.query("SELECT fingerprint FROM schema_version"), [(fingerprint(),)])
+
+    def test_create_all_is_up_to_date(self):
+        engine = create_engine(self.url)
+        Base.metadata.create_all(engine)
+        engine.dispose()
+
+        self.assertEqual(migrate(self.url, dry_run=True), [])
+
+    def test_upgrade(self):
+        connection = sqlite3.connect(self.path)
+        connection.executescript(OLD_SCHEMA)
+        connection.close()
+
+        self.assertEqual(len(migrate(self.url, dry_run=True)), len(migrate(self.url, batch_size=2)))
+        self.assertEqual(migrate(self.url), [])
+
+        # the new columns got their defaults, dropped indexes are dropped
+        self.assertEqual(self.query("SELECT id, nombre, version FROM sucursal"), [(1, "blobcorp", 1)])
+        indexes = {name for name, in self.query("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertNotIn("ix_sucursal_tipo", indexes)
+        self.assertIn("ix_registro_sucursal_fecha", indexes)
+
+        # updated_at is computed when the row is written, it has no SQL DEFAULT
+        sql, = self.query("SELECT sql FROM sqlite_master WHERE name = 'sucursal'")[0]
+        self.assertNotRegex(sql, r"updated_at[^,]*DEFAULT")
+        self.assertIsNotNone(self.query("SELECT updated_at FROM sucursal")[0][0])
+
+        # registro changed its primary key and a type, it was copied
+        self.assertEqual(
+            self.query("SELECT id, lectura, fecha, version FROM registro ORDER BY id"),
+            [(1, 0, "2000-01-01", 1), (2, 20, "2000-01-31", 1), (3, 25, "2000-02-01", 1)],
+        )
+        # and the rollups were built from it
+        self.assertEqual(
+            self.query("SELECT anio, mes, consumo FROM consumo_mensual ORDER BY anio, mes"),
+            [(2000, 1, 20), (2000, 2, 5)],
+        )
+        self.assertEqual(self.query("SELECT fecha, exceso FROM alerta ORDER BY fecha"), [("2000-01-31", 10), ("2000-02-01", 5)])
+
+    def test_required_column_without_default(self):
+        migrate(self.url)
+
+        metadata = MetaData()
+        for table in Base.metadata.tables.values():
+            table.to_metadata(metadata)
+        metadata.tables["sucursal"].append_column(Column("piso", Integer, nullable=False))
+
+        with self.assertRaises(MigrationError):
+            migrate(self.url, metadata)
+
+
+def main_suite() -> unittest.TestSuite:
+    s = unittest.TestSuite()
+    load_from = unittest.defaultTestLoader.loadTestsFromTestCase
+    s.addTests(load_from(Test_Migrations))
+
+    return s
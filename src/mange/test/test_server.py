@@ -0,0 +1,309 @@
+from datetime import date
+import os
+import select
+import signal
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from mange.test.test_db import build_test_db
+
+build_test_db()
+
+from mange import metrics
+from mange.api import encode_cursor, report_cache
+from mange.server import app, client
+
+
+class Test_Server(unittest.TestCase):
+
+    def setUp(self):
+        build_test_db()
+        client.session.remove()
+        report_cache.clear()
+        self.http = app.test_client()
+
+    def tearDown(self):
+        client.session.remove()
+
+    def create_sucursales(self, n):
+        for index in range(n):
+            client.create_sucursal(
+                nombre=f"sucursal {index}", tipo="oficina", direccion="calle", limite=100
+            )
+
+    def test_index_paginates(self):
+        self.create_sucursales(5)
+
+        page = self.http.get("/api/sucursal/?limit=2").json
+        self.assertEqual([row["id"] for row in page["results"]], [1, 2])
+
+        page = self.http.get(f"/api/sucursal/?limit=2&after={page['next']}").json
+        self.assertEqual([row["id"] for row in page["results"]], [3, 4])
+
+        page = self.http.get(f"/api/sucursal/?limit=2&after={page['next']}").json
+        self.assertEqual([row["id"] for row in page["results"]], [5])
+        self.assertIsNone(page["next"])
+
+    def test_index_streams(self):
+        self.create_sucursales(3)
+
+        response = self.http.get("/api/sucursal/?stream=1")
+        self.assertTrue(response.is_streamed)
+        self.assertEqual([row["id"] for row in response.json], [1, 2, 3])
+
+        client.session.remove()
+        build_test_db()
+        self.assertEqual(self.http.get("/api/sucursal/?stream=1").json, [])
+
+    def test_registro_bulk(self):
+        self.create_sucursales(1)
+        rows = [
+            {"id_sucursal": 1, "fecha": "2000-10-01", "lectura": 1, "costo": 0, "sobre_limite": 0},
+            {"id_sucursal": 1, "fecha": "2000-10-02", "lectura": "x", "costo": 0, "sobre_limite": 0},
+        ]
+
+        result = self.http.post("/api/registro/bulk/", json=rows).json
+        self.assertEqual(result["created"], 1)
+        self.assertEqual(result["errors"][0]["index"], 1)
+
+        self.assertEqual(self.http.post("/api/registro/bulk/", json={}).status_code, 400)
+
+    def test_report_forecast(self):
+        self.create_sucursales(2)
+
+        self.assertEqual(self.http.get("/api/report/forecast/?sucursal=1&sucursal=2").json, {"1": None, "2": None})
+        self.assertEqual(self.http.get("/api/report/forecast/?sucursal=x").status_code, 400)
+
+    def test_report_over_limit(self):
+        self.create_sucursales(1)
+
+        self.assertEqual(self.http.get("/api/report/over-limit/?anio=2000&mes=10").json, [])
+        self.assertEqual(self.http.get("/api/report/over-limit/?anio=2000&mes=13").status_code, 400)
+
+    def test_alerts(self):
+        self.create_sucursales(2)
+        client.bulk_create_registro([
+            {"id_sucursal": id_sucursal, "fecha": f"2000-10-{day:02}", "lectura": day, "costo": 0, "sobre_limite": day}
+            for id_sucursal in (1, 2)
+            for day in (1, 2, 3)
+        ])
+
+        page = self.http.get("/api/alerta/?sucursal=2&limit=2").json
+        self.assertEqual([(row["id_sucursal"], row["fecha"]) for row in page["results"]], [(2, "2000-10-01"), (2, "2000-10-02")])
+        page = self.http.get(f"/api/alerta/?sucursal=2&limit=2&after={page['next']}").json
+        self.assertEqual([row["fecha"] for row in page["results"]], ["2000-10-03"])
+
+        alerta = page["results"][0]["id"]
+        self.assertTrue(self.http.post(f"/api/alerta/{alerta}/acknowledge/").json["reconocida"])
+
+        # alerts are derived from the readings
+        self.assertEqual(self.http.post("/api/alerta/", json={"id_sucursal": 1}).status_code, 405)
+        self.assertEqual(self.http.put(f"/api/alerta/{alerta}/", json={"reconocida": False}).status_code, 405)
+        self.assertEqual(self.http.delete(f"/api/alerta/{alerta}/").status_code, 405)
+        self.assertEqual(self.http.get(f"/api/alerta/{alerta}/").status_code, 200)
+
+    def test_report_cache(self):
+        self.create_sucursales(2)
+        url = "/api/report/over-limit/?mes=10&anio=2000"
+        reading = {"fecha": "2000-10-01", "lectura": 0, "costo": 0, "sobre_limite": 0}
+        client.bulk_create_registro([{**reading, "id_sucursal": id_sucursal} for id_sucursal in (1, 2)])
+
+        self.assertEqual(self.http.get(url).json, [])
+        hits = metrics.cache_requests.value(("report", "hit"))
+        # same parameters in another order
+        self.assertEqual(self.http.get("/api/report/over-limit/?anio=2000&mes=10").json, [])
+        self.assertEqual(metrics.cache_requests.value(("report", "hit")), hits + 1)
+
+        # the bulk path invalidates the reports of the branches it wrote to
+        self.http.get("/api/alerta/?sucursal=1")
+        self.http.get("/api/alerta/?sucursal=2")
+        client.bulk_create_registro([{**reading, "id_sucursal": 2, "fecha": "2000-10-31", "lectura": 150}])
+        self.assertEqual([row["id_sucursal"] for row in self.http.get(url).json], [2])
+        self.assertEqual(len(report_cache), 2)  # over-limit again and the alerts of branch 1
+
+        # so do ORM writes, once committed
+        client.update(client.get_sucursal(id=2).one(), limite=1000)
+        self.assertEqual(len(report_cache), 2)
+        client.session.commit()
+        self.assertEqual(self.http.get(url).json, [])
+        self.assertEqual(len(report_cache), 2)
+
+    def test_conditional_get(self):
+        self.create_sucursales(2)
+
+        response = self.http.get("/api/sucursal/1/")
+        tag = response.headers["ETag"]
+        self.assertEqual(response.json["version"], 1)
+        self.assertIsNotNone(response.last_modified)
+        response = self.http.get("/api/sucursal/1/", headers={"If-None-Match": tag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+
+        page = self.http.get("/api/sucursal/?limit=1")
+        self.assertIsNotNone(page.last_modified)
+        self.assertEqual(
+            self.http.get("/api/sucursal/?limit=1", headers={"If-None-Match": page.headers["ETag"]}).status_code,
+            304,
+        )
+
+        client.update(client.get_sucursal(id=1).one(), limite=1000)
+        client.session.commit()
+        response = self.http.get("/api/sucursal/1/", headers={"If-None-Match": tag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["version"], 2)
+        self.assertNotEqual(response.headers["ETag"], tag)
+        response = self.http.get("/api/sucursal/?limit=1", headers={"If-None-Match": page.headers["ETag"]})
+        self.assertEqual(response.status_code, 200)
+
+    def test_fields(self):
+        self.create_sucursales(2)
+
+        page = self.http.get("/api/sucursal/?fields=nombre,id&limit=1")
+        self.assertEqual(page.json["results"], [{"nombre": "sucursal 0", "id": 1}])
+        page = self.http.get(f"/api/sucursal/?fields=nombre&after={page.json['next']}").json
+        self.assertEqual(page["results"], [{"nombre": "sucursal 1"}])
+
+        self.assertEqual(self.http.get("/api/sucursal/2/?fields=limite").json, {"limite": 100})
+        self.assertEqual(self.http.get("/api/sucursal/?fields=id&stream=1").json, [{"id": 1}, {"id": 2}])
+        self.assertEqual(self.http.get("/api/sucursal/?fields=nope").status_code, 400)
+
+        # a projection is another representation
+        full = self.http.get("/api/sucursal/1/").headers["ETag"]
+        self.assertNotEqual(self.http.get("/api/sucursal/1/?fields=id").headers["ETag"], full)
+
+    def test_filters(self):
+        self.create_sucursales(3)
+        client.bulk_create_registro([
+            {"id_sucursal": id_sucursal, "fecha": f"2000-10-{day:02}", "lectura": day, "costo": 0, "sobre_limite": 0}
+            for id_sucursal in (1, 2, 3)
+            for day in (1, 2, 3)
+        ])
+
+        def fetch(query):
+            return [(row["id_sucursal"], row["fecha"][-2:]) for row in self.http.get(f"/api/registro/?{query}").json["results"]]
+
+        self.assertEqual(
+            fetch("id_sucursal__in=1,3&fecha__gte=2000-10-02&fecha__lt=2000-10-03"),
+            [(1, "02"), (3, "02")],
+        )
+        self.assertEqual(fetch("fecha=2000-10-03&sort=-id"), [(3, "03"), (2, "03"), (1, "03")])
+        # without ?sort= a range is walked in the order of its index
+        self.assertEqual(fetch("fecha__gte=2000-10-03&limit=2"), [(1, "03"), (2, "03")])
+        # the date index can't give the branch order, nor the primary key the dates
+        self.assertEqual(self.http.get("/api/registro/?fecha=2000-10-03&sort=-id_sucursal").status_code, 400)
+        self.assertEqual(self.http.get("/api/registro/?fecha__gte=2000-10-03&sort=id").status_code, 400)
+
+        # the sort goes along with the cursor
+        page = self.http.get("/api/registro/?sort=-fecha&limit=2&fields=id_sucursal").json
+        self.assertEqual(page["results"], [{"id_sucursal": 3}, {"id_sucursal": 2}])
+        page = self.http.get(f"/api/registro/?sort=-fecha&limit=2&after={page['next']}").json
+        self.assertEqual([(row["id_sucursal"], row["fecha"]) for row in page["results"]], [(1, "2000-10-03"), (3, "2000-10-02")])
+        self.assertEqual(self.http.get("/api/registro/?sort=-fecha,id_sucursal").status_code, 400)
+
+        names = self.http.get("/api/sucursal/?nombre__startswith=sucursal 1").json["results"]
+        self.assertEqual([row["nombre"] for row in names], ["sucursal 1"])
+
+        self.assertEqual(self.http.get("/api/registro/?lectura=1").status_code, 400)
+        self.assertEqual(self.http.get("/api/registro/?sort=lectura").status_code, 400)
+        self.assertEqual(self.http.get("/api/registro/?fecha__gte=nope").status_code, 400)
+
+    def test_authentication(self):
+        token = client.create_user(name="blob", password="doko").token.value
+
+        self.assertEqual(self.http.get("/api/sucursal/", headers={"Authorization": token}).status_code, 200)
+        self.assertEqual(self.http.get("/api/sucursal/", headers={"Authorization": f"Bearer {token}"}).status_code, 200)
+        self.assertEqual(self.http.get("/api/sucursal/", headers={"Authorization": "nope"}).status_code, 401)
+
+    def test_metrics(self):
+        self.http.get("/api/sucursal/")
+        self.assertEqual(self.http.get("/api/metrics").status_code, 401)
+
+        admin = client.create_group(name="Admin")
+        token = client.create_user(name="admin", password="doko", group=admin).token.value
+        body = self.http.get("/api/metrics", headers={"Authorization": token}).text
+        self.assertIn('mange_http_requests_total{route="/api/sucursal/",method="GET",status="200"}', body)
+        self.assertIn('mange_client_seconds_count{method="get_sucursal"}', body)
+        self.assertIn('mange_sql_statements_total{statement="SELECT"}', body)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "fork is not available")
+    def test_metrics_reset_at_fork(self):
+        metrics.sql_statements.inc(("TEST",))
+        read, write = os.pipe()
+        # as if another thread was recording when the worker was forked
+        with metrics.sql_statements._lock:
+            pid = os.fork()
+            if pid == 0:
+                metrics.sql_statements.inc(("TEST",))
+                os.write(write, str(metrics.sql_statements.value(("TEST",))).encode())
+                os._exit(0)
+        ready, _, _ = select.select([read], [], [], 5)
+        if not ready:
+            os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read, 16) if ready else b"deadlock", b"1")
+        os.close(read)
+        os.close(write)
+        self.assertGreater(metrics.sql_statements.value(("TEST",)), 0)
+
+    def test_publish_survives_errors(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(metrics, "publish", side_effect=[OSError("disk full")] + [None] * 1000) as publish:
+            metrics.share(directory)
+            try:
+                metrics.publish_every(interval=0.01)
+                for _ in range(500):
+                    if publish.call_count >= 2:
+                        break
+                    time.sleep(0.01)
+            finally:
+                # stops the thread
+                metrics.share(None)
+        # it went on publishing after the failed write
+        self.assertGreaterEqual(publish.call_count, 2)
+
+    def test_merge_snapshots(self):
+        registry = metrics.Registry()
+        counter = registry.counter("c", "test", ("x",))
+        histogram = registry.histogram("h", "test", buckets=(1,))
+        counter.inc(("a",))
+        histogram.observe(0.5)
+        other = registry.snapshot()
+
+        body = registry.render([other, other])
+        self.assertIn('c{x="a"} 3', body)
+        self.assertIn('h_bucket{le="1"} 3', body)
+        self.assertIn("h_sum 1.5", body)
+        # rendering doesn't change the values of the registry
+        self.assertEqual(counter.value(("a",)), 1)
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("h", "test", ("x",), buckets=(1, 2))
+        for value in (0.5, 1.5, 1.5, 3):
+            histogram.observe(value, ("a",))
+
+        self.assertEqual(list(histogram.samples()), [
+            'h_bucket{x="a",le="1"} 1',
+            'h_bucket{x="a",le="2"} 3',
+            'h_bucket{x="a",le="+Inf"} 4',
+            'h_sum{x="a"} 6.5',
+            'h_count{x="a"} 4',
+        ])
+
+    def test_index_rejects_bad_arguments(self):
+        self.assertEqual(self.http.get("/api/sucursal/?limit=0").status_code, 400)
+        self.assertEqual(self.http.get("/api/sucursal/?after=garbage").status_code, 400)
+        # well formed cursors with values of the wrong type
+        for values in ([1, 5], [True, "2000-01-01"], [1, "nope"]):
+            cursor = encode_cursor(values)
+            self.assertEqual(self.http.get(f"/api/registro/?after={cursor}").status_code, 400, values)
+        self.assertEqual(self.http.get(f"/api/sucursal/?after={encode_cursor([True])}").status_code, 400)
+
+
+def main_suite() -> unittest.TestSuite:
+    s = unittest.TestSuite()
+    load_from = unittest.defaultTestLoader.loadTestsFromTestCase
+    s.addTests(load_from(Test_Server))
+
+    return s
@@ -0,0 +1,114 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from urllib.request import urlopen
+
+from mange.test.test_db import build_test_db
+
+build_test_db()
+
+from mange import metrics
+from mange.server import ProcessLocalClient
+from mange.serving import PooledWSGIServer, listen
+
+
+class Test_Serving(unittest.TestCase):
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires fork")
+    def test_client_is_created_after_fork(self):
+        client = ProcessLocalClient(factory=object)
+        parent = client.get()
+        self.assertIs(client.get(), parent)
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if client.get() is not parent else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+    def test_busy_worker_leaves_connections_queued(self):
+        release = threading.Event()
+
+        def app(environ, start_response):
+            release.wait(5)
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [b"OK"]
+
+        sock = listen("127.0.0.1", 0)
+        server = PooledWSGIServer(*sock.getsockname()[:2], app, 1, fd=sock.fileno())
+        accepted = []
+        get_request = server.get_request
+        server.get_request = lambda: accepted.append(1) or get_request()
+        thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+        thread.start()
+        try:
+            url = f"http://127.0.0.1:{sock.getsockname()[1]}/"
+            with ThreadPoolExecutor(2) as requests:
+                first = requests.submit(lambda: urlopen(url, timeout=5).read())
+                time.sleep(0.2)
+                second = requests.submit(lambda: urlopen(url, timeout=5).read())
+                time.sleep(0.2)
+                # the only thread is busy, the second connection waits in the backlog
+                self.assertEqual(len(accepted), 1)
+                release.set()
+                self.assertEqual((first.result(), second.result()), (b"OK", b"OK"))
+            self.assertEqual(len(accepted), 2)
+        finally:
+            release.set()
+            server.shutdown()
+            thread.join()
+            server.server_close()
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires fork")
+    def test_prefork_server(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        server = subprocess.Popen(
+            [
+                sys.executable, "-c",
+                "import sys; from mange.conf import settings; settings.METRICS_PUBLIC = True; "
+                "from mange.server import runserver; runserver(sys.argv[1:])",
+                "--port", str(port), "--workers", "2", "--threads", "2",
+            ],
+            env=os.environ,
+        )
+        try:
+            for _ in range(50):
+                try:
+                    with urlopen(f"http://127.0.0.1:{port}/", timeout=1) as response:
+                        self.assertEqual(response.read(), b"OK")
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            else:
+                self.fail("server didn't start")
+
+            for _ in range(10):
+                with urlopen(f"http://127.0.0.1:{port}/api/sucursal/", timeout=5) as response:
+                    self.assertEqual(response.status, 200)
+
+            # whichever worker answers, the metrics add up those of both
+            time.sleep(2 * metrics.SHARE_INTERVAL)
+            for _ in range(4):
+                with urlopen(f"http://127.0.0.1:{port}/api/metrics", timeout=5) as response:
+                    body = response.read().decode()
+                self.assertIn('mange_http_requests_total{route="/api/sucursal/",method="GET",status="200"} 10', body)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            self.assertEqual(server.wait(timeout=10), 0)
+
+
+def main_suite() -> unittest.TestSuite:
+    s = unittest.TestSuite()
+    load_from = unittest.defaultTestLoader.loadTestsFromTestCase
+    s.addTests(load_from(Test_Serving))
+
+    return s